@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+"""Compare the startup cost of a job with and without deferred imports and a warm pool.
+
+For sensorposition and netcdf, times in fresh interpreters:
+  - python doing nothing,
+  - importing the extractor module, whose heavy imports are now deferred,
+  - importing it together with the deferred modules, as every job did before,
+and the round trip of a job sent to a pre-forked pool of the extractor.
+
+    python bench_startup.py [repeats]
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+COMMON = os.path.join(REPO, "common")
+
+
+# name: (directory, module, modules whose import is deferred until first use)
+EXTRACTORS = {
+	"sensorposition": ("sensorposition", "terra_sensorposition", ["terrautils.geostreams"]),
+	"netcdf": ("netcdf", "terra_netcdf", ["numpy", "netCDF4"])
+}
+
+
+def median_time(cmd, cwd, repeats):
+	"""Median wall time of running cmd, or None if it fails."""
+	times = []
+	for i in range(repeats):
+		start = time.time()
+		with open(os.devnull, "w") as devnull:
+			if subprocess.call(cmd, cwd=cwd, stdout=devnull, stderr=devnull) != 0:
+				return None
+		times.append(time.time() - start)
+	return sorted(times)[len(times) // 2]
+
+
+def prefork_time(directory, module, repeats):
+	"""Median round trip of a ping job to a pre-forked pool of the extractor, or None."""
+	socket_path = os.path.join(tempfile.mkdtemp(prefix="prefork-"), "bench.sock")
+	with open(os.devnull, "w") as devnull:
+		server = subprocess.Popen([sys.executable, module + ".py", "--prefork_socket", socket_path,
+								   "--prefork_workers", "2"], cwd=directory, stdout=devnull, stderr=devnull)
+	try:
+		deadline = time.time() + 60
+		while not os.path.exists(socket_path):
+			if server.poll() is not None or time.time() > deadline:
+				return None
+			time.sleep(0.1)
+		client = [sys.executable, os.path.join(COMMON, "prefork.py"), "submit", socket_path, "--ping"]
+		return median_time(client, directory, repeats)
+	finally:
+		server.terminate()
+		server.wait()
+
+
+def show(label, seconds):
+	print("  %-42s %s" % (label, "failed" if seconds is None else "%.3fs" % seconds))
+
+
+if __name__ == "__main__":
+	repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+	path_setup = "import sys; sys.path.append(%r); " % COMMON
+	show("python -c pass", median_time([sys.executable, "-c", "pass"], REPO, repeats))
+	for name in sorted(EXTRACTORS):
+		directory, module, deferred = EXTRACTORS[name]
+		directory = os.path.join(REPO, directory)
+		print(name)
+		show("import, deferred (now)", median_time(
+			[sys.executable, "-c", path_setup + "import %s" % module], directory, repeats))
+		show("import + %s (before)" % ", ".join(deferred), median_time(
+			[sys.executable, "-c", path_setup + "import %s; import %s" % (module, ", ".join(deferred))],
+			directory, repeats))
+		show("job sent to a warm pre-forked pool", prefork_time(directory, module, repeats))
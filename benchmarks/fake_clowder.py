@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+
+"""In-memory stand-in for the Clowder and geostreams API used by the extractors.
+
+Answers the dataset, file, metadata, extraction, upload and geostreams calls
+made through pyclowder, terrautils and common/clowder_client.py, with a
+configurable delay per request and a rate of injected 503 errors. Counts
+requests per route so a benchmark can report requests per message.
+
+Uploads are accepted as multipart posts to uploadToDataset or in chunks through
+api/uploads, the resumable protocol of repairer/upload.py; start the server with
+chunked_uploads=False to answer those with 404 like a Clowder without it.
+
+Test data is loaded by POSTing JSON to /_bench/seed:
+    {"datasets": {id: {"name": ..., "files": [file ids], "metadata": [...]}},
+     "files": {id: {"filename": ..., "filepath": ..., "size": ..., "sha512": ...}}}
+GET /_bench/stats returns the request counts and POST /_bench/reset clears them.
+
+Run on its own with:
+    python fake_clowder.py [--port 9000] [--latency 0.02] [--error_rate 0.01] [--no_chunked_uploads]
+"""
+
+import argparse
+import hashlib
+import itertools
+import json
+import random
+import re
+import threading
+import time
+
+try:
+	from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+	from SocketServer import ThreadingMixIn
+	from urlparse import urlparse, parse_qs
+except ImportError:
+	from http.server import BaseHTTPRequestHandler, HTTPServer
+	from socketserver import ThreadingMixIn
+	from urllib.parse import urlparse, parse_qs
+
+
+class FakeClowderState(object):
+	"""Datasets, files, metadata and geostreams objects held by the fake server."""
+
+	def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, seed=None, chunked_uploads=True):
+		self.latency = latency
+		self.jitter = jitter
+		self.error_rate = error_rate
+		self.chunked_uploads = chunked_uploads
+		self.random = random.Random(seed)
+		self.lock = threading.Lock()
+		self.ids = itertools.count(1)
+		self.datasets = {}
+		self.files = {}
+		self.sensors = {}
+		self.streams = {}
+		self.datapoints = 0
+		self.uploads = {}
+		self.uploaded_bytes = 0
+		self.counts = {}
+		self.errors = 0
+
+	def new_id(self):
+		with self.lock:
+			return "%024x" % next(self.ids)
+
+	def seed(self, data):
+		with self.lock:
+			for ds_id, ds in data.get("datasets", {}).items():
+				entry = self.datasets.setdefault(ds_id, {"name": ds_id, "files": [], "metadata": [], "extractions": []})
+				entry.update(ds)
+				entry.setdefault("extractions", [])
+			self.files.update(data.get("files", {}))
+
+	def count(self, route):
+		with self.lock:
+			self.counts[route] = self.counts.get(route, 0) + 1
+
+	def stats(self):
+		with self.lock:
+			return {"requests": dict(self.counts), "total": sum(self.counts.values()), "errors": self.errors,
+					"datapoints": self.datapoints, "uploaded_bytes": self.uploaded_bytes}
+
+	def reset(self):
+		with self.lock:
+			self.counts = {}
+			self.errors = 0
+			self.datapoints = 0
+			self.uploaded_bytes = 0
+
+	def inject(self):
+		"""Sleep for the configured latency; True if this request should fail with a 503."""
+		delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+		if delay > 0:
+			time.sleep(delay)
+		if self.error_rate and self.random.random() < self.error_rate:
+			with self.lock:
+				self.errors += 1
+			return True
+		return False
+
+
+# (method, path pattern, handler name, route name used in the request counts)
+ROUTES = [
+	("GET", r"^/api/datasets$", "find_datasets", "datasets"),
+	("GET", r"^/api/datasets/(\w+)$", "dataset_info", "dataset_info"),
+	("GET", r"^/api/datasets/(\w+)/files$", "dataset_files", "dataset_files"),
+	("GET", r"^/api/datasets/(\w+)/metadata\.jsonld$", "get_metadata", "download_metadata"),
+	("POST", r"^/api/datasets/(\w+)/metadata\.jsonld$", "add_metadata", "upload_metadata"),
+	("DELETE", r"^/api/datasets/(\w+)/metadata\.jsonld$", "remove_metadata", "remove_metadata"),
+	("POST", r"^/api/datasets/(\w+)/extractions$", "submit_extraction", "submit_extraction"),
+	("POST", r"^/api/uploadToDataset/(\w+)$", "upload_to_dataset", "upload_to_dataset"),
+	("POST", r"^/api/uploads$", "start_upload", "upload_start"),
+	("PUT", r"^/api/uploads/(\w+)$", "upload_chunk", "upload_chunk"),
+	("GET", r"^/api/uploads/(\w+)$", "upload_status", "upload_status"),
+	("POST", r"^/api/uploads/(\w+)/complete$", "complete_upload", "upload_complete"),
+	("GET", r"^/api/files/(\w+)/metadata$", "file_info", "download_info"),
+	("POST", r"^/api/files/(\w+)/metadata\.jsonld$", "add_file_metadata", "upload_file_metadata"),
+	("GET", r"^/api/geostreams/sensors$", "find_sensors", "geostreams_sensors"),
+	("POST", r"^/api/geostreams/sensors$", "create_sensor", "geostreams_create_sensor"),
+	("GET", r"^/api/geostreams/streams$", "find_streams", "geostreams_streams"),
+	("POST", r"^/api/geostreams/streams$", "create_stream", "geostreams_create_stream"),
+	("POST", r"^/api/geostreams/datapoints$", "create_datapoint", "geostreams_datapoint"),
+	("POST", r"^/api/geostreams/datapoints/bulk$", "create_datapoints", "geostreams_datapoints_bulk"),
+]
+ROUTES = [(m, re.compile(p), h, r) for m, p, h, r in ROUTES]
+
+
+class FakeClowderHandler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+	state = None
+
+	def log_message(self, format, *args):
+		pass
+
+	def do_GET(self):
+		self.dispatch("GET")
+
+	def do_POST(self):
+		self.dispatch("POST")
+
+	def do_PUT(self):
+		self.dispatch("PUT")
+
+	def do_DELETE(self):
+		self.dispatch("DELETE")
+
+	def dispatch(self, method):
+		url = urlparse(self.path)
+		self.query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+		self.body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+		state = self.state
+
+		if url.path.startswith("/_bench/"):
+			if url.path == "/_bench/seed":
+				state.seed(json.loads(self.body.decode("utf-8")))
+				return self.reply({})
+			if url.path == "/_bench/stats":
+				return self.reply(state.stats())
+			if url.path == "/_bench/reset":
+				state.reset()
+				return self.reply({})
+			return self.reply({"error": "not found"}, 404)
+
+		for m, pattern, handler, route in ROUTES + getattr(self, "extra_routes", []):
+			match = pattern.match(url.path)
+			if m == method and match:
+				state.count(route)
+				if state.inject():
+					return self.reply({"error": "injected failure"}, 503)
+				return getattr(self, handler)(*match.groups())
+		state.count("unknown %s %s" % (method, url.path))
+		return self.reply({"error": "not found"}, 404)
+
+	def reply(self, data, status=200):
+		body = json.dumps(data).encode("utf-8")
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def json_body(self):
+		try:
+			return json.loads(self.body.decode("utf-8")) if self.body else {}
+		except ValueError:
+			return {}
+
+	def dataset(self, ds_id):
+		with self.state.lock:
+			return self.state.datasets.setdefault(ds_id, {"name": ds_id, "files": [], "metadata": [], "extractions": []})
+
+	# datasets
+	def find_datasets(self):
+		title = self.query.get("title")
+		with self.state.lock:
+			found = [{"id": i, "name": d["name"]} for i, d in self.state.datasets.items()
+					 if title is None or d["name"] == title]
+		self.reply(found[:int(self.query.get("limit", 100))])
+
+	def dataset_info(self, ds_id):
+		ds = self.dataset(ds_id)
+		self.reply({"id": ds_id, "name": ds["name"], "description": "", "files": ds["files"]})
+
+	def dataset_files(self, ds_id):
+		ds = self.dataset(ds_id)
+		with self.state.lock:
+			files = [dict(self.state.files.get(f, {}), id=f) for f in ds["files"]]
+		self.reply(files)
+
+	def get_metadata(self, ds_id):
+		self.reply(self.dataset(ds_id)["metadata"])
+
+	def add_metadata(self, ds_id):
+		md = self.json_body()
+		ds = self.dataset(ds_id)
+		with self.state.lock:
+			ds["metadata"].append(md)
+		self.reply({})
+
+	def remove_metadata(self, ds_id):
+		extractor = self.query.get("extractor")
+		ds = self.dataset(ds_id)
+		with self.state.lock:
+			ds["metadata"] = [md for md in ds["metadata"] if extractor and
+							  not md.get("agent", {}).get("extractor_id", "").endswith(extractor)]
+		self.reply({})
+
+	def submit_extraction(self, ds_id):
+		ds = self.dataset(ds_id)
+		with self.state.lock:
+			ds["extractions"].append(self.json_body().get("extractor"))
+		self.reply({"status": "OK"})
+
+	def add_file(self, ds_id, filename, size, sha512):
+		file_id = self.state.new_id()
+		ds = self.dataset(ds_id)
+		with self.state.lock:
+			ds["files"].append(file_id)
+			self.state.files[file_id] = {"filename": filename, "size": size, "sha512": sha512}
+		return file_id
+
+	def upload_to_dataset(self, ds_id):
+		filename, data = "upload", self.body
+		match = re.search(r'boundary=("?)([^";]+)\1', self.headers.get("Content-Type", ""))
+		if match:
+			# one file part: headers, a blank line, the content, then the closing boundary
+			part = self.body.split(b"--" + match.group(2).encode("utf-8"))[1]
+			head, data = part.split(b"\r\n\r\n", 1)
+			data = data[:-2] if data.endswith(b"\r\n") else data
+			name = re.search(br'filename="([^"]*)"', head)
+			if name:
+				filename = name.group(1).decode("utf-8")
+		with self.state.lock:
+			self.state.uploaded_bytes += len(data)
+		self.reply({"id": self.add_file(ds_id, filename, len(data), hashlib.sha512(data).hexdigest())})
+
+	# chunked uploads
+	def start_upload(self):
+		if not self.state.chunked_uploads:
+			return self.reply({"error": "not found"}, 404)
+		body = self.json_body()
+		key = (body.get("dataset_id"), body.get("filename"), body.get("size"))
+		with self.state.lock:
+			# an unfinished upload of the same file is resumed, as after a restart of the uploader
+			for upload_id, upload in self.state.uploads.items():
+				if upload["key"] == key:
+					return self.reply({"id": upload_id, "offset": upload["offset"]})
+			upload_id = "%024x" % next(self.state.ids)
+			self.state.uploads[upload_id] = {"key": key, "offset": 0, "sha512": hashlib.sha512()}
+		self.reply({"id": upload_id, "offset": 0})
+
+	def upload_chunk(self, upload_id):
+		if not self.state.chunked_uploads:
+			return self.reply({"error": "not found"}, 404)
+		match = re.match(r"bytes (\d+)-(\d+)/(\d+)", self.headers.get("Content-Range", ""))
+		with self.state.lock:
+			upload = self.state.uploads.get(upload_id)
+			if upload is None or not match:
+				return self.reply({"error": "unknown upload or missing Content-Range"}, 404 if upload is None else 400)
+			if int(match.group(1)) != upload["offset"]:
+				return self.reply({"error": "offset mismatch", "offset": upload["offset"]}, 409)
+			upload["sha512"].update(self.body)
+			upload["offset"] += len(self.body)
+			self.state.uploaded_bytes += len(self.body)
+			offset = upload["offset"]
+		self.reply({"offset": offset})
+
+	def upload_status(self, upload_id):
+		with self.state.lock:
+			upload = self.state.uploads.get(upload_id)
+		if upload is None or not self.state.chunked_uploads:
+			return self.reply({"error": "not found"}, 404)
+		self.reply({"offset": upload["offset"]})
+
+	def complete_upload(self, upload_id):
+		with self.state.lock:
+			upload = self.state.uploads.get(upload_id)
+			if upload is None or not self.state.chunked_uploads:
+				return self.reply({"error": "not found"}, 404)
+			ds_id, filename, size = upload["key"]
+			if upload["offset"] != size:
+				return self.reply({"error": "incomplete upload", "offset": upload["offset"]}, 400)
+			del self.state.uploads[upload_id]
+		self.reply({"id": self.add_file(ds_id, filename, size, upload["sha512"].hexdigest())})
+
+	# files
+	def file_info(self, file_id):
+		with self.state.lock:
+			info = self.state.files.get(file_id)
+		if info is None:
+			return self.reply({"error": "not found"}, 404)
+		self.reply(dict(info, id=file_id))
+
+	def add_file_metadata(self, file_id):
+		self.reply({})
+
+	# geostreams
+	def find_sensors(self):
+		name = self.query.get("sensor_name")
+		with self.state.lock:
+			found = [s for s in self.state.sensors.values() if name is None or s["name"] == name]
+			if name and not found:
+				# every plot exists already, as on the production geostreams
+				sensor = {"id": len(self.state.sensors) + 1, "name": name,
+						  "geometry": {"type": "Point", "coordinates": [-111.975, 33.075, 0]}, "properties": {}}
+				self.state.sensors[sensor["id"]] = sensor
+				found = [sensor]
+		self.reply(found)
+
+	def create_sensor(self):
+		body = self.json_body()
+		with self.state.lock:
+			sensor = dict(body, id=len(self.state.sensors) + 1)
+			self.state.sensors[sensor["id"]] = sensor
+		self.reply({"id": sensor["id"]})
+
+	def find_streams(self):
+		name = self.query.get("stream_name")
+		with self.state.lock:
+			found = [s for s in self.state.streams.values() if name is None or s["name"] == name]
+		self.reply(found)
+
+	def create_stream(self):
+		body = self.json_body()
+		with self.state.lock:
+			stream = dict(body, id=len(self.state.streams) + 1)
+			self.state.streams[stream["id"]] = stream
+		self.reply({"id": stream["id"]})
+
+	def create_datapoint(self):
+		with self.state.lock:
+			self.state.datapoints += 1
+		self.reply({"id": self.state.datapoints})
+
+	def create_datapoints(self):
+		points = self.json_body().get("datapoints", [])
+		with self.state.lock:
+			self.state.datapoints += len(points)
+		self.reply({"count": len(points)})
+
+
+class FakeClowderServer(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+
+def start(port=0, latency=0.0, jitter=0.0, error_rate=0.0, seed=None, chunked_uploads=True):
+	"""Start the fake server on a daemon thread; returns (server, state, base URL ending in '/')."""
+	state = FakeClowderState(latency, jitter, error_rate, seed, chunked_uploads)
+	handler = type("Handler", (FakeClowderHandler, object), {"state": state})
+	server = FakeClowderServer(("127.0.0.1", port), handler)
+	thread = threading.Thread(target=server.serve_forever)
+	thread.daemon = True
+	thread.start()
+	return server, state, "http://127.0.0.1:%s/" % server.server_address[1]
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Fake Clowder/geostreams API for benchmarks")
+	parser.add_argument("--port", type=int, default=9000)
+	parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+	parser.add_argument("--jitter", type=float, default=0.0, help="up to this many extra random seconds")
+	parser.add_argument("--error_rate", type=float, default=0.0, help="fraction of requests answered with 503")
+	parser.add_argument("--no_chunked_uploads", action="store_true", help="answer the api/uploads calls with 404")
+	args = parser.parse_args()
+	server, state, url = start(args.port, args.latency, args.jitter, args.error_rate,
+							   chunked_uploads=not args.no_chunked_uploads)
+	print("fake Clowder listening on %s" % url)
+	try:
+		while True:
+			time.sleep(3600)
+	except KeyboardInterrupt:
+		server.shutdown()
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+
+"""Measure messages per second of the extractors against a local fake Clowder.
+
+Generates synthetic datasets (synthetic.py), then runs each extractor in its
+own process against a fresh fake Clowder/geostreams server (fake_clowder.py),
+calling check_message and process_message directly for every message, the
+way pyclowder does, without RabbitMQ. Reports throughput, p50/p99 latency per
+message and Clowder requests per message, and optionally compares them with
+the results of an earlier run:
+
+    python run_benchmarks.py --messages 200 --latency 0.02 --output baseline.json
+    python run_benchmarks.py --messages 200 --latency 0.02 --baseline baseline.json
+"""
+
+import argparse
+import copy
+import importlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+import fake_clowder
+import synthetic
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+from worker_pool import OrderedPool
+
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+# name: (directory, module, extractor class)
+EXTRACTORS = {
+	"cleaner": ("cleaner", "terra_mdcleaner", "ReCleanLemnatecMetadata"),
+	"repairer": ("repairer", "terra_repairer", "RepairLemnatecDatasets"),
+	"sensorposition": ("sensorposition", "terra_sensorposition", "Sensorposition2Geostreams"),
+	"netcdf": ("netcdf", "terra_netcdf", "NetCDFMetadataConversion")
+}
+ORDER = ["cleaner", "repairer", "sensorposition", "netcdf"]
+
+
+class BenchConnector(object):
+	"""The parts of a pyclowder connector the extractors and pyclowder helpers use."""
+
+	def __init__(self, mounted_paths):
+		self.mounted_paths = mounted_paths
+		self.ssl_verify = True
+
+	def status_update(self, *args, **kwargs):
+		pass
+
+	def message_process(self, *args, **kwargs):
+		pass
+
+
+def percentile(values, p):
+	if not values:
+		return 0.0
+	values = sorted(values)
+	return values[int(round(p * (len(values) - 1)))]
+
+
+def load_extractor(name, argv):
+	"""Import and construct an extractor as if its script had been started with argv."""
+	directory, module, cls = EXTRACTORS[name]
+	path = os.path.join(REPO, directory)
+	# pyclowder finds extractor_info.json next to the script
+	os.chdir(path)
+	sys.path.insert(0, path)
+	sys.argv = [os.path.join(path, module + ".py")] + argv
+	return getattr(importlib.import_module(module), cls)()
+
+
+def run_extractor(name, manifest, args):
+	"""Send every message of manifest to one extractor; return the measurements."""
+	server, state, host = fake_clowder.start(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+											 seed=args.seed, chunked_uploads=not args.no_chunked_uploads)
+	state.seed(manifest["seed"])
+
+	argv = []
+	if name == "sensorposition" and manifest["shapefile"]:
+		argv += ["--plot_shapefile", manifest["shapefile"], "--plot_sitename", manifest["sitename_format"]]
+	extractor = load_extractor(name, argv)
+	if not args.verbose:
+		logging.getLogger().setLevel(logging.WARNING)
+	from pyclowder.utils import CheckMessage
+
+	connector = BenchConnector(manifest["mounted_paths"])
+	messages = manifest["messages"][name][:args.messages or None]
+	latencies = []
+	outcomes = {"failed": 0, "skipped": 0}
+	lock = threading.Lock()
+
+	def handle(resource):
+		t = time.time()
+		outcome = None
+		try:
+			check = extractor.check_message(connector, host, "bench", resource, {})
+			if check in (CheckMessage.download, CheckMessage.bypass):
+				extractor.process_message(connector, host, "bench", resource, {})
+			else:
+				outcome = "skipped"
+		except Exception:
+			outcome = "failed"
+			if args.verbose:
+				traceback.print_exc()
+		with lock:
+			latencies.append(time.time() - t)
+			if outcome:
+				outcomes[outcome] += 1
+
+	state.reset()
+	start = time.time()
+	if args.workers > 1:
+		# same per-dataset ordering as the extractors' worker mode
+		pool = OrderedPool(args.workers)
+		for resource in messages:
+			pool.submit(resource.get("parent", {}).get("id", resource["id"]), handle, copy.deepcopy(resource))
+		pool.wait()
+		pool.close()
+	else:
+		for resource in messages:
+			handle(copy.deepcopy(resource))
+	if hasattr(extractor, "close_sinks"):
+		extractor.close_sinks()
+	elapsed = time.time() - start
+	stats = state.stats()
+	server.shutdown()
+
+	n = len(messages)
+	return {
+		"extractor": name,
+		"messages": n,
+		"workers": args.workers,
+		"failed": outcomes["failed"],
+		"skipped": outcomes["skipped"],
+		"seconds": elapsed,
+		"throughput": n / elapsed if elapsed else 0.0,
+		"p50": percentile(latencies, 0.50),
+		"p99": percentile(latencies, 0.99),
+		"requests": stats["total"],
+		"requests_per_message": stats["total"] / float(n) if n else 0.0,
+		"routes": stats["requests"],
+		"injected_errors": stats["errors"],
+		"datapoints": stats["datapoints"],
+		"uploaded_bytes": stats["uploaded_bytes"]
+	}
+
+
+def child_command(name, manifest_path, result_path, args):
+	cmd = [sys.executable, os.path.abspath(__file__), "--child", name, "--manifest", manifest_path,
+		   "--result", result_path, "--messages", str(args.messages), "--latency", str(args.latency),
+		   "--jitter", str(args.jitter), "--error_rate", str(args.error_rate), "--seed", str(args.seed),
+		   "--workers", str(args.workers)]
+	if args.verbose:
+		cmd.append("--verbose")
+	if args.no_chunked_uploads:
+		cmd.append("--no_chunked_uploads")
+	return cmd
+
+
+def report(results, baseline=None):
+	print("%-15s %8s %7s %9s %9s %9s %8s" % ("extractor", "messages", "failed", "msg/s", "p50 ms", "p99 ms", "req/msg"))
+	for r in results:
+		if "error" in r:
+			print("%-15s %s" % (r["extractor"], r["error"]))
+			continue
+		print("%-15s %8d %7d %9.1f %9.1f %9.1f %8.2f" % (r["extractor"], r["messages"], r["failed"], r["throughput"],
+														r["p50"] * 1000, r["p99"] * 1000, r["requests_per_message"]))
+		routes = sorted(r["routes"].items(), key=lambda i: -i[1])
+		print("  " + ", ".join("%s %.2f" % (route, count / float(r["messages"])) for route, count in routes))
+		old = (baseline or {}).get(r["extractor"])
+		if old and "error" not in old:
+			print("  vs baseline: msg/s %+.1f%%, p50 %+.1f%%, p99 %+.1f%%, req/msg %+.2f" % (
+				change(old["throughput"], r["throughput"]), change(old["p50"], r["p50"]),
+				change(old["p99"], r["p99"]), r["requests_per_message"] - old["requests_per_message"]))
+
+
+def change(old, new):
+	return (new - old) * 100.0 / old if old else 0.0
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark the extractors against a local fake Clowder")
+	parser.add_argument("--extractors", default=",".join(ORDER), help="comma-separated extractors to run")
+	parser.add_argument("--messages", type=int, default=200, help="messages sent to each extractor")
+	parser.add_argument("--bin_size", type=int, default=256 * 1024, help="size of each synthetic .bin file")
+	parser.add_argument("--latency", type=float, default=0.01, help="seconds added to every Clowder request")
+	parser.add_argument("--jitter", type=float, default=0.0, help="up to this many extra random seconds per request")
+	parser.add_argument("--error_rate", type=float, default=0.0, help="fraction of requests answered with 503")
+	parser.add_argument("--seed", type=int, default=42)
+	parser.add_argument("--workers", type=int, default=1, help="messages processed at the same time by each extractor")
+	parser.add_argument("--no_chunked_uploads", action="store_true",
+						help="fake a Clowder without chunked uploads, so the repairer streams whole files")
+	parser.add_argument("--workdir", default="", help="where synthetic data is written (default: a temporary directory)")
+	parser.add_argument("--output", default="", help="write the results to this JSON file")
+	parser.add_argument("--baseline", default="", help="compare with the results JSON of an earlier run")
+	parser.add_argument("--verbose", action="store_true", help="show extractor logs and tracebacks")
+	parser.add_argument("--child", default="", help=argparse.SUPPRESS)
+	parser.add_argument("--manifest", default="", help=argparse.SUPPRESS)
+	parser.add_argument("--result", default="", help=argparse.SUPPRESS)
+	args = parser.parse_args()
+
+	if args.child:
+		with open(args.manifest) as f:
+			manifest = json.load(f)
+		try:
+			result = run_extractor(args.child, manifest, args)
+		except Exception as e:
+			if args.verbose:
+				traceback.print_exc()
+			result = {"extractor": args.child, "error": "%s: %s" % (type(e).__name__, e)}
+		with open(args.result, "w") as f:
+			json.dump(result, f)
+		return
+
+	workdir = args.workdir or tempfile.mkdtemp(prefix="terraref-bench-")
+	try:
+		start = time.time()
+		synthetic.generate(workdir, args.messages, args.bin_size, seed=args.seed)
+		print("synthetic data for %s messages written to %s in %.1fs" % (args.messages, workdir, time.time() - start))
+
+		results = []
+		for name in args.extractors.split(","):
+			result_path = os.path.join(workdir, "result_%s.json" % name)
+			subprocess.call(child_command(name, os.path.join(workdir, "manifest.json"), result_path, args))
+			if os.path.exists(result_path):
+				with open(result_path) as f:
+					results.append(json.load(f))
+			else:
+				results.append({"extractor": name, "error": "benchmark process failed"})
+
+		baseline = None
+		if args.baseline:
+			with open(args.baseline) as f:
+				baseline = dict((r["extractor"], r) for r in json.load(f)["results"])
+		report(results, baseline)
+
+		if args.output:
+			with open(args.output, "w") as f:
+				json.dump({"settings": {"messages": args.messages, "workers": args.workers, "bin_size": args.bin_size,
+										"latency": args.latency, "jitter": args.jitter, "error_rate": args.error_rate,
+										"chunked_uploads": not args.no_chunked_uploads},
+						   "results": results}, f, indent=2)
+	finally:
+		if not args.workdir:
+			shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+	main()
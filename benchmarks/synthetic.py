@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+
+"""Synthetic LemnaTec datasets for the extractor benchmarks.
+
+Writes a site tree like the production mounts (raw_data metadata.json and .bin
+files, Level_1 outputs and netCDF files) under a work directory, a plot
+shapefile when GDAL is available, and a manifest.json holding the data to
+seed the fake Clowder with and the messages to send to each extractor.
+
+Clowder sees the tree under CLOWDER_BASE; the extractors reach it through the
+connector's mounted_paths, as they do in production.
+"""
+
+import hashlib
+import json
+import os
+import random
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "sensorposition"))
+from gantry_transform import GantryTransform, CONTROL_POINTS
+
+try:
+	import netCDF4
+except ImportError:
+	netCDF4 = None
+
+try:
+	from osgeo import ogr, osr
+except ImportError:
+	ogr = None
+
+
+CLOWDER_BASE = "/home/extractor/sites"
+SITE = "ua-mac"
+
+# plot grid of the synthetic season: ranges run north along gantry x, passes west along gantry y
+RANGES = 54
+PASSES = 16
+SITENAME_FORMAT = "MAC Field Scanner Season 2 Range {range} Pass {pass}"
+FIELD_X = (CONTROL_POINTS[0][1][0], CONTROL_POINTS[2][1][0])
+FIELD_Y = (CONTROL_POINTS[0][1][1], CONTROL_POINTS[1][1][1])
+
+# stereoTop field of view in meters
+FOV = (1.0, 0.8)
+
+
+def plot_of(x, y):
+	"""Return (range, pass) of the plot containing gantry position (x, y)."""
+	dx = (FIELD_X[1] - FIELD_X[0]) / RANGES
+	dy = (FIELD_Y[1] - FIELD_Y[0]) / PASSES
+	return (min(RANGES, int((x - FIELD_X[0]) / dx) + 1), min(PASSES, int((y - FIELD_Y[0]) / dy) + 1))
+
+
+def dataset_id(kind, i):
+	return "5a%02x%020x" % (kind, i)
+
+
+def timestamp(i):
+	day = 1 + (i // 10000) % 28
+	seconds = 6 * 3600 + (i % 10000) * 3
+	date = "2017-05-%02d" % day
+	return date, "%s__%02d-%02d-%02d-%03d" % (date, seconds // 3600, seconds // 60 % 60, seconds % 60, i % 1000)
+
+
+def write_bytes(path, size, rng):
+	with open(path, "wb") as f:
+		block = bytearray(rng.getrandbits(8) for i in range(min(size, 65536)))
+		remaining = size
+		while remaining > 0:
+			f.write(block[:remaining])
+			remaining -= len(block)
+
+
+def raw_metadata(ts, x, y):
+	date, clock = ts.split("__")
+	year, month, day = date.split("-")
+	return {"lemnatec_measurement_metadata": {
+		"user_given_data": {"season": "Season 4", "experiment": "Synthetic benchmark", "sensor": "stereoTop"},
+		"gantry_system_fixed_metadata": {"system location": "Maricopa, Arizona", "system_id": "ua-mac"},
+		"gantry_system_variable_metadata": {
+			"time": "%s/%s/%s %s" % (month, day, year, clock[:8].replace("-", ":")),
+			"position x [m]": "%.3f" % x, "position y [m]": "%.3f" % y, "position z [m]": "0.635",
+			"speed x [m/s]": "0", "speed y [m/s]": "0.33", "speed z [m/s]": "0",
+			"camera box light 1 is on": "True", "camera box light 2 is on": "True"
+		},
+		"sensor_fixed_metadata": {
+			"sensor product name": "Prosilica GT3300C", "cameras": "2",
+			"location in camera box x [m]": "0.877", "location in camera box y [m]": "2.276",
+			"field of view x [m]": "%.3f" % FOV[0], "field of view y [m]": "%.3f" % FOV[1]
+		},
+		"sensor_variable_metadata": {"rgb temperature [K]": "2800", "exposure [ms]": "0.9"}
+	}}
+
+
+def terra_metadata(ts, x, y, transform, sitename=None):
+	"""Cleaned TERRA metadata as carried by a metadata-added message to sensorposition."""
+	lat, lon = transform.to_latlon(x, y)
+	ring = transform.footprints([x], [y], FOV[0], FOV[1])[0].tolist()
+	date, clock = ts.split("__")
+	md = {
+		"gantry_variable_metadata": {
+			"datetime": "%sT%s-07:00" % (date, clock[:8].replace("-", ":")),
+			"position_m": {"x": x, "y": y, "z": 0.635}
+		},
+		"spatial_metadata": {
+			"left": {
+				"centroid": {"type": "Point", "coordinates": [float(lon), float(lat)]},
+				"bounding_box": {"type": "Polygon", "coordinates": ring}
+			}
+		}
+	}
+	if sitename:
+		md["site_metadata"] = {"sitename": sitename}
+	return md
+
+
+def write_netcdf(path, rows, rng):
+	ds = netCDF4.Dataset(path, "w", format="NETCDF4")
+	try:
+		ds.title = "Synthetic EnvironmentLogger data"
+		ds.institution = "Synthetic benchmark"
+		ds.createDimension("time", rows)
+		var = ds.createVariable("time", "f8", ("time",))
+		var.units = "days since 1970-01-01 00:00:00"
+		var[:] = [17287 + r / 86400.0 for r in range(rows)]
+		for name, units in [("air_temperature", "K"), ("relative_humidity", "1"), ("wind_speed", "m s-1"),
+							("surface_downwelling_photosynthetic_photon_flux_in_air", "umol m-2 s-1"),
+							("precipitation_rate", "mm s-1")]:
+			var = ds.createVariable(name, "f4", ("time",))
+			var.units = units
+			var.long_name = name.replace("_", " ")
+			var[:] = [rng.random() for r in range(rows)]
+	finally:
+		ds.close()
+
+
+def write_shapefile(path, transform):
+	"""Write the plot grid as a polygon shapefile with the fields read by plotid_by_latlon.
+
+	Coordinates are UTM, like the season shapefiles, when the utm package is
+	installed and WGS84 otherwise.
+	"""
+	driver = ogr.GetDriverByName("ESRI Shapefile")
+	if os.path.exists(path):
+		driver.DeleteDataSource(path)
+	srs = osr.SpatialReference()
+	if transform.utm_coef is not None:
+		srs.ImportFromEPSG(32600 + transform.utm_zone[0])
+		project = lambda x, y: transform.to_utm(x, y)
+	else:
+		srs.ImportFromEPSG(4326)
+		project = lambda x, y: transform.to_latlon(x, y)[::-1]
+	ds = driver.CreateDataSource(path)
+	lyr = ds.CreateLayer(os.path.basename(path).split(".shp")[0], srs, ogr.wkbPolygon)
+	for name, kind in [("RangePass", ogr.OFTString), ("Range", ogr.OFTInteger), ("Pass", ogr.OFTInteger),
+					   ("MAC_ENTRY", ogr.OFTInteger)]:
+		lyr.CreateField(ogr.FieldDefn(name, kind))
+	dx = (FIELD_X[1] - FIELD_X[0]) / RANGES
+	dy = (FIELD_Y[1] - FIELD_Y[0]) / PASSES
+	for r in range(RANGES):
+		for p in range(PASSES):
+			x0, y0 = FIELD_X[0] + r * dx, FIELD_Y[0] + p * dy
+			xs, ys = project([x0, x0 + dx, x0 + dx, x0, x0], [y0, y0, y0 + dy, y0 + dy, y0])
+			ring = ogr.Geometry(ogr.wkbLinearRing)
+			for px, py in zip(xs, ys):
+				ring.AddPoint_2D(float(px), float(py))
+			poly = ogr.Geometry(ogr.wkbPolygon)
+			poly.AddGeometry(ring)
+			feature = ogr.Feature(lyr.GetLayerDefn())
+			feature.SetField("RangePass", "%d-%d" % (r + 1, p + 1))
+			feature.SetField("Range", r + 1)
+			feature.SetField("Pass", p + 1)
+			feature.SetField("MAC_ENTRY", r * PASSES + p + 1)
+			feature.SetGeometry(poly)
+			lyr.CreateFeature(feature)
+	ds = None
+
+
+def generate(workdir, count=200, bin_size=256 * 1024, nc_rows=1000, missing_rate=0.1, upload_fraction=0.5,
+			 seed=42):
+	"""Write count synthetic stereoTop captures and count netCDF files under workdir; return the manifest.
+
+	missing_rate is the fraction of Level_1 outputs left off disk, so the repairer
+	finds invalid datasets; upload_fraction is the fraction of datasets whose raw
+	files the repairer has to upload. Half of those already hold the left image,
+	as after an interrupted upload.
+	"""
+	rng = random.Random(seed)
+	root = os.path.join(workdir, "sites")
+	transform = GantryTransform(model="bilinear")
+
+	shapefile = ""
+	if ogr is not None:
+		shapefile = os.path.join(workdir, "plots.shp")
+		write_shapefile(shapefile, transform)
+
+	seed_data = {"datasets": {}, "files": {}}
+	messages = {"cleaner": [], "repairer": [], "sensorposition": [], "netcdf": []}
+
+	def add_file(ds_id, file_id, local_path):
+		info = {"filename": os.path.basename(local_path), "filepath": local_path.replace(root, CLOWDER_BASE, 1),
+				"size": 0}
+		if os.path.exists(local_path):
+			with open(local_path, "rb") as f:
+				data = f.read()
+			info.update(size=len(data), sha512=hashlib.sha512(data).hexdigest())
+		seed_data["datasets"][ds_id]["files"].append(file_id)
+		seed_data["files"][file_id] = info
+		return {"id": file_id, "filename": info["filename"]}
+
+	for i in range(count):
+		date, ts = timestamp(i)
+		x = rng.uniform(FIELD_X[0] + 0.5, FIELD_X[1] - 0.5)
+		y = rng.uniform(FIELD_Y[0] + 0.5, FIELD_Y[1] - 0.5)
+		ds_id = dataset_id(1, i)
+		name = "stereoTop - %s" % ts
+		seed_data["datasets"][ds_id] = {"name": name, "files": [], "metadata": []}
+
+		raw_dir = os.path.join(root, SITE, "raw_data", "stereoTop", date, ts)
+		os.makedirs(raw_dir)
+		prefix = "%08x-%04x" % (rng.getrandbits(32), i % 65536)
+		with open(os.path.join(raw_dir, prefix + "_metadata.json"), "w") as f:
+			json.dump(raw_metadata(ts, x, y), f)
+		raw_files = []
+		for side in ("left", "right"):
+			path = os.path.join(raw_dir, "%s_%s.bin" % (prefix, side))
+			write_bytes(path, bin_size, rng)
+			raw_files.append(path)
+
+		# Level_1 outputs recorded in the bin2tif metadata, some of them missing on disk; like bin2tif,
+		# they go to a Level_1 dataset of their own rather than the raw dataset
+		out_dir = os.path.join(root, SITE, "Level_1", "rgb_geotiff", date, ts)
+		os.makedirs(out_dir)
+		out_ds = dataset_id(6, i)
+		seed_data["datasets"][out_ds] = {"name": "RGB GeoTIFFs - %s" % ts, "files": [], "metadata": []}
+		created = []
+		for j, side in enumerate(("left", "right")):
+			path = os.path.join(out_dir, "rgb_geotiff_L1_%s_%s_%s.tif" % (SITE, ts, side))
+			if rng.random() >= missing_rate:
+				write_bytes(path, 4096, rng)
+			file_id = dataset_id(2, i * 2 + j)
+			add_file(out_ds, file_id, path)
+			created.append("https://terraref.ncsa.illinois.edu/clowder/files/%s" % file_id)
+		seed_data["datasets"][ds_id]["metadata"].append({
+			"agent": {"@type": "cat:extractor",
+					  "extractor_id": "https://terraref.ncsa.illinois.edu/clowder/api/extractors/terra.stereo-rgb.bin2tif"},
+			"content": {"files_created": created}
+		})
+
+		files = []
+		if rng.random() >= upload_fraction:
+			files = [add_file(ds_id, dataset_id(3, i * 2 + j), path) for j, path in enumerate(raw_files)]
+		elif i % 2 == 0:
+			# an upload interrupted after the left image: only that one is in Clowder already
+			files = [add_file(ds_id, dataset_id(3, i * 2), raw_files[0])]
+
+		# without a shapefile every dataset needs site_metadata, to avoid the remote plot lookup
+		sitename = None
+		if not shapefile or i % 2 == 0:
+			r, p = plot_of(x, y)
+			sitename = SITENAME_FORMAT.format(**{"range": r, "pass": p})
+
+		messages["cleaner"].append({"type": "dataset", "id": ds_id, "name": name})
+		messages["repairer"].append({"type": "dataset", "id": ds_id, "name": name, "files": files})
+		messages["sensorposition"].append({"type": "dataset", "id": ds_id, "name": name,
+										   "metadata": terra_metadata(ts, x, y, transform, sitename)})
+
+		if netCDF4 is not None:
+			nc_dir = os.path.join(root, SITE, "Level_1", "envlog_netcdf", date)
+			if not os.path.isdir(nc_dir):
+				os.makedirs(nc_dir)
+			nc_name = "envlog_netcdf_L1_%s_%s.nc" % (SITE, ts)
+			nc_path = os.path.join(nc_dir, nc_name)
+			write_netcdf(nc_path, nc_rows, rng)
+			nc_ds = dataset_id(4, i)
+			seed_data["datasets"][nc_ds] = {"name": "EnvironmentLogger netCDFs - %s" % date, "files": [], "metadata": []}
+			nc_id = dataset_id(5, i)
+			add_file(nc_ds, nc_id, nc_path)
+			messages["netcdf"].append({"type": "file", "id": nc_id, "name": nc_name, "local_paths": [nc_path],
+									   "parent": {"type": "dataset", "id": nc_ds}})
+
+	manifest = {
+		"root": root,
+		"mounted_paths": {CLOWDER_BASE: root},
+		"shapefile": shapefile,
+		"sitename_format": SITENAME_FORMAT,
+		"seed": seed_data,
+		"messages": messages
+	}
+	with open(os.path.join(workdir, "manifest.json"), "w") as f:
+		json.dump(manifest, f)
+	return manifest
+
+
+if __name__ == "__main__":
+	if len(sys.argv) < 2:
+		print("usage: python synthetic.py workdir [count] [bin_size]")
+		sys.exit(1)
+	manifest = generate(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 200,
+						int(sys.argv[3]) if len(sys.argv) > 3 else 256 * 1024)
+	print("%s messages per extractor written to %s" % (
+		dict((k, len(v)) for k, v in manifest["messages"].items()), os.path.join(sys.argv[1], "manifest.json")))
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+
+"""Helpers for re-cleaning every dataset of a sensor over a date range without RabbitMQ messages."""
+
+import datetime
+import logging
+import os
+import re
+
+
+TIMESTAMP_DIR = re.compile(r'^\d{4}-\d{2}-\d{2}__\d{2}-\d{2}-\d{2}-\d{3}$')
+
+
+def date_range(start_date, end_date):
+	"""Yield YYYY-MM-DD strings from start_date to end_date, inclusive."""
+	day = datetime.datetime.strptime(start_date, "%Y-%m-%d")
+	last = datetime.datetime.strptime(end_date, "%Y-%m-%d")
+	while day <= last:
+		yield day.strftime("%Y-%m-%d")
+		day += datetime.timedelta(days=1)
+
+
+def find_dataset_names(sensors, sensor_type, start_date, end_date, remap=None):
+	"""Yield "<sensor_type> - <timestamp>" for each timestamp directory of sensor_type in the date range.
+
+	The date directories are located with sensors.get_sensor_path_by_dataset, so the
+	same site layout is used as when a single dataset is cleaned.
+	"""
+	for day in date_range(start_date, end_date):
+		probe = sensors.get_sensor_path_by_dataset("%s - %s__00-00-00-000" % (sensor_type, day))
+		day_dir = os.path.dirname(os.path.dirname(probe))
+		if remap:
+			day_dir = remap(day_dir)
+		if not os.path.isdir(day_dir):
+			continue
+		for ts in sorted(os.listdir(day_dir)):
+			if TIMESTAMP_DIR.match(ts) and os.path.isdir(os.path.join(day_dir, ts)):
+				yield "%s - %s" % (sensor_type, ts)
+
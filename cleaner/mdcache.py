@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+import copy
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+try:
+	import pkg_resources
+	TERRAUTILS_VERSION = pkg_resources.get_distribution('terrautils').version
+except Exception:
+	TERRAUTILS_VERSION = "unknown"
+
+
+class CleanedMetadataCache(object):
+	"""LRU cache of cleaned LemnaTec metadata, bounded by the size of the source files.
+
+	Entries are keyed by (metadata.json content hash, sensor, terrautils version), so
+	re-cleaning an unchanged file, or the same raw file for several derived datasets,
+	skips both parsing and clean_metadata. Content hashes are remembered per path
+	and file mtime/size, so an unchanged file isn't even read again; they are
+	dropped with the last entry of their content. Callers get their own copy of
+	the cleaned metadata and may change it.
+	"""
+
+	def __init__(self, max_bytes=256 * 1024 * 1024):
+		self.max_bytes = max_bytes
+		self.entries = OrderedDict()
+		self.total_bytes = 0
+		# path -> (mtime, size, content hash), and content hash -> (paths, number of entries)
+		self.hashes = {}
+		self.contents = {}
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def _content_hash(self, md_file):
+		"""Return (content hash, stat key, file contents or None if the hash was known)."""
+		st = os.stat(md_file)
+		stat_key = (st.st_mtime, st.st_size)
+		with self.lock:
+			known = self.hashes.get(md_file)
+		if known and known[:2] == stat_key:
+			return known[2], stat_key, None
+		with open(md_file, 'rb') as f:
+			data = f.read()
+		return hashlib.sha1(data).hexdigest(), stat_key, data
+
+	def _remember(self, md_file, stat_key, digest):
+		"""Record the content hash of md_file; only called for content with an entry."""
+		known = self.hashes.get(md_file)
+		if known and known[2] != digest and known[2] in self.contents:
+			self.contents[known[2]][0].discard(md_file)
+		self.hashes[md_file] = stat_key + (digest,)
+		self.contents[digest][0].add(md_file)
+
+	def get_or_clean(self, md_file, sensor, clean):
+		"""Return clean(parsed md_file, sensor), from the cache if the same content was cleaned before."""
+		digest, stat_key, data = self._content_hash(md_file)
+		key = (digest, sensor, TERRAUTILS_VERSION)
+		with self.lock:
+			entry = self.entries.pop(key, None)
+			if entry is not None:
+				self.entries[key] = entry
+				self.hits += 1
+				self._remember(md_file, stat_key, digest)
+				return copy.deepcopy(entry[0])
+			self.misses += 1
+
+		if data is None:
+			with open(md_file, 'rb') as f:
+				data = f.read()
+		cleaned = clean(json.loads(data.decode('utf-8')), sensor)
+
+		with self.lock:
+			if key not in self.entries:
+				self.entries[key] = (copy.deepcopy(cleaned), len(data))
+				self.total_bytes += len(data)
+				self.contents.setdefault(digest, [set(), 0])[1] += 1
+			self._remember(md_file, stat_key, digest)
+			while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+				old_key, (old, size) = self.entries.popitem(last=False)
+				self.total_bytes -= size
+				self.evictions += 1
+				self._forget(old_key[0])
+		return cleaned
+
+	def _forget(self, digest):
+		"""Drop the content hashes of the paths holding digest once no entry has it."""
+		paths = self.contents[digest]
+		paths[1] -= 1
+		if paths[1] == 0:
+			for path in paths[0]:
+				if self.hashes.get(path, (None, None, None))[2] == digest:
+					del self.hashes[path]
+			del self.contents[digest]
+
+	def summary(self):
+		return "cleaned metadata cache: %s hits, %s misses, %s evictions, %s entries (%.1f MB)" % (
+			self.hits, self.misses, self.evictions, len(self.entries), self.total_bytes / 1048576.0)
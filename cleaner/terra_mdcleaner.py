@@ -1,13 +1,38 @@
 #!/usr/bin/env python
 
 import os
+import sys
+import json
 import logging
+import multiprocessing
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 
 from pyclowder.utils import CheckMessage
-from pyclowder.datasets import upload_metadata, submit_extraction, download_metadata, remove_metadata
 from terrautils.extractors import TerrarefExtractor, delete_dataset_metadata, load_json_file
 from terrautils.metadata import clean_metadata, get_terraref_metadata
 
+# modules shared between extractors live in ../common in a repository checkout
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+from dirindex import DirectoryIndex
+from mdcache import CleanedMetadataCache
+from bulk_clean import find_dataset_names
+from checkpoint import Checkpoint
+from clowder_client import ClowderClient, get_client
+from pathremap import remap_mount_path
+from worker_pool import run_workers, PerThreadStats
+import metrics
+
+delete_dataset_metadata = metrics.timed(delete_dataset_metadata)
+
+# These datasets do not have TERRA md
+UNCLEANABLES = ["Full Field"]
+
+# For these datasets, we must get TERRA md from raw_data source
+LV1_TYPES = {"RGB GeoTIFFs": "stereoTop",
+			 "Thermal IR GeoTIFFs": "flirIrCamera"}
+
 
 def add_local_arguments(parser):
 	# add any additional arguments to parser
@@ -17,8 +42,40 @@ def add_local_arguments(parser):
 						help="user ID to use as creator of metadata")
 	parser.add_argument('--callback', default=os.getenv('CALLBACK_EXTRACTOR', ""),
 						help="user ID to use as creator of metadata")
+	parser.add_argument('--dirindex', default=os.getenv('DIRECTORY_INDEX', ""),
+						help="SQLite directory index used to find metadata.json without listing directories")
+	parser.add_argument('--metrics_port', type=int, default=os.getenv('METRICS_PORT', 0),
+						help="port serving Prometheus metrics on /metrics (0 = off)")
+	parser.add_argument('--workers', type=int, default=os.getenv('EXTRACTOR_WORKERS', 1),
+						help="number of messages processed at the same time (1 = pyclowder's one at a time)")
+	parser.add_argument('--prefetch', type=int, default=os.getenv('EXTRACTOR_PREFETCH', 0),
+						help="number of messages fetched ahead when workers > 1 (default: 2 x workers)")
+	parser.add_argument('--md_cache_mb', type=int, default=os.getenv('CLEANED_METADATA_CACHE_MB', 256),
+						help="size of the cleaned metadata cache, in MB of source metadata.json files")
 
-class ReCleanLemnatecMetadata(TerrarefExtractor):
+	# bulk mode: re-clean a sensor over a date range instead of listening for messages
+	parser.add_argument('--bulk_sensor', default="",
+						help="dataset sensor name to re-clean in bulk mode, e.g. stereoTop or 'RGB GeoTIFFs'")
+	parser.add_argument('--bulk_start', default="", help="first YYYY-MM-DD date to re-clean in bulk mode")
+	parser.add_argument('--bulk_end', default="", help="last YYYY-MM-DD date to re-clean in bulk mode (default: bulk_start)")
+	parser.add_argument('--bulk_processes', type=int, default=multiprocessing.cpu_count(),
+						help="number of datasets cleaned in parallel in bulk mode")
+	parser.add_argument('--bulk_checkpoint', default="",
+						help="progress file used to resume bulk mode (default: .terra_mdcleaner_<sensor>_checkpoint)")
+	parser.add_argument('--http_threads', type=int, default=os.getenv('CLOWDER_HTTP_THREADS', 8),
+						help="number of Clowder requests in flight at once")
+	parser.add_argument('--callback_batch', type=int, default=100,
+						help="number of callback extractions submitted before pausing in bulk mode")
+	parser.add_argument('--callback_delay', type=float, default=0,
+						help="seconds to wait between batches of callback extractions in bulk mode")
+	parser.add_argument('--dry_run', action='store_true',
+						help="in bulk mode, find and clean metadata but don't change anything in Clowder")
+	parser.add_argument('--clowder_host', default=os.getenv('CLOWDER_HOST', ""),
+						help="Clowder URL used in bulk mode")
+	parser.add_argument('--clowder_key', default=os.getenv('CLOWDER_KEY', ""),
+						help="Clowder key used in bulk mode")
+
+class ReCleanLemnatecMetadata(PerThreadStats, TerrarefExtractor):
 	def __init__(self):
 		super(ReCleanLemnatecMetadata, self).__init__()
 
@@ -31,6 +88,11 @@ class ReCleanLemnatecMetadata(TerrarefExtractor):
 		self.delete = self.args.delete
 		self.userid = self.args.userid
 		self.callback = self.args.callback
+		self.dirindex = DirectoryIndex(self.args.dirindex) if self.args.dirindex else None
+		self.md_cache = CleanedMetadataCache(int(self.args.md_cache_mb) * 1024 * 1024)
+		self.http_threads = int(self.args.http_threads)
+		if self.args.metrics_port:
+			metrics.start_exporter(self.args.metrics_port, self.extractor_info['name'])
 
 	# Check whether dataset has geospatial metadata
 	def check_message(self, connector, host, secret_key, resource, parameters):
@@ -39,72 +101,44 @@ class ReCleanLemnatecMetadata(TerrarefExtractor):
 	# Process the file and upload the results
 	def process_message(self, connector, host, secret_key, resource, parameters):
 		self.start_message(resource)
+		metrics.start_message()
 
 		sensor_type, timestamp = resource['name'].split(" - ")
 
 		# These datasets do not have TERRA md
-		uncleanables = ["Full Field"]
-		if sensor_type in uncleanables:
+		if sensor_type in UNCLEANABLES:
 			self.log_info(resource, "Cannot clean metadata for %s" % sensor_type)
 			return
 
-		# For these datasets, we must get TERRA md from raw_data source
-		lv1_types = {"RGB GeoTIFFs": "stereoTop",
-					 "Thermal IR GeoTIFFs": "flirIrCamera"}
-		if sensor_type in lv1_types:
-			raw_equiv = resource['name'].replace(sensor_type, lv1_types[sensor_type])
-			raw_sensor = lv1_types[sensor_type]
-			source_dir = os.path.dirname(self.sensors.get_sensor_path_by_dataset(raw_equiv))
-		else:
-			# Search for metadata.json source file
-			raw_sensor = sensor_type
-			source_dir = os.path.dirname(self.sensors.get_sensor_path_by_dataset(resource['name']))
-		source_dir = self.remapMountPath(connector, source_dir)
+		raw_sensor, source_dir = self.get_source_dir(connector, resource['name'])
 
 		if self.delete:
 			# Delete all existing metadata from this dataset
 			self.log_info(resource, "Deleting existing metadata")
 			delete_dataset_metadata(host, self.clowder_user, self.clowder_pass, resource['id'])
 
-		# TODO: split between the PLY files (in Level_1) and metadata.json files - unique to this sensor
-		if sensor_type == "scanner3DTop":
-			source_dir = source_dir.replace("Level_1", "raw_data").replace("laser3d_las", "scanner3DTop")
-
 		self.log_info(resource, "Searching for metadata.json in %s" % source_dir)
 		if os.path.isdir(source_dir):
-			md_file = None
-			for f in os.listdir(source_dir):
-				if f.endswith("metadata.json"):
-					md_file = os.path.join(source_dir, f)
+			md_file = self.find_metadata_file(source_dir)
 			if md_file:
 				self.log_info(resource, "Found metadata.json; cleaning")
-				md_json = clean_metadata(load_json_file(md_file), raw_sensor)
-				format_md = {
-					"@context": ["https://clowder.ncsa.illinois.edu/contexts/metadata.jsonld",
-								 {"@vocab": "https://terraref.ncsa.illinois.edu/metadata/uamac#"}],
-					"content": md_json,
-					"agent": {
-						"@type": "cat:user",
-						"user_id": "https://terraref.ncsa.illinois.edu/clowder/api/users/%s" % self.userid
-					}
-				}
+				with metrics.timer("clean_metadata"):
+					md_json = self.md_cache.get_or_clean(md_file, raw_sensor, clean_metadata)
+				self.log_info(resource, self.md_cache.summary())
+				format_md = self.format_metadata(md_json)
 				self.log_info(resource, "Uploading cleaned metadata")
+				client = get_client(host, secret_key, self.http_threads, getattr(connector, 'ssl_verify', True))
 				# TODO: Can we remove all metadata here? Does username work?
-				remove_metadata(connector, host, secret_key, resource['id'], 'Maricopa Site')
-				upload_metadata(connector, host, secret_key, resource['id'], format_md)
+				client.remove_metadata(resource['id'], 'Maricopa Site')
+				client.upload_metadata(resource['id'], format_md)
 
 				# Now trigger a callback extraction if given
-				if len(self.callback) > 0:
-					self.log_info(resource, "Submitting callback extraction to %s" % self.callback)
-					submit_extraction(connector, host, secret_key, resource['id'], self.callback)
+				callbacks = self.get_callbacks(sensor_type)
+				if callbacks:
+					self.log_info(resource, "Submitting callback extractions to %s" % ", ".join(callbacks))
+					client.submit_extractions(resource['id'], callbacks)
 				else:
-					callbacks = self.get_callbacks_by_sensor(sensor_type)
-					if callbacks:
-						for c in callbacks:
-							self.log_info(resource, "Submitting callback extraction to %s" % c)
-							submit_extraction(connector, host, secret_key, resource['id'], c)
-					else:
-						self.log_info(resource, "No default callback found for %s" % sensor_type)
+					self.log_info(resource, "No default callback found for %s" % sensor_type)
 			else:
 				self.log_error(resource, "metadata.json not found in %s" % source_dir)
 
@@ -113,16 +147,64 @@ class ReCleanLemnatecMetadata(TerrarefExtractor):
 
 		# TODO: Have extractor check for existence of Level_1 output product and delete if exists?
 
+		self.log_info(resource, metrics.message_summary())
 		self.end_message(resource)
 
-	def remapMountPath(self, connector, path):
-		if len(connector.mounted_paths) > 0:
-			for source_path in connector.mounted_paths:
-				if path.startswith(source_path):
-					return path.replace(source_path, connector.mounted_paths[source_path])
-			return path
+	def get_source_dir(self, connector, dataset_name):
+		"""Return (raw sensor, directory holding the source metadata.json) for a dataset name."""
+		sensor_type = dataset_name.split(" - ")[0]
+
+		# For these datasets, we must get TERRA md from raw_data source
+		if sensor_type in LV1_TYPES:
+			raw_equiv = dataset_name.replace(sensor_type, LV1_TYPES[sensor_type])
+			raw_sensor = LV1_TYPES[sensor_type]
+			source_dir = os.path.dirname(self.sensors.get_sensor_path_by_dataset(raw_equiv))
 		else:
-			return path
+			# Search for metadata.json source file
+			raw_sensor = sensor_type
+			source_dir = os.path.dirname(self.sensors.get_sensor_path_by_dataset(dataset_name))
+		source_dir = self.remapMountPath(connector, source_dir)
+
+		# TODO: split between the PLY files (in Level_1) and metadata.json files - unique to this sensor
+		if sensor_type == "scanner3DTop":
+			source_dir = source_dir.replace("Level_1", "raw_data").replace("laser3d_las", "scanner3DTop")
+
+		return (raw_sensor, source_dir)
+
+	def find_metadata_file(self, source_dir):
+		"""Return the path of the metadata.json file in source_dir, or None."""
+		with metrics.timer("find_metadata"):
+			return self._find_metadata_file(source_dir)
+
+	def _find_metadata_file(self, source_dir):
+		if self.dirindex:
+			return self.dirindex.find_metadata(source_dir)
+		md_file = None
+		for f in os.listdir(source_dir):
+			if f.endswith("metadata.json"):
+				md_file = os.path.join(source_dir, f)
+		return md_file
+
+	def format_metadata(self, md_json):
+		"""Wrap cleaned metadata in the JSON-LD document uploaded to Clowder."""
+		return {
+			"@context": ["https://clowder.ncsa.illinois.edu/contexts/metadata.jsonld",
+						 {"@vocab": "https://terraref.ncsa.illinois.edu/metadata/uamac#"}],
+			"content": md_json,
+			"agent": {
+				"@type": "cat:user",
+				"user_id": "https://terraref.ncsa.illinois.edu/clowder/api/users/%s" % self.userid
+			}
+		}
+
+	def get_callbacks(self, sensor_type):
+		"""Return the --callback extractor if given, otherwise the standard ones for the sensor."""
+		if len(self.callback) > 0:
+			return [self.callback]
+		return self.get_callbacks_by_sensor(sensor_type)
+
+	def remapMountPath(self, connector, path):
+		return remap_mount_path(connector, path)
 
 	def get_callbacks_by_sensor(self, sensor_type):
 		"""Return list of standard extractors to trigger based on input sensor."""
@@ -139,6 +221,153 @@ class ReCleanLemnatecMetadata(TerrarefExtractor):
 		else:
 			return None
 
+	def run_bulk(self):
+		"""Re-clean every --bulk_sensor dataset in the date range: clean in a process pool, upload over a thread pool."""
+		args = self.args
+		sensor_type = args.bulk_sensor
+		if sensor_type in UNCLEANABLES:
+			logging.error("bulk: cannot clean metadata for %s" % sensor_type)
+			return
+
+		mounts = BulkMounts(args.mounted_paths)
+		checkpoint = Checkpoint(args.bulk_checkpoint or ".terra_mdcleaner_%s_checkpoint" % sensor_type.replace(" ", "_"))
+		names = list(find_dataset_names(self.sensors, sensor_type, args.bulk_start, args.bulk_end or args.bulk_start,
+										lambda path: self.remapMountPath(mounts, path)))
+		todo = [n for n in names if not checkpoint.is_done('uploaded', n)]
+		logging.info("bulk: %s %s datasets found, %s already re-cleaned%s" % (
+			len(names), sensor_type, len(names) - len(todo), " (dry run)" if args.dry_run else ""))
+
+		client = None if args.dry_run else ClowderClient(args.clowder_host, args.clowder_key, args.http_threads)
+		counts = {"cleaned": 0, "uploaded": 0, "failed": 0}
+		counts_lock = threading.Lock()
+
+		def count(key):
+			with counts_lock:
+				counts[key] += 1
+
+		# bound the cleaned documents waiting for an upload thread
+		slots = threading.BoundedSemaphore(max(1, args.http_threads) * 4)
+
+		def upload(name, md_json):
+			try:
+				dataset_id = client.get_dataset_id(name)
+				if not dataset_id:
+					logging.error('bulk: no Clowder dataset named "%s"' % name)
+					count("failed")
+					return
+				if self.delete:
+					delete_dataset_metadata(client.host, self.clowder_user, self.clowder_pass, dataset_id)
+				client.remove_metadata(dataset_id, 'Maricopa Site')
+				client.upload_metadata(dataset_id, self.format_metadata(md_json))
+				checkpoint.mark('uploaded', name)
+				count("uploaded")
+			except Exception as e:
+				logging.error('bulk: uploading metadata for "%s" failed: %s' % (name, str(e)))
+				count("failed")
+			finally:
+				slots.release()
+
+		global _bulk_extractor
+		_bulk_extractor = self
+		self.bulk_mounts = mounts
+		start = time.time()
+		pool = multiprocessing.Pool(max(1, args.bulk_processes), _bulk_init)
+		threads = ThreadPool(max(1, args.http_threads))
+		try:
+			for name, md_json, error in pool.imap_unordered(_bulk_clean, todo, chunksize=8):
+				if md_json is None:
+					logging.error('bulk: "%s": %s' % (name, error))
+					count("failed")
+					continue
+				count("cleaned")
+				if args.dry_run:
+					logging.info('bulk: would upload cleaned metadata to "%s"' % name)
+					continue
+				slots.acquire()
+				threads.apply_async(upload, (name, md_json))
+				if counts["cleaned"] % 1000 == 0:
+					logging.info("bulk: %s datasets cleaned (%.1f datasets/sec)" % (
+						counts["cleaned"], counts["cleaned"] / (time.time() - start)))
+		finally:
+			pool.close()
+			pool.join()
+			threads.close()
+			threads.join()
+		elapsed = time.time() - start
+		logging.info("bulk: cleaned %s and uploaded %s datasets (%s failed) in %.1fs" % (
+			counts["cleaned"], counts["uploaded"], counts["failed"], elapsed))
+
+		callbacks = self.get_callbacks(sensor_type) or []
+		pending = [n for n in names if checkpoint.is_done('uploaded', n) and not checkpoint.is_done('callback', n)]
+		submitted = 0
+		if callbacks and args.dry_run:
+			logging.info("bulk: would submit %s datasets to %s" % (counts["cleaned"], ", ".join(callbacks)))
+		elif callbacks and pending:
+			def submit(name):
+				try:
+					for c in callbacks:
+						client.submit_extraction(client.get_dataset_id(name), c)
+					checkpoint.mark('callback', name)
+					return True
+				except Exception as e:
+					logging.error('bulk: submitting "%s" to %s failed: %s' % (name, ", ".join(callbacks), str(e)))
+					return False
+
+			batch_size = max(1, args.callback_batch)
+			threads = ThreadPool(max(1, args.http_threads))
+			try:
+				for i in range(0, len(pending), batch_size):
+					if i > 0 and args.callback_delay:
+						time.sleep(args.callback_delay)
+					submitted += sum(1 for ok in threads.map(submit, pending[i:i + batch_size]) if ok)
+			finally:
+				threads.close()
+				threads.join()
+			logging.info("bulk: submitted %s of %s datasets to %s" % (submitted, len(pending), ", ".join(callbacks)))
+
+		checkpoint.close()
+		elapsed = time.time() - start
+		logging.info("bulk: %s datasets in %.1fs, %.1f datasets/sec, %s Clowder requests" % (
+			counts["cleaned"], elapsed, counts["cleaned"] / elapsed if elapsed else 0,
+			client.requests if client else 0))
+		if client:
+			client.close()
+
+
+class BulkMounts(object):
+	"""Stands in for the connector's mounted_paths when bulk mode runs without RabbitMQ."""
+	def __init__(self, mounted_paths):
+		if not isinstance(mounted_paths, dict):
+			mounted_paths = json.loads(mounted_paths or "{}")
+		self.mounted_paths = mounted_paths
+
+
+# set before the bulk pool forks so workers can reach the configured extractor
+_bulk_extractor = None
+
+def _bulk_init():
+	# SQLite connections can't be shared across a fork
+	if _bulk_extractor.dirindex:
+		_bulk_extractor.dirindex = DirectoryIndex(_bulk_extractor.dirindex.db_path)
+
+def _bulk_clean(name):
+	"""Return (dataset name, cleaned metadata or None, error message)."""
+	try:
+		raw_sensor, source_dir = _bulk_extractor.get_source_dir(_bulk_extractor.bulk_mounts, name)
+		if not os.path.isdir(source_dir):
+			return (name, None, "%s could not be found" % source_dir)
+		md_file = _bulk_extractor.find_metadata_file(source_dir)
+		if not md_file:
+			return (name, None, "metadata.json not found in %s" % source_dir)
+		return (name, _bulk_extractor.md_cache.get_or_clean(md_file, raw_sensor, clean_metadata), None)
+	except Exception as e:
+		return (name, None, str(e))
+
 if __name__ == "__main__":
 	extractor = ReCleanLemnatecMetadata()
-	extractor.start()
+	if extractor.args.bulk_sensor:
+		extractor.run_bulk()
+	elif extractor.args.workers > 1:
+		run_workers(extractor, extractor.args.workers, extractor.args.prefetch)
+	else:
+		extractor.start()
@@ -0,0 +1,66 @@
+# bench_pathremap.py: compare the old linear remapMountPath against MountPathRemapper
+# Usage: python bench_pathremap.py [num_mounts] [num_paths] [num_distinct]
+# Paths are drawn from num_distinct files spread over the mounted trees, so
+# num_distinct below num_paths shows the effect of the LRU cache.
+import random
+import sys
+import time
+
+from pathremap import MountPathRemapper
+
+
+def linear_remap(mounted_paths, path):
+	# the per-extractor implementation this module replaced
+	if len(mounted_paths) > 0:
+		for source_path in mounted_paths:
+			if path.startswith(source_path):
+				return path.replace(source_path, mounted_paths[source_path])
+		return path
+	else:
+		return path
+
+
+def make_mounts(n):
+	mounts = {}
+	for i in range(n):
+		mounts["/home/clowder/site%04d/ua-mac" % i] = "/sites/site%04d" % i
+	return mounts
+
+
+def make_paths(mounts, n, distinct, rng):
+	sources = sorted(mounts)
+	files = []
+	for i in range(distinct):
+		files.append("%s/raw_data/stereoTop/2017-05-%02d/2017-05-%02d__10-%02d-00-000/%06d_left.bin" % (
+			rng.choice(sources), i % 28 + 1, i % 28 + 1, i % 60, i))
+	return [rng.choice(files) for i in range(n)]
+
+
+def timed(label, func, n):
+	start = time.time()
+	result = func()
+	elapsed = time.time() - start
+	print("%-22s %d paths in %.3fs (%.0f paths/s)" % (label, n, elapsed, n / elapsed if elapsed else 0))
+	return result, elapsed
+
+
+if __name__ == '__main__':
+	num_mounts = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+	num_paths = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+	num_distinct = int(sys.argv[3]) if len(sys.argv) > 3 else num_paths // 10
+
+	rng = random.Random(42)
+	mounts = make_mounts(num_mounts)
+	paths = make_paths(mounts, num_paths, num_distinct, rng)
+	print("%d mounts, %d paths, %d distinct" % (num_mounts, num_paths, num_distinct))
+
+	start = time.time()
+	remapper = MountPathRemapper(mounts, cache_size=max(num_distinct, 1))
+	print("%-22s %.3fs" % ("compile mount table:", time.time() - start))
+
+	linear, linear_t = timed("linear remapMountPath:", lambda: [linear_remap(mounts, p) for p in paths], num_paths)
+	single, single_t = timed("remap() with LRU:", lambda: [remapper.remap(p) for p in paths], num_paths)
+	batch, batch_t = timed("remap_many():", lambda: remapper.remap_many(paths), num_paths)
+	print(remapper.summary())
+	print("speedup: remap() %.1fx, remap_many() %.1fx" % (linear_t / single_t, linear_t / batch_t))
+	print("mismatched paths: %d" % sum(1 for a, b, c in zip(linear, single, batch) if not a == b == c))
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+
+"""Progress file for batch runs over many files or datasets, so an interrupted run can resume."""
+
+import os
+import threading
+
+
+class Checkpoint(object):
+	"""Append-only record of the items (file paths, dataset names) finished in each stage."""
+
+	def __init__(self, path):
+		self.path = path
+		self.lock = threading.Lock()
+		self.done = {}
+		if os.path.isfile(path):
+			with open(path, 'r') as f:
+				for line in f:
+					stage, sep, item = line.rstrip('\n').partition('\t')
+					if sep:
+						self.done.setdefault(stage, set()).add(item)
+		self.out = open(path, 'a')
+
+	def is_done(self, stage, item):
+		return item in self.done.get(stage, ())
+
+	def mark(self, stage, item):
+		with self.lock:
+			self.done.setdefault(stage, set()).add(item)
+			self.out.write("%s\t%s\n" % (stage, item))
+			self.out.flush()
+
+	def close(self):
+		self.out.close()
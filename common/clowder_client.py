@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+"""Concurrent Clowder client shared by the extractors.
+
+One pooled requests session per Clowder host and key, a thread pool to run
+independent calls at the same time, retries with exponential backoff on
+connection errors and 5xx responses of idempotent calls, and a limit on the
+requests in flight per host. The dataset and file calls use the same endpoints as pyclowder.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.exceptions import NewConnectionError
+
+import metrics
+
+try:
+	from urllib.parse import urlparse
+except ImportError:
+	from urlparse import urlparse
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+_host_limits = {}
+_host_limits_lock = threading.Lock()
+
+# methods a repeated request can't apply twice
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+
+
+def get_client(host, secret_key, max_per_host=8, verify=True):
+	"""Return the shared ClowderClient for host and key, creating it on first use."""
+	key = (host, secret_key)
+	with _clients_lock:
+		client = _clients.get(key)
+		if client is None:
+			client = ClowderClient(host, secret_key, max_per_host, verify=verify)
+			_clients[key] = client
+		return client
+
+
+def not_sent(error):
+	"""True if a ConnectionError happened while connecting, before any of the request was sent."""
+	if isinstance(error, requests.exceptions.ConnectTimeout):
+		return True
+	reason = error.args[0] if error.args else None
+	return isinstance(getattr(reason, 'reason', reason), NewConnectionError)
+
+
+def _host_limit(host, max_per_host):
+	"""Semaphore bounding the requests in flight to one host, across all clients."""
+	netloc = urlparse(host).netloc
+	with _host_limits_lock:
+		sem = _host_limits.get(netloc)
+		if sem is None:
+			sem = threading.BoundedSemaphore(max_per_host)
+			_host_limits[netloc] = sem
+		return sem
+
+
+class ClowderClient(object):
+	"""Clowder API calls over a persistent connection pool, with helpers to run them concurrently."""
+
+	def __init__(self, host, secret_key, max_per_host=8, retries=3, backoff=0.5, verify=True):
+		self.host = host + ("" if host.endswith("/") else "/")
+		self.secret_key = secret_key
+		self.retries = retries
+		self.backoff = backoff
+		self.verify = verify
+		self.limit = _host_limit(self.host, max(1, max_per_host))
+		self.session = requests.Session()
+		adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, max_per_host))
+		self.session.mount('http://', adapter)
+		self.session.mount('https://', adapter)
+		self.pool = ThreadPool(max(1, max_per_host))
+		self.datasets = {}
+		self.lock = threading.Lock()
+		self.requests = 0
+		self.retried = 0
+
+	def request(self, method, path, stage="clowder_request", retries=None, **kwargs):
+		"""Send method to api/<path>, retrying connection errors and 5xx responses. Raises on failure.
+
+		Only idempotent methods are retried by default: a POST that failed with a
+		5xx or a broken connection may still have been applied, so it is only
+		retried when the connection couldn't be opened, unless the caller passes
+		retries. Pass retries=0 for request bodies that can't be sent twice, such
+		as streams. Each attempt is timed under stage.
+		"""
+		idempotent = retries is not None or method.upper() in IDEMPOTENT_METHODS
+		retries = self.retries if retries is None else retries
+		url = "%sapi/%s" % (self.host, path)
+		params = dict(kwargs.pop('params', {}))
+		params['key'] = self.secret_key
+		attempt = 0
+		while True:
+			try:
+				with self.limit, metrics.timer(stage):
+					result = self.session.request(method, url, params=params, verify=self.verify, **kwargs)
+				with self.lock:
+					self.requests += 1
+				if result.status_code < 500 or attempt >= retries or not idempotent:
+					result.raise_for_status()
+					return result
+				reason = "HTTP %s" % result.status_code
+			except requests.ConnectionError as e:
+				if attempt >= retries or not (idempotent or not_sent(e)):
+					raise
+				reason = str(e)
+			delay = self.backoff * (2 ** attempt)
+			attempt += 1
+			with self.lock:
+				self.retried += 1
+			metrics.count("clowder_retries")
+			logging.getLogger(__name__).warning("%s %s failed (%s); retry %s in %.1fs" % (
+				method, path, reason, attempt, delay))
+			time.sleep(delay)
+
+	# concurrency helpers
+	def _in_message(self, func):
+		# time calls on the pool threads as part of the caller's message
+		message = metrics.current()
+
+		def run(*args):
+			metrics.attach(message)
+			try:
+				return func(*args)
+			finally:
+				metrics.attach(None)
+		return run
+
+	def submit(self, func, *args):
+		"""Start func(*args) on the client's thread pool; call .get() on the result to wait for it."""
+		return self.pool.apply_async(self._in_message(func), args)
+
+	def map(self, func, items):
+		"""Return [func(item) for item in items], with the calls running concurrently."""
+		items = list(items)
+		if len(items) <= 1:
+			return [func(i) for i in items]
+		return self.pool.map(self._in_message(func), items)
+
+	# dataset calls
+	def get_dataset_id(self, name):
+		"""Return the id of the dataset with exactly this name, or None."""
+		with self.lock:
+			if name in self.datasets:
+				return self.datasets[name]
+		dataset_id = None
+		for ds in self.request('GET', 'datasets', "get_dataset_id", params={"title": name, "limit": 10}).json():
+			if ds.get('name') == name:
+				dataset_id = ds['id']
+				break
+		with self.lock:
+			self.datasets[name] = dataset_id
+		return dataset_id
+
+	def get_file_list(self, dataset_id):
+		"""Return the file records of a dataset in one request."""
+		return self.request('GET', 'datasets/%s/files' % dataset_id, "get_file_list").json()
+
+	def remove_metadata(self, dataset_id, extractor=None):
+		params = {"extractor": extractor} if extractor else {}
+		self.request('DELETE', 'datasets/%s/metadata.jsonld' % dataset_id, "remove_metadata", params=params)
+
+	def upload_metadata(self, dataset_id, metadata):
+		self.request('POST', 'datasets/%s/metadata.jsonld' % dataset_id, "upload_metadata", json=metadata)
+
+	def submit_extraction(self, dataset_id, extractor):
+		self.request('POST', 'datasets/%s/extractions' % dataset_id, "submit_extraction", json={"extractor": extractor})
+
+	def upload_to_dataset(self, dataset_id, path, mounted_paths=None):
+		"""Add a file to a dataset and return its id, like pyclowder's upload_to_dataset.
+
+		A file under one of the local mounts of mounted_paths (Clowder path ->
+		local path) is added by its Clowder path without sending its contents.
+		"""
+		for remote, local in sorted((mounted_paths or {}).items(), key=lambda m: len(m[1]), reverse=True):
+			if path.startswith(local):
+				pointer = json.dumps({"path": remote + path[len(local):]})
+				return self.request('POST', 'uploadToDataset/%s' % dataset_id, "upload_to_dataset",
+									files={"file": (None, pointer)}).json()['id']
+		with open(path, 'rb') as f:
+			return self.request('POST', 'uploadToDataset/%s' % dataset_id, "upload_to_dataset", retries=0,
+								files={"File": (os.path.basename(path), f)}).json()['id']
+
+	def submit_extractions(self, dataset_id, extractors):
+		"""Submit the dataset to several extractors at once."""
+		self.map(lambda e: self.submit_extraction(dataset_id, e), extractors)
+
+	# file calls
+	def download_info(self, file_id, missing_ok=False):
+		"""Return the info of a file; with missing_ok, None if Clowder answers 404."""
+		try:
+			return self.request('GET', 'files/%s/metadata' % file_id, "download_info").json()
+		except requests.HTTPError as e:
+			if missing_ok and e.response is not None and e.response.status_code == 404:
+				return None
+			raise
+
+	def download_info_many(self, file_ids, missing_ok=False):
+		"""Return the info of each file id, in order, fetched concurrently."""
+		return self.map(lambda fid: self.download_info(fid, missing_ok), file_ids)
+
+	def summary(self):
+		return "clowder client: %s requests, %s retried" % (self.requests, self.retried)
+
+	def close(self):
+		self.pool.close()
+		self.pool.join()
+		self.session.close()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+"""SQLite index of dataset directory listings on the raw_data mounts.
+
+Listing directories on the NFS/Lustre mounts is the slowest part of a
+re-clean or repair sweep. The index keeps the file names of each directory
+together with the directory mtime; a lookup costs one stat, and only
+directories whose mtime changed are listed again.
+
+Build or refresh the index for a tree with:
+    python dirindex.py INDEX_FILE ROOT_DIR [THREADS]
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import metrics
+
+try:
+	from os import scandir
+except ImportError:
+	# python 2: the scandir backport, if installed
+	try:
+		from scandir import scandir
+	except ImportError:
+		scandir = None
+
+
+def _scan(path, classify=True):
+	"""Return (mtime, file names, subdirectory names) of path, or None if it can't be listed.
+
+	Without scandir, telling files from directories costs a stat per entry; with
+	classify=False every name is returned as a file and the subdirectories as None.
+	"""
+	with metrics.timer("listdir"):
+		return _list(path, classify)
+
+
+def _list(path, classify):
+	try:
+		mtime = os.stat(path).st_mtime
+		files, dirs = [], []
+		if scandir is not None:
+			for entry in scandir(path):
+				(dirs if entry.is_dir() else files).append(entry.name)
+		elif not classify:
+			return (mtime, os.listdir(path), None)
+		else:
+			for name in os.listdir(path):
+				(dirs if os.path.isdir(os.path.join(path, name)) else files).append(name)
+		return (mtime, files, dirs)
+	except OSError:
+		return None
+
+
+class DirectoryIndex(object):
+	"""Cached directory listings keyed by path and validated against the directory mtime."""
+
+	def __init__(self, db_path, timeout=30):
+		self.db_path = db_path
+		self.lock = threading.Lock()
+		self.conn = sqlite3.connect(db_path, timeout=timeout, check_same_thread=False)
+		with self.lock:
+			self.conn.execute("CREATE TABLE IF NOT EXISTS dirs ("
+							  "path TEXT PRIMARY KEY, mtime REAL NOT NULL, files TEXT NOT NULL, dirs TEXT NOT NULL)")
+			self.conn.commit()
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, path):
+		"""Return (mtime, files, dirs) stored for path, or None. dirs is None if the listing wasn't classified."""
+		with self.lock:
+			row = self.conn.execute("SELECT mtime, files, dirs FROM dirs WHERE path=?", (path,)).fetchone()
+		if row is None:
+			return None
+		return (row[0], json.loads(row[1]), json.loads(row[2]))
+
+	def store(self, entries):
+		"""Save (path, mtime, files, dirs) entries."""
+		with self.lock:
+			self.conn.executemany("INSERT OR REPLACE INTO dirs (path, mtime, files, dirs) VALUES (?, ?, ?, ?)",
+								  [(p, m, json.dumps(f), json.dumps(d)) for p, m, f, d in entries])
+			self.conn.commit()
+
+	def listdir(self, path, verify=True):
+		"""Return the file names in path, listing the directory only if the index is missing or stale.
+
+		With verify=False the stored listing is trusted without a stat. Returns None
+		if path can't be listed. Without scandir the names of subdirectories are
+		returned too, rather than stat each entry; callers match file suffixes.
+		"""
+		path = os.path.normpath(path)
+		known = self.get(path)
+		if known is not None:
+			if not verify:
+				self.hits += 1
+				return known[1]
+			try:
+				if os.stat(path).st_mtime == known[0]:
+					self.hits += 1
+					return known[1]
+			except OSError:
+				return None
+
+		self.misses += 1
+		scanned = _scan(path, classify=False)
+		if scanned is None:
+			return None
+		self.store([(path, scanned[0], scanned[1], scanned[2])])
+		return scanned[1]
+
+	def find_metadata(self, path):
+		"""Return the full path of the *metadata.json file in path, or None."""
+		md_file = None
+		for f in self.listdir(path) or []:
+			if f.endswith("metadata.json"):
+				md_file = os.path.join(path, f)
+		return md_file
+
+	def find_targets(self, path, targets):
+		"""Return {target suffix: full path} for the files in path ending with one of targets."""
+		targ_files = {}
+		for f in self.listdir(path) or []:
+			for t in targets:
+				if f.endswith(t):
+					targ_files[t] = os.path.join(path, f)
+					break
+		return targ_files
+
+	def crawl(self, root, threads=16):
+		"""Index every directory under root, listing only those whose mtime changed.
+
+		Returns (directories visited, directories listed).
+		"""
+		pool = ThreadPool(threads)
+		visited = listed = 0
+		try:
+			level = [os.path.normpath(root)]
+			while level:
+				known = dict((p, self.get(p)) for p in level)
+
+				def refresh(path):
+					entry = known[path]
+					# listings stored by listdir() without subdirectories are listed again
+					if entry is not None and entry[2] is not None:
+						try:
+							if os.stat(path).st_mtime == entry[0]:
+								return (path, entry, False)
+						except OSError:
+							return (path, None, False)
+					return (path, _scan(path), True)
+
+				results = pool.map(refresh, level)
+				changed = [(p, e[0], e[1], e[2]) for p, e, fresh in results if fresh and e is not None]
+				self.store(changed)
+				visited += len(results)
+				listed += len(changed)
+				level = [os.path.join(p, d) for p, e, fresh in results if e is not None for d in e[2]]
+		finally:
+			pool.close()
+			pool.join()
+		return (visited, listed)
+
+	def summary(self):
+		return "directory index: %s hits, %s listings" % (self.hits, self.misses)
+
+	def close(self):
+		with self.lock:
+			self.conn.close()
+
+
+if __name__ == "__main__":
+	if len(sys.argv) < 3:
+		print("usage: dirindex.py INDEX_FILE ROOT_DIR [THREADS]")
+		sys.exit(1)
+	logging.basicConfig(level=logging.INFO)
+	index = DirectoryIndex(sys.argv[1])
+	start = time.time()
+	visited, listed = index.crawl(sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else 16)
+	print("visited %s directories, listed %s in %.1fs" % (visited, listed, time.time() - start))
+	index.close()
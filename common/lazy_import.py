@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+
+"""Import heavy modules on first use instead of at extractor startup.
+
+Short HPC jobs and idle extractors pay for every import made at startup,
+and terrautils.geostreams or GDAL cost more than the rest of the extractor.
+lazy_function() stands in for a `from module import name` until the first
+call; preload() imports the modules up front, for a pre-forked parent whose
+children should start warm.
+"""
+
+import importlib
+
+import metrics
+
+
+def lazy_function(module_name, name):
+	"""Return a function that imports module_name on its first call and then calls its `name`."""
+	loaded = []
+
+	def call(*args, **kwargs):
+		if not loaded:
+			loaded.append(getattr(load(module_name), name))
+		return loaded[0](*args, **kwargs)
+
+	call.__name__ = name
+	call.__doc__ = "%s.%s, imported on first use." % (module_name, name)
+	return call
+
+
+def load(module_name):
+	"""Import module_name (a no-op once imported), timed as import_<module_name>."""
+	with metrics.timer("import_%s" % module_name):
+		return importlib.import_module(module_name)
+
+
+def preload(*module_names):
+	"""Import module_names now."""
+	return [load(m) for m in module_names]
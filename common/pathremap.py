@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+"""Translate Clowder file paths to the paths the extractor sees on its own mounts.
+
+The mount table ({'clowder path': 'local path'}, the connector's mounted_paths)
+is compiled into a trie of path components, so the longest mounted prefix is
+found in one walk regardless of the table size, and only that prefix is
+replaced. Recent results are kept in an LRU cache.
+"""
+
+import threading
+from collections import OrderedDict
+
+
+_TARGET = object()
+
+
+def _components(path):
+	return [c for c in path.split("/") if c]
+
+
+class MountPathRemapper(object):
+	"""Longest-prefix mount path remapping with an LRU cache of recent paths."""
+
+	def __init__(self, mounted_paths, cache_size=4096):
+		self.mounted_paths = mounted_paths
+		self.cache_size = cache_size
+		self.cache = OrderedDict()
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.trie = {}
+		for source_path, local_path in (mounted_paths or {}).items():
+			node = self.trie
+			for c in _components(source_path):
+				node = node.setdefault(c, {})
+			node[_TARGET] = local_path.rstrip("/") if local_path.strip("/") else local_path
+
+	def _remap(self, path):
+		if not path.startswith("/"):
+			return path
+		parts = path.split("/")
+		node = self.trie
+		match = node.get(_TARGET)
+		match_len = 1
+		for i in range(1, len(parts)):
+			node = node.get(parts[i])
+			if node is None:
+				break
+			local = node.get(_TARGET)
+			if local is not None:
+				match = local
+				match_len = i + 1
+		if match is None:
+			return path
+		rest = "/".join(parts[match_len:])
+		if not rest:
+			return match
+		return match + rest if match.endswith("/") else match + "/" + rest
+
+	def remap(self, path):
+		"""Return path with its longest mounted prefix replaced by the local mount."""
+		if not self.trie:
+			return path
+		with self.lock:
+			local = self.cache.pop(path, None)
+			if local is not None:
+				self.cache[path] = local
+				self.hits += 1
+				return local
+			self.misses += 1
+		local = self._remap(path)
+		with self.lock:
+			self.cache[path] = local
+			if len(self.cache) > self.cache_size:
+				self.cache.popitem(last=False)
+		return local
+
+	def remap_many(self, paths):
+		"""Remap a list of paths without touching the shared cache; repeats within the list are remapped once."""
+		if not self.trie:
+			return list(paths)
+		memo = {}
+		result = []
+		for p in paths:
+			local = memo.get(p)
+			if local is None:
+				local = memo[p] = self._remap(p)
+			result.append(local)
+		return result
+
+	def summary(self):
+		return "path remapper: %s mounts, %s hits, %s misses" % (len(self.mounted_paths or {}), self.hits, self.misses)
+
+
+# compiled remappers by mount table contents, most recently used last
+_remappers = OrderedDict()
+_remappers_lock = threading.Lock()
+MAX_REMAPPERS = 16
+
+
+def get_remapper(mounted_paths):
+	"""Return the compiled remapper for a mount table, shared by every table with the same mounts.
+
+	Worker and prefork mode parse a new table for each message, so tables are
+	matched by their contents rather than identity.
+	"""
+	key = tuple(sorted(mounted_paths.items()))
+	with _remappers_lock:
+		remapper = _remappers.pop(key, None)
+		if remapper is None:
+			remapper = MountPathRemapper(dict(mounted_paths))
+			while len(_remappers) >= MAX_REMAPPERS:
+				_remappers.popitem(last=False)
+		_remappers[key] = remapper
+		return remapper
+
+
+def remap_mount_path(connector, path):
+	"""Remap path with the connector's mounted_paths; path is returned unchanged without a connector."""
+	if connector is None or not getattr(connector, 'mounted_paths', None):
+		return path
+	return get_remapper(connector.mounted_paths).remap(path)
+
+
+def remap_mount_paths(connector, paths):
+	"""remap_mount_path for a list of paths."""
+	if connector is None or not getattr(connector, 'mounted_paths', None):
+		return list(paths)
+	return get_remapper(connector.mounted_paths).remap_many(paths)
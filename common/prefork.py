@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+
+"""Serve extractor jobs from warm pre-forked worker processes.
+
+A batch job that starts a new interpreter pays for importing pyclowder,
+terrautils, GDAL and the extractor configuration before doing any work.
+serve_prefork() does all of that once in a parent process, then forks
+workers that share the warm state copy-on-write and take jobs from a unix
+socket, one at a time each. Workers are replaced when they exit or after
+max_jobs jobs; SIGTERM lets running jobs finish. An extractor's post_fork(slot)
+is called in each worker before its first job, to open what can't be shared
+between processes (SQLite connections, HTTP sessions, the metrics exporter);
+slot numbers the workers from 0 and is kept by a replacement.
+
+A job is one JSON line: {"message": <Clowder message body>, "routing_key": ...}
+or {"picklefile": <path>} as written for pyclowder's HPC connector. The reply is
+one JSON line with "status" "ok" or "error". Submit jobs with:
+    python prefork.py submit SOCKET [--pickle FILE ... | --message FILE.json [--routing_key KEY] | --ping] ...
+
+submit takes the same arguments as the extractor scripts, so batch_launcher.sh
+passes its arguments to whichever one runs the job: --pickle as for pyclowder's
+HPC connector, while the extractor's other options are ignored since the pool
+applied its own when it started.
+
+This module only imports the standard library at the top so the submit
+client starts quickly.
+"""
+
+import errno
+import json
+import logging
+import os
+import pickle
+import signal
+import socket
+import sys
+import time
+
+
+class PreforkServer(object):
+	"""Parent of the pre-forked workers of one extractor."""
+
+	def __init__(self, extractor, socket_path, workers=4, max_jobs=1000, on_exit=None):
+		self.extractor = extractor
+		self.socket_path = socket_path
+		self.workers = max(1, workers)
+		self.max_jobs = max_jobs
+		self.on_exit = on_exit
+		self.children = {}
+		self.stopping = False
+		self.busy = False
+		self.sock = None
+
+	def serve(self):
+		log = logging.getLogger(__name__)
+		start = time.time()
+		preload = getattr(self.extractor, 'preload', None)
+		if preload:
+			preload()
+		log.info("preloaded in %.2fs" % (time.time() - start))
+
+		if os.path.exists(self.socket_path):
+			os.unlink(self.socket_path)
+		self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.sock.bind(self.socket_path)
+		self.sock.listen(128)
+
+		signal.signal(signal.SIGTERM, self.stop)
+		signal.signal(signal.SIGINT, self.stop)
+		for slot in range(self.workers):
+			self.spawn(slot)
+		log.info("serving %s with %s pre-forked workers" % (self.socket_path, self.workers))
+
+		while self.children:
+			try:
+				pid, status = os.wait()
+			except OSError as e:
+				if e.errno == errno.EINTR:
+					continue
+				raise
+			started, slot = self.children.pop(pid, (None, None))
+			if not self.stopping and slot is not None:
+				if status and time.time() - started < 1:
+					# don't spin when workers fail right away
+					time.sleep(1)
+				self.spawn(slot)
+
+		self.sock.close()
+		if os.path.exists(self.socket_path):
+			os.unlink(self.socket_path)
+		log.info("all workers stopped")
+
+	def stop(self, *args):
+		if self.stopping:
+			return
+		self.stopping = True
+		for pid in list(self.children):
+			try:
+				os.kill(pid, signal.SIGTERM)
+			except OSError:
+				pass
+
+	def spawn(self, slot):
+		pid = os.fork()
+		if pid:
+			self.children[pid] = (time.time(), slot)
+			return
+		code = 0
+		try:
+			post_fork = getattr(self.extractor, 'post_fork', None)
+			if post_fork:
+				post_fork(slot)
+			self.work()
+		except Exception:
+			logging.getLogger(__name__).exception("pre-forked worker failed")
+			code = 1
+		finally:
+			if self.on_exit:
+				try:
+					self.on_exit()
+				except Exception:
+					logging.getLogger(__name__).exception("worker exit handler failed")
+			os._exit(code)
+
+	def work(self):
+		"""Worker loop: take jobs from the socket until max_jobs or SIGTERM."""
+		self.children = {}
+		signal.signal(signal.SIGTERM, self.stop_worker)
+		signal.signal(signal.SIGINT, signal.SIG_IGN)
+		for n in range(self.max_jobs):
+			self.busy = False
+			if self.stopping:
+				return
+			try:
+				conn, addr = self.sock.accept()
+			except socket.error as e:
+				if e.args and e.args[0] == errno.EINTR:
+					continue
+				raise
+			self.busy = True
+			try:
+				self.handle(conn)
+			finally:
+				conn.close()
+
+	def stop_worker(self, *args):
+		self.stopping = True
+		if not self.busy:
+			# waiting in accept(); nothing to finish
+			raise SystemExit(0)
+
+	def handle(self, conn):
+		f = conn.makefile('rb')
+		try:
+			line = f.readline()
+		finally:
+			f.close()
+		start = time.time()
+		try:
+			reply = self.run_job(json.loads(line.decode('utf-8')))
+		except Exception as e:
+			logging.getLogger(__name__).exception("job failed")
+			reply = {"status": "error", "error": "%s: %s" % (type(e).__name__, e)}
+		reply["pid"] = os.getpid()
+		reply["seconds"] = time.time() - start
+		conn.sendall((json.dumps(reply) + "\n").encode('utf-8'))
+
+	def run_job(self, job):
+		if job.get('ping'):
+			return {"status": "ok"}
+		if 'picklefile' in job:
+			with open(job['picklefile'], 'rb') as pf:
+				body = pickle.load(pf)
+		else:
+			body = job['message']
+
+		from pyclowder.connectors import Connector
+		from worker_pool import connector_settings
+
+		if 'routing_key' not in body and job.get('routing_key'):
+			# pyclowder reads the resource type from it; RabbitMQ deliveries carry it outside the body
+			body['routing_key'] = job['routing_key']
+
+		mounted_paths, ssl_verify = connector_settings(self.extractor)
+		info = self.extractor.extractor_info
+		connector = Connector(info['name'], info, check_message=self.extractor.check_message,
+							  process_message=self.extractor.process_message, ssl_verify=ssl_verify,
+							  mounted_paths=mounted_paths)
+		connector._process_message(body)
+		return {"status": "ok"}
+
+
+def serve_prefork(extractor, socket_path, workers=4, max_jobs=1000, on_exit=None):
+	"""Run extractor jobs from socket_path on pre-forked workers until SIGTERM or SIGINT.
+
+	on_exit is called in each worker before it exits, e.g. to flush buffered output.
+	"""
+	PreforkServer(extractor, socket_path, workers, max_jobs, on_exit).serve()
+
+
+def submit(socket_path, job, timeout=None):
+	"""Send one job to a prefork server and return its reply."""
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	sock.settimeout(timeout)
+	try:
+		sock.connect(socket_path)
+		sock.sendall((json.dumps(job) + "\n").encode('utf-8'))
+		f = sock.makefile('rb')
+		try:
+			line = f.readline()
+		finally:
+			f.close()
+	finally:
+		sock.close()
+	if not line:
+		return {"status": "error", "error": "worker closed the connection"}
+	return json.loads(line.decode('utf-8'))
+
+
+def _jobs(args):
+	jobs = []
+	i = 0
+	while i < len(args):
+		if args[i] == "--ping":
+			jobs.append({"ping": True})
+			i += 1
+		elif args[i] == "--pickle":
+			# one or more files, like pyclowder's own option
+			i += 1
+			while i < len(args) and not args[i].startswith("-"):
+				jobs.append({"picklefile": os.path.abspath(args[i])})
+				i += 1
+		elif args[i] == "--message" and i + 1 < len(args):
+			with open(args[i + 1]) as f:
+				jobs.append({"message": json.load(f)})
+			i += 2
+		elif args[i] == "--routing_key" and i + 1 < len(args):
+			if not jobs or 'message' not in jobs[-1]:
+				raise ValueError("--routing_key must follow the --message it belongs to")
+			jobs[-1]['routing_key'] = args[i + 1]
+			i += 2
+		elif args[i].startswith("-"):
+			# an extractor option (--connector, --mounts, ...): the pool applied its own when it started
+			sys.stderr.write("ignoring %s: the pool runs with the options it was started with\n" % args[i])
+			i += 1
+			if i < len(args) and not args[i].startswith("-"):
+				i += 1
+		else:
+			raise ValueError("unexpected argument %s" % args[i])
+	return jobs
+
+
+if __name__ == "__main__":
+	if len(sys.argv) < 3 or sys.argv[1] != "submit":
+		print("usage: python prefork.py submit SOCKET [--pickle FILE ... | --message FILE.json [--routing_key KEY] | --ping] ...")
+		sys.exit(2)
+	failed = 0
+	for job in _jobs(sys.argv[3:]) or [{"ping": True}]:
+		reply = submit(sys.argv[2], job)
+		if reply.get("status") != "ok":
+			failed += 1
+			sys.stderr.write("job failed: %s\n" % reply.get("error"))
+	sys.exit(1 if failed else 0)
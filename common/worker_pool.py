@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+
+"""Process several extractor messages at once in one process.
+
+pyclowder hands an extractor one RabbitMQ message at a time. run_workers()
+consumes the extractor's queue itself with a prefetch of several messages and
+runs them on a thread pool through pyclowder's own message handling, so
+check_message and process_message are unchanged. Messages for the same
+dataset run one after another in delivery order, and each message is acked
+when it finishes. Extractors run this way subclass PerThreadStats so the
+per-message stats of TerrarefExtractor are not shared between messages. SIGTERM or SIGINT stops consumption: running messages
+finish and are acked, prefetched ones that haven't started are requeued.
+"""
+
+import collections
+import functools
+import json
+import logging
+import re
+import signal
+import threading
+import time
+
+try:
+	import pika
+	from pyclowder.connectors import Connector
+except ImportError:
+	pika = None
+	Connector = object
+
+
+class OrderedPool(object):
+	"""Thread pool that runs tasks with the same key one at a time, in submission order.
+
+	Tasks with different keys run concurrently on up to `workers` threads. A key
+	whose task finishes goes to the back of the line if it has more tasks, so one
+	busy dataset can't hold a thread while others wait.
+	"""
+
+	def __init__(self, workers):
+		self.cond = threading.Condition()
+		self.tasks = {}
+		self.ready = collections.deque()
+		self.running = 0
+		self.closed = False
+		self.threads = []
+		for i in range(max(1, workers)):
+			t = threading.Thread(target=self._work, name="message-worker-%d" % i)
+			t.daemon = True
+			t.start()
+			self.threads.append(t)
+
+	def submit(self, key, func, *args):
+		"""Queue func(*args) behind any pending tasks for key."""
+		with self.cond:
+			if self.closed:
+				raise RuntimeError("pool is closed")
+			if key in self.tasks:
+				self.tasks[key].append((func, args))
+			else:
+				self.tasks[key] = collections.deque([(func, args)])
+				self.ready.append(key)
+				self.cond.notify()
+
+	def _work(self):
+		while True:
+			with self.cond:
+				while not self.ready and not self.closed:
+					self.cond.wait()
+				if not self.ready:
+					return
+				key = self.ready.popleft()
+				func, args = self.tasks[key].popleft()
+				self.running += 1
+			try:
+				func(*args)
+			except Exception:
+				logging.getLogger(__name__).exception("unhandled error in message worker")
+			finally:
+				with self.cond:
+					self.running -= 1
+					if self.tasks[key]:
+						self.ready.append(key)
+					else:
+						del self.tasks[key]
+					self.cond.notify_all()
+
+	def pending(self):
+		"""Number of tasks queued or running."""
+		with self.cond:
+			return self.running + sum(len(q) for q in self.tasks.values())
+
+	def wait(self):
+		"""Wait until every submitted task has finished."""
+		with self.cond:
+			while self.tasks:
+				self.cond.wait()
+
+	def close(self):
+		"""Stop accepting tasks and drop the ones not started yet; returns their (func, args)."""
+		with self.cond:
+			self.closed = True
+			dropped = []
+			for key in list(self.ready):
+				dropped.extend(self.tasks.pop(key))
+			self.ready.clear()
+			for key in self.tasks:
+				# keys with a running task keep nothing queued behind it either
+				while self.tasks[key]:
+					dropped.append(self.tasks[key].popleft())
+			self.cond.notify_all()
+			return dropped
+
+	def join(self, timeout=None):
+		"""Wait for running tasks after close(); returns False on timeout."""
+		deadline = None if timeout is None else time.time() + timeout
+		with self.cond:
+			while self.running:
+				remaining = None if deadline is None else deadline - time.time()
+				if remaining is not None and remaining <= 0:
+					return False
+				self.cond.wait(remaining)
+		return True
+
+
+class PerThread(object):
+	"""Attribute descriptor holding a separate value for each thread, `default` until set."""
+
+	def __init__(self, default=None):
+		self.default = default
+		self.local = threading.local()
+
+	def _values(self):
+		values = getattr(self.local, 'values', None)
+		if values is None:
+			values = self.local.values = {}
+		return values
+
+	def __get__(self, obj, objtype=None):
+		if obj is None:
+			return self
+		return self._values().get(id(obj), self.default)
+
+	def __set__(self, obj, value):
+		self._values()[id(obj)] = value
+
+
+class PerThreadStats(object):
+	"""Mixin keeping TerrarefExtractor's per-message stats per thread.
+
+	start_message() resets starttime, created and bytes on the extractor and
+	end_message() logs them to InfluxDB, which is only right while one message
+	runs at a time. Each message runs on one worker thread, so keeping them per
+	thread gives every message its own. Work a message hands to other threads
+	must be counted on the message thread.
+	"""
+	starttime = PerThread()
+	created = PerThread(0)
+	bytes = PerThread(0)
+
+
+def routing_keys(extractor_info):
+	"""The routing keys pyclowder binds an extractor's queue to."""
+	keys = ["extractors." + extractor_info['name']]
+	for resource, types in extractor_info.get('process', {}).items():
+		for mt in types:
+			mt = re.sub(r"\*$", "#", mt)
+			if "*" in mt:
+				logging.getLogger(__name__).warning("skipping unsupported process type %s" % mt)
+				continue
+			keys.append("*.%s.%s" % (resource, mt.replace("/", ".")))
+	return keys
+
+
+def ordering_key(body):
+	"""Messages with the same key are processed in order: the dataset, else the resource."""
+	return body.get('datasetId') or body.get('id') or body.get('fileid')
+
+
+def message_body(body, routing_key):
+	"""Parse a message body, adding the routing key pyclowder reads the resource type from."""
+	body = json.loads(body)
+	if 'routing_key' not in body and routing_key:
+		body['routing_key'] = routing_key
+	return body
+
+
+def connector_settings(extractor):
+	"""(mounted_paths, ssl_verify) for connectors of extractor, from pyclowder's command line options."""
+	mounts = getattr(extractor.args, 'mounted_paths', None) or {}
+	if not isinstance(mounts, dict):
+		mounts = json.loads(mounts)
+	return (mounts, getattr(extractor.args, 'sslverify', True))
+
+
+class MessageConnector(Connector):
+	"""pyclowder connector for a single message, reporting status on the consumer's channel."""
+
+	def __init__(self, consumer, properties, *args, **kwargs):
+		super(MessageConnector, self).__init__(*args, **kwargs)
+		self.consumer = consumer
+		self.reply_to = properties.reply_to
+		self.correlation_id = properties.correlation_id
+
+	def status_update(self, status, resource, message):
+		super(MessageConnector, self).status_update(status, resource, message)
+		if not self.reply_to:
+			return
+		report = json.dumps({
+			'file_id': resource.get('id'),
+			'extractor_id': self.extractor_info['name'],
+			'status': "%s: %s" % (status, message),
+			'start': time.strftime('%Y-%m-%dT%H:%M:%S%z')
+		})
+		self.consumer.threadsafe(self.consumer.channel.basic_publish, exchange='', routing_key=self.reply_to,
+								 properties=pika.BasicProperties(correlation_id=self.correlation_id), body=report)
+
+
+class MessageConsumer(object):
+	"""Consume an extractor queue and process up to `workers` messages concurrently."""
+
+	def __init__(self, extractor, workers, prefetch=0):
+		if pika is None:
+			raise RuntimeError("pika and pyclowder are required for worker mode")
+		if not hasattr(pika.BlockingConnection, 'add_callback_threadsafe'):
+			raise RuntimeError("worker mode needs pika 1.0 or later, found %s" % getattr(pika, '__version__', "?"))
+		self.extractor = extractor
+		self.workers = workers
+		self.prefetch = prefetch or workers * 2
+		self.pool = OrderedPool(workers)
+		self.stopping = False
+		self.processed = 0
+		self.failed = 0
+		self.count_lock = threading.Lock()
+
+		args = extractor.args
+		self.mounted_paths, self.ssl_verify = connector_settings(extractor)
+		self.queue = getattr(args, 'rabbitmq_queuename', None) or extractor.extractor_info['name']
+		self.exchange = getattr(args, 'rabbitmq_exchange', None) or "clowder"
+		self.connection = pika.BlockingConnection(pika.URLParameters(args.rabbitmq_uri))
+		self.channel = self.connection.channel()
+
+	def threadsafe(self, func, *args, **kwargs):
+		"""Run a channel call on the connection thread; pika channels are not thread-safe."""
+		self.connection.add_callback_threadsafe(functools.partial(func, *args, **kwargs))
+
+	def on_message(self, channel, method, properties, body):
+		try:
+			key = ordering_key(json.loads(body))
+		except ValueError:
+			key = None
+		self.pool.submit(key, self.handle, method.delivery_tag, method.redelivered, method.routing_key, properties, body)
+
+	def handle(self, delivery_tag, redelivered, routing_key, properties, body):
+		connector = MessageConnector(self, properties, self.extractor.extractor_info['name'],
+									 self.extractor.extractor_info, check_message=self.extractor.check_message,
+									 process_message=self.extractor.process_message, ssl_verify=self.ssl_verify,
+									 mounted_paths=self.mounted_paths)
+		try:
+			# same handling as pyclowder's own consumer, which also acks messages that failed to process
+			connector._process_message(message_body(body, routing_key))
+		except Exception:
+			logging.getLogger(__name__).exception("message could not be handled")
+			with self.count_lock:
+				self.failed += 1
+			# give a message one more delivery before dropping it
+			self.threadsafe(self.channel.basic_nack, delivery_tag, requeue=not redelivered)
+			return
+		with self.count_lock:
+			self.processed += 1
+		self.threadsafe(self.channel.basic_ack, delivery_tag)
+
+	def stop(self, *args):
+		self.stopping = True
+
+	def run(self, drain_timeout=None):
+		"""Consume until stop() is called, then drain."""
+		log = logging.getLogger(__name__)
+		self.channel.exchange_declare(exchange=self.exchange, exchange_type='topic', durable=True)
+		self.channel.queue_declare(queue=self.queue, durable=True)
+		for key in routing_keys(self.extractor.extractor_info):
+			self.channel.queue_bind(queue=self.queue, exchange=self.exchange, routing_key=key)
+		self.channel.basic_qos(prefetch_count=self.prefetch)
+		tag = self.channel.basic_consume(self.queue, self.on_message)
+		log.info("consuming %s with %s workers, prefetch %s" % (self.queue, self.workers, self.prefetch))
+
+		while not self.stopping:
+			self.connection.process_data_events(time_limit=1)
+
+		log.info("stopping: finishing %s running messages" % self.pool.running)
+		self.channel.basic_cancel(tag)
+		for func, args in self.pool.close():
+			self.channel.basic_nack(args[0], requeue=True)
+		deadline = None if drain_timeout is None else time.time() + drain_timeout
+		while not self.pool.join(timeout=0.5):
+			# keep delivering the acks of finished messages while waiting
+			self.connection.process_data_events(time_limit=0)
+			if deadline is not None and time.time() > deadline:
+				log.warning("drain timed out; unacked messages will be redelivered")
+				break
+		self.connection.process_data_events(time_limit=0)
+		self.connection.close()
+		log.info(self.summary())
+
+	def summary(self):
+		return "worker pool: %s messages processed, %s failed" % (self.processed, self.failed)
+
+
+def run_workers(extractor, workers, prefetch=0, drain_timeout=None):
+	"""Run extractor with `workers` concurrent messages until SIGTERM or SIGINT."""
+	consumer = MessageConsumer(extractor, workers, prefetch)
+	signal.signal(signal.SIGTERM, consumer.stop)
+	signal.signal(signal.SIGINT, consumer.stop)
+	consumer.run(drain_timeout)
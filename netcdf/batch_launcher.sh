@@ -8,5 +8,11 @@ module load python/2.7.10 pythonlibs/2.7.10 gdal-stack-2.7.10 nco
 # Activate python virtualenv
 source /projects/arpae/terraref/shared/extractors/pyenv/bin/activate
 
-# Run extractor script
-python /projects/arpae/terraref/shared/extractors/extractors-metadata/netcdf/terra_netcdf.py
+# Hand the job to a warm pre-forked pool if one serves $PREFORK_SOCKET (started with
+# `terra_netcdf.py --prefork_socket $PREFORK_SOCKET`), otherwise run the extractor script.
+# Both take the extractor's arguments, e.g. --connector HPC --pickle FILE
+if [ -n "$PREFORK_SOCKET" ] && [ -S "$PREFORK_SOCKET" ]; then
+    python /projects/arpae/terraref/shared/extractors/extractors-metadata/common/prefork.py submit "$PREFORK_SOCKET" "$@"
+else
+    python /projects/arpae/terraref/shared/extractors/extractors-metadata/netcdf/terra_netcdf.py "$@"
+fi
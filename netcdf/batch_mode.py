@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+"""Helpers for running the netcdf extractor over a directory tree instead of RabbitMQ messages."""
+
+import logging
+import os
+import re
+
+from terrautils.extractors import build_metadata
+
+import json_budget
+
+
+DATE_DIR = re.compile(r'^\d{4}-\d{2}-\d{2}')
+
+
+def find_nc_files(root, start_date=None, end_date=None):
+	"""Yield .nc files under root in sorted order, limited to YYYY-MM-DD directories in [start_date, end_date]."""
+	for dirpath, dirnames, filenames in os.walk(root):
+		dirnames.sort()
+		keep = []
+		for d in dirnames:
+			if DATE_DIR.match(d):
+				day = d[:10]
+				if (start_date and day < start_date) or (end_date and day > end_date):
+					continue
+			keep.append(d)
+		dirnames[:] = keep
+		for f in sorted(filenames):
+			if f.endswith('.nc'):
+				yield os.path.join(dirpath, f)
+
+
+class ClowderRegistrar(object):
+	"""Upload batch outputs to the Clowder dataset that holds each .nc file.
+
+	The dataset is found by name, "<dataset_prefix> - <timestamp directory>",
+	the same naming used when the hyperspectral datasets are created. Outputs
+	the dataset already holds with the same name and size are not uploaded
+	again, so registering after a fresh checkpoint doesn't duplicate them.
+	"""
+
+	def __init__(self, client, dataset_prefix, extractor_info, budget):
+		self.client = client
+		self.dataset_prefix = dataset_prefix
+		self.extractor_info = extractor_info
+		self.budget = budget
+
+	def dataset_name(self, nc_path):
+		return "%s - %s" % (self.dataset_prefix, os.path.basename(os.path.dirname(nc_path)))
+
+	def register(self, nc_path, outputs):
+		"""Upload the output files and attach the JSON header as dataset metadata. False if no dataset."""
+		dataset_id = self.client.get_dataset_id(self.dataset_name(nc_path))
+		if not dataset_id:
+			logging.error('...no Clowder dataset named "%s" for %s' % (self.dataset_name(nc_path), nc_path))
+			return False
+
+		existing = set((f.get('filename'), int(f.get('size', -1))) for f in self.client.get_file_list(dataset_id))
+		for out_path in outputs:
+			if (os.path.basename(out_path), os.path.getsize(out_path)) in existing:
+				logging.info('...%s already in dataset %s' % (os.path.basename(out_path), dataset_id))
+				continue
+			self.client.upload_to_dataset(dataset_id, out_path)
+
+			if out_path.endswith('._metadata.json'):
+				doc = json_budget.load_file(out_path, self.budget)
+				self.client.upload_metadata(dataset_id, build_metadata(self.client.host, self.extractor_info,
+																	   dataset_id, doc, 'dataset'))
+		return True
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+"""Keep a bounded subset of large ncks --jsn documents for Clowder metadata.
+
+stream_to_file() copies a JSON stream to disk while an incremental parser
+(ijson) builds only the sections and number of values allowed by the budget,
+so the whole document never has to be held in memory. Without ijson the file
+is written first and loaded back, then pruned the same way.
+"""
+
+import json
+import logging
+from collections import OrderedDict
+from decimal import Decimal
+
+try:
+	import ijson
+except ImportError:
+	ijson = None
+
+
+# top-level sections of the ncks JSON document that go into Clowder metadata
+HEADER_SECTIONS = ("dimensions", "variables", "attributes", "groups")
+
+TRUNCATED_KEY = "_truncated"
+
+_SKIP = object()
+
+
+class Budget(object):
+	"""Limits on how much of a document is kept: leaf values and characters per string (0 = unlimited)."""
+
+	def __init__(self, max_fields=10000, max_string=4096, sections=HEADER_SECTIONS):
+		self.max_fields = max_fields
+		self.max_string = max_string
+		self.sections = sections
+
+
+class _BudgetBuilder(object):
+	"""Build a document from ijson parse events, dropping whatever exceeds the budget."""
+
+	def __init__(self, budget):
+		self.budget = budget
+		self.root = None
+		self.stack = []
+		self.fields = 0
+		self.truncated = False
+
+	def event(self, event, value):
+		if event == 'map_key':
+			self.stack[-1][1] = value
+		elif event == 'start_map':
+			self._add(OrderedDict(), True)
+		elif event == 'start_array':
+			self._add([], True)
+		elif event in ('end_map', 'end_array'):
+			self.stack.pop()
+		else:
+			self._add(value, False)
+
+	def _add(self, value, container):
+		if not self.stack:
+			self.root = value
+			self.stack.append([value, None])
+			return
+
+		parent, key = self.stack[-1]
+		keep = parent is not _SKIP
+		if keep and parent is self.root and self.budget.sections and key not in self.budget.sections:
+			keep = False
+		if keep and not container and self.budget.max_fields and self.fields >= self.budget.max_fields:
+			keep = False
+			self.truncated = True
+
+		if keep:
+			if not container:
+				value = _leaf(value, self.budget)
+				self.fields += 1
+			if isinstance(parent, list):
+				parent.append(value)
+			else:
+				parent[key] = value
+		if container:
+			self.stack.append([value if keep else _SKIP, None])
+
+	def document(self):
+		doc = self.root if self.root is not None else OrderedDict()
+		if self.truncated and isinstance(doc, dict):
+			doc[TRUNCATED_KEY] = True
+		return doc
+
+
+def _leaf(value, budget):
+	if isinstance(value, Decimal):
+		value = float(value)
+	elif budget.max_string and isinstance(value, (bytes, type(u""))) and len(value) > budget.max_string:
+		value = value[:budget.max_string] + "..."
+	return value
+
+
+class _TeeReader(object):
+	"""File-like wrapper that copies everything read from source into sink."""
+
+	def __init__(self, source, sink):
+		self.source = source
+		self.sink = sink
+
+	def read(self, size=-1):
+		data = self.source.read(size)
+		if data:
+			self.sink.write(data)
+		return data
+
+
+def prune(doc, budget):
+	"""Return the part of an in-memory document that fits in budget."""
+	builder = _BudgetBuilder(budget)
+	_walk(doc, builder)
+	return builder.document()
+
+
+def _walk(value, builder):
+	if isinstance(value, dict):
+		builder.event('start_map', None)
+		for k, v in value.items():
+			builder.event('map_key', k)
+			_walk(v, builder)
+		builder.event('end_map', None)
+	elif isinstance(value, list):
+		builder.event('start_array', None)
+		for v in value:
+			_walk(v, builder)
+		builder.event('end_array', None)
+	else:
+		builder.event('scalar', value)
+
+
+def stream_to_file(stream, out_path, budget):
+	"""Copy a JSON byte stream to out_path and return the part of it that fits in budget."""
+	if ijson is None:
+		logging.warning('...ijson is not installed; loading the full JSON document')
+		with open(out_path, 'wb') as out:
+			while True:
+				chunk = stream.read(65536)
+				if not chunk:
+					break
+				out.write(chunk)
+		with open(out_path, 'r') as metajson:
+			return prune(json.load(metajson, object_pairs_hook=OrderedDict), budget)
+
+	builder = _BudgetBuilder(budget)
+	with open(out_path, 'wb') as out:
+		tee = _TeeReader(stream, out)
+		for prefix, event, value in ijson.parse(tee):
+			builder.event(event, value)
+		# copy anything the parser didn't need to read
+		while tee.read(65536):
+			pass
+	return builder.document()
+
+
+def load_file(path, budget):
+	"""Return the part of the JSON document in path that fits in budget."""
+	if ijson is None:
+		with open(path, 'r') as metajson:
+			return prune(json.load(metajson, object_pairs_hook=OrderedDict), budget)
+
+	builder = _BudgetBuilder(budget)
+	with open(path, 'rb') as metajson:
+		for prefix, event, value in ijson.parse(metajson):
+			builder.event(event, value)
+	return builder.document()
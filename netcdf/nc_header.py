@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+
+"""Read a NetCDF header once and render it as CDL, NcML and JSON.
+
+This is the in-process replacement for running `ncks --cdl/--xml/--jsn -m -M`
+on the same file three times. The renderers follow the ncks layouts closely
+enough to be used interchangeably with its output.
+"""
+
+import json
+import math
+import os
+import pkgutil
+from collections import OrderedDict
+from xml.sax.saxutils import quoteattr
+
+# netCDF4 and numpy are imported by load(), on the first header read
+netCDF4 = None
+numpy = None
+
+
+# numpy dtype kind+size -> netCDF/CDL type name
+CDL_TYPES = {
+	'i1': 'byte', 'u1': 'ubyte', 'i2': 'short', 'u2': 'ushort',
+	'i4': 'int', 'u4': 'uint', 'i8': 'int64', 'u8': 'uint64',
+	'f4': 'float', 'f8': 'double', 'S1': 'char'
+}
+
+# CDL literal suffix per type, as written by ncdump/ncks
+CDL_SUFFIXES = {
+	'byte': 'b', 'ubyte': 'ub', 'short': 's', 'ushort': 'us',
+	'uint': 'u', 'int64': 'll', 'uint64': 'ull', 'float': 'f'
+}
+
+
+def available():
+	"""Return True if the netCDF4 module needed to read headers is installed, without importing it."""
+	return netCDF4 is not None or pkgutil.find_loader('netCDF4') is not None
+
+
+def load():
+	"""Import netCDF4 and numpy if not done yet."""
+	global netCDF4, numpy
+	if netCDF4 is None:
+		import numpy as np
+		import netCDF4 as nc
+		numpy = np
+		netCDF4 = nc
+
+
+def read_header(nc_path):
+	"""Return the header model of nc_path: dimensions, variables, attributes and groups."""
+	load()
+	ds = netCDF4.Dataset(nc_path, 'r')
+	try:
+		return _read_group(ds)
+	finally:
+		ds.close()
+
+
+def _read_group(grp):
+	dims = OrderedDict()
+	for name, dim in grp.dimensions.items():
+		dims[_text(name)] = {"size": len(dim), "unlimited": dim.isunlimited()}
+
+	variables = OrderedDict()
+	for name, var in grp.variables.items():
+		variables[_text(name)] = {
+			"type": _type_name(var.dtype),
+			"shape": [_text(d) for d in var.dimensions],
+			"attributes": _read_attributes(var)
+		}
+
+	groups = OrderedDict()
+	for name, sub in grp.groups.items():
+		groups[_text(name)] = _read_group(sub)
+
+	return {"dimensions": dims, "variables": variables,
+			"attributes": _read_attributes(grp), "groups": groups}
+
+
+def _read_attributes(obj):
+	attrs = OrderedDict()
+	for name in obj.ncattrs():
+		value = obj.getncattr(name)
+		if isinstance(value, (bytes, type(u""))):
+			attrs[_text(name)] = ("char", _text(value))
+		elif isinstance(value, numpy.ndarray):
+			if value.dtype.kind in ('S', 'U', 'O'):
+				attrs[_text(name)] = ("string", [_text(v) for v in value.tolist()])
+			else:
+				values = _round_floats(value.dtype, value.tolist())
+				attrs[_text(name)] = (_type_name(value.dtype), values[0] if len(values) == 1 else values)
+		else:
+			value = numpy.asarray(value)
+			attrs[_text(name)] = (_type_name(value.dtype), _round_floats(value.dtype, [value.item()])[0])
+	return attrs
+
+
+def _round_floats(dtype, values):
+	# float32 values widened to python floats pick up noise digits (0.1 -> 0.10000000149011612)
+	if dtype.kind == 'f' and dtype.itemsize == 4:
+		return [float("%.7g" % v) for v in values]
+	return values
+
+
+def _type_name(dtype):
+	if dtype is str or not hasattr(dtype, 'kind'):
+		return 'string'
+	if dtype.kind in ('U', 'O'):
+		return 'string'
+	return CDL_TYPES.get("%s%s" % (dtype.kind, dtype.itemsize), str(dtype))
+
+
+def _text(value):
+	if isinstance(value, bytes):
+		return value.decode('utf-8', 'replace')
+	return value
+
+
+def _values(value):
+	return value if isinstance(value, list) else [value]
+
+
+def _nonfinite(v):
+	"""NaN or Infinity as spelled by ncdump, or None for finite values."""
+	if not isinstance(v, float) or not (math.isnan(v) or math.isinf(v)):
+		return None
+	if math.isnan(v):
+		return "NaN"
+	return "Infinity" if v > 0 else "-Infinity"
+
+
+def _cdl_value(atype, value):
+	if atype in ('char', 'string'):
+		return ", ".join('"%s"' % _cdl_escape(v) for v in _values(value))
+	suffix = CDL_SUFFIXES.get(atype, '')
+	out = []
+	for v in _values(value):
+		if _nonfinite(v):
+			v = _nonfinite(v)
+		elif atype == 'float':
+			v = "%.7g" % v
+		elif atype == 'double':
+			v = "%.15g" % v
+		out.append("%s%s" % (v, suffix))
+	return ", ".join(out)
+
+
+def _cdl_escape(text):
+	return text.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_cdl(header, name):
+	"""Return the header as CDL text, like `ncks --cdl -m -M`."""
+	lines = ["netcdf %s {" % name]
+	_cdl_group(header, lines, "  ")
+	lines.append("} // group /")
+	return "\n".join(lines) + "\n"
+
+
+def _cdl_group(header, lines, indent):
+	inner = indent + "  "
+	if header["dimensions"]:
+		lines.append(indent + "dimensions:")
+		for dname, dim in header["dimensions"].items():
+			if dim["unlimited"]:
+				lines.append(inner + "%s = UNLIMITED ; // (%s currently)" % (dname, dim["size"]))
+			else:
+				lines.append(inner + "%s = %s ;" % (dname, dim["size"]))
+		lines.append("")
+
+	if header["variables"]:
+		lines.append(indent + "variables:")
+		for vname, var in header["variables"].items():
+			shape = "(%s)" % ", ".join(var["shape"]) if var["shape"] else ""
+			lines.append(inner + "%s %s%s ;" % (var["type"], vname, shape))
+			for aname, (atype, value) in var["attributes"].items():
+				lines.append(inner + "  %s:%s = %s ;" % (vname, aname, _cdl_value(atype, value)))
+			lines.append("")
+
+	if header["attributes"]:
+		lines.append(indent + "// global attributes:")
+		for aname, (atype, value) in header["attributes"].items():
+			lines.append(inner + ":%s = %s ;" % (aname, _cdl_value(atype, value)))
+
+	for gname, group in header["groups"].items():
+		lines.append("")
+		lines.append(indent + "group: %s {" % gname)
+		_cdl_group(group, lines, inner)
+		lines.append(indent + "} // group %s" % gname)
+
+
+def render_ncml(header, location):
+	"""Return the header as NcML-XML, like `ncks --xml -m -M`."""
+	lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+			 '<netcdf xmlns="http://www.unidata.ucar.edu/namespaces/netcdf/ncml-2.2" location=%s>' %
+			 quoteattr("file:" + location)]
+	_ncml_group(header, lines, "  ")
+	lines.append("</netcdf>")
+	return "\n".join(lines) + "\n"
+
+
+def _ncml_attribute(aname, atype, value, indent):
+	if atype in ('char', 'string'):
+		values = _values(value)
+		if len(values) == 1:
+			return indent + '<attribute name=%s value=%s />' % (quoteattr(aname), quoteattr(values[0]))
+		return indent + '<attribute name=%s type="String" separator="*" value=%s />' % (
+			quoteattr(aname), quoteattr("*".join(values)))
+	return indent + '<attribute name=%s type="%s" value=%s />' % (
+		quoteattr(aname), atype, quoteattr(" ".join(_nonfinite(v) or str(v) for v in _values(value))))
+
+
+def _ncml_group(header, lines, indent):
+	for dname, dim in header["dimensions"].items():
+		unlimited = ' isUnlimited="true"' if dim["unlimited"] else ''
+		lines.append(indent + '<dimension name=%s length="%s"%s />' % (quoteattr(dname), dim["size"], unlimited))
+
+	for vname, var in header["variables"].items():
+		opening = indent + '<variable name=%s shape=%s type="%s"' % (
+			quoteattr(vname), quoteattr(" ".join(var["shape"])), var["type"])
+		if not var["attributes"]:
+			lines.append(opening + " />")
+			continue
+		lines.append(opening + ">")
+		for aname, (atype, value) in var["attributes"].items():
+			lines.append(_ncml_attribute(aname, atype, value, indent + "  "))
+		lines.append(indent + "</variable>")
+
+	for aname, (atype, value) in header["attributes"].items():
+		lines.append(_ncml_attribute(aname, atype, value, indent))
+
+	for gname, group in header["groups"].items():
+		lines.append(indent + '<group name=%s>' % quoteattr(gname))
+		_ncml_group(group, lines, indent + "  ")
+		lines.append(indent + "</group>")
+
+
+def _json_value(value):
+	# JSON has no NaN or Infinity; ncks writes null for them
+	if isinstance(value, list):
+		return [_json_value(v) for v in value]
+	return None if _nonfinite(value) else value
+
+
+def to_json(header):
+	"""Return the header as the document `ncks --jsn -m -M` writes, with null for NaN and Infinity."""
+	doc = OrderedDict()
+	if header["dimensions"]:
+		doc["dimensions"] = OrderedDict((d, dim["size"]) for d, dim in header["dimensions"].items())
+	if header["variables"]:
+		doc["variables"] = OrderedDict()
+		for vname, var in header["variables"].items():
+			entry = OrderedDict()
+			if var["shape"]:
+				entry["shape"] = var["shape"]
+			entry["type"] = var["type"]
+			if var["attributes"]:
+				entry["attributes"] = OrderedDict((a, _json_value(v)) for a, (t, v) in var["attributes"].items())
+			doc["variables"][vname] = entry
+	if header["attributes"]:
+		doc["attributes"] = OrderedDict((a, _json_value(v)) for a, (t, v) in header["attributes"].items())
+	if header["groups"]:
+		doc["groups"] = OrderedDict((g, to_json(grp)) for g, grp in header["groups"].items())
+	return doc
+
+
+def render_json(header):
+	return json.dumps(to_json(header), indent=2, allow_nan=False) + "\n"
+
+
+def render(header, fmt, nc_path):
+	"""Return the header of nc_path rendered in fmt ('cdl', 'xml' or 'json')."""
+	if fmt == 'cdl':
+		return render_cdl(header, os.path.splitext(os.path.basename(nc_path))[0])
+	elif fmt == 'xml':
+		return render_ncml(header, nc_path)
+	elif fmt == 'json':
+		return render_json(header)
+	raise ValueError("unknown metadata format: %s" % fmt)
+
+
+def write(text, out_path):
+	"""Write rendered text to out_path as UTF-8."""
+	if not isinstance(text, bytes):
+		text = text.encode('utf-8')
+	with open(out_path, 'wb') as out:
+		out.write(text)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+import hashlib
+import json
+import logging
+import os
+
+
+# sidecar written next to the metadata outputs of each .nc file
+CACHE_SUFFIX = '._metadata.cache.json'
+
+HEAD_BYTES = 1024 * 1024
+TAIL_BYTES = 64 * 1024
+
+
+def fingerprint(nc_path, with_hash=True):
+	"""Return size, mtime and (optionally) a hash of the first and last blocks of nc_path.
+
+	The header of classic NetCDF files sits at the start; for NetCDF4/HDF5 the
+	superblock is at the start and the tail catches appended objects.
+	"""
+	st = os.stat(nc_path)
+	fp = {"size": st.st_size, "mtime": st.st_mtime}
+	if with_hash:
+		h = hashlib.sha1()
+		with open(nc_path, 'rb') as f:
+			h.update(f.read(HEAD_BYTES))
+			if st.st_size > HEAD_BYTES + TAIL_BYTES:
+				f.seek(-TAIL_BYTES, os.SEEK_END)
+				h.update(f.read())
+		fp["header_hash"] = h.hexdigest()
+	return fp
+
+
+class OutputCache(object):
+	"""Sidecar record of the source fingerprint the metadata outputs were generated from."""
+
+	def __init__(self, cache_path):
+		self.cache_path = cache_path
+		self.entry = None
+		if os.path.isfile(cache_path):
+			try:
+				with open(cache_path, 'r') as f:
+					self.entry = json.load(f)
+			except (IOError, ValueError) as e:
+				logging.warning('...ignoring unreadable output cache %s: %s' % (cache_path, str(e)))
+
+	@staticmethod
+	def for_outputs(out_dir, out_fname_root):
+		return OutputCache(os.path.join(out_dir, out_fname_root + CACHE_SUFFIX))
+
+	def exists(self):
+		return self.entry is not None
+
+	def is_current(self, nc_path, outputs, version):
+		"""Return True if outputs were all generated by version from the current contents of nc_path."""
+		if self.entry is None or self.entry.get("version") != version:
+			return False
+		if sorted(self.entry.get("outputs", [])) != sorted(os.path.basename(o) for o in outputs):
+			return False
+		if not all(os.path.isfile(o) for o in outputs):
+			return False
+
+		fp = fingerprint(nc_path, with_hash=False)
+		if fp["size"] != self.entry.get("size"):
+			return False
+		if fp["mtime"] == self.entry.get("mtime"):
+			return True
+		# touched but maybe not changed: compare the header hash
+		fp = fingerprint(nc_path)
+		if fp["header_hash"] != self.entry.get("header_hash"):
+			return False
+		self.record(fp, outputs, version)
+		return True
+
+	def record(self, fp, outputs, version):
+		"""Save the fingerprint and outputs produced from it."""
+		entry = dict(fp)
+		entry["outputs"] = sorted(os.path.basename(o) for o in outputs)
+		entry["version"] = version
+		tmp_path = self.cache_path + ".tmp"
+		with open(tmp_path, 'w') as f:
+			json.dump(entry, f)
+		os.rename(tmp_path, self.cache_path)
+		self.entry = entry
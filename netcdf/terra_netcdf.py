@@ -1,71 +1,378 @@
 #!/usr/bin/env python
 
 import logging
-import json
+import multiprocessing
 import os
 import subprocess
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 
 from pyclowder.utils import CheckMessage
-from pyclowder.files import upload_metadata, upload_to_dataset
+from pyclowder.files import download_info
 from terrautils.extractors import TerrarefExtractor, build_metadata
 
+import nc_header
+import json_budget
+from output_cache import OutputCache, fingerprint
+from batch_mode import find_nc_files, ClowderRegistrar
 
-class NetCDFMetadataConversion(TerrarefExtractor):
+# modules shared between extractors live in ../common in a repository checkout
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+from checkpoint import Checkpoint
+from clowder_client import ClowderClient, get_client
+from pathremap import remap_mount_path
+from prefork import serve_prefork
+from worker_pool import run_workers, PerThreadStats
+import metrics
+
+download_info = metrics.timed(download_info)
+
+
+# (format, output file suffix, ncks flag)
+METADATA_OUTPUTS = [
+	('cdl', '_metadata.cdl', '--cdl'),
+	('xml', '._metadataxml', '--xml'),
+	('json', '._metadata.json', '--jsn')
+]
+
+
+def add_local_arguments(parser):
+	# add any additional arguments to parser
+	parser.add_argument('--ncks', action='store_true',
+						default=os.getenv('NETCDF_METADATA_MODE', "native") == "ncks",
+						help="extract headers with ncks subprocesses instead of reading them in-process")
+	parser.add_argument('--pipeline_threads', type=int, default=os.getenv('NETCDF_PIPELINE_THREADS', 3),
+						help="number of metadata formats rendered and uploaded at the same time")
+	parser.add_argument('--json_max_fields', type=int, default=os.getenv('NETCDF_JSON_MAX_FIELDS', 10000),
+						help="maximum number of JSON header values kept for Clowder metadata (0 for no limit)")
+	parser.add_argument('--json_max_string', type=int, default=os.getenv('NETCDF_JSON_MAX_STRING', 4096),
+						help="maximum length of a JSON header string kept for Clowder metadata (0 for no limit)")
+
+	# batch mode: walk a directory tree instead of listening for messages
+	parser.add_argument('--batch_dir', default="",
+						help="extract metadata for every .nc file under this directory and exit")
+	parser.add_argument('--batch_start', default="", help="first YYYY-MM-DD directory to include in batch mode")
+	parser.add_argument('--batch_end', default="", help="last YYYY-MM-DD directory to include in batch mode")
+	parser.add_argument('--batch_processes', type=int, default=multiprocessing.cpu_count(),
+						help="number of files extracted in parallel in batch mode")
+	parser.add_argument('--batch_checkpoint', default="",
+						help="progress file used to resume batch mode (default: .terra_netcdf_checkpoint in batch_dir)")
+	parser.add_argument('--register', action='store_true',
+						help="upload batch mode outputs to the Clowder dataset of each file afterwards")
+	parser.add_argument('--register_threads', type=int, default=8,
+						help="number of files registered with Clowder at the same time")
+	parser.add_argument('--dataset_prefix', default=os.getenv('NETCDF_DATASET_PREFIX', ""),
+						help="dataset name before ' - <timestamp>' used to find Clowder datasets when registering")
+	parser.add_argument('--metrics_port', type=int, default=os.getenv('METRICS_PORT', 0),
+						help="port serving Prometheus metrics on /metrics (0 = off)")
+	parser.add_argument('--workers', type=int, default=os.getenv('EXTRACTOR_WORKERS', 1),
+						help="number of messages processed at the same time (1 = pyclowder's one at a time)")
+	parser.add_argument('--prefetch', type=int, default=os.getenv('EXTRACTOR_PREFETCH', 0),
+						help="number of messages fetched ahead when workers > 1 (default: 2 x workers)")
+	parser.add_argument('--prefork_socket', default=os.getenv('PREFORK_SOCKET', ""),
+						help="serve jobs from batch_launcher.sh on this unix socket with pre-forked warm workers")
+	parser.add_argument('--prefork_workers', type=int, default=os.getenv('PREFORK_WORKERS', 4),
+						help="number of pre-forked workers serving --prefork_socket")
+	parser.add_argument('--clowder_host', default=os.getenv('CLOWDER_HOST', ""),
+						help="Clowder URL used when registering batch mode outputs")
+	parser.add_argument('--clowder_key', default=os.getenv('CLOWDER_KEY', ""),
+						help="Clowder key used when registering batch mode outputs")
+
+class NetCDFMetadataConversion(PerThreadStats, TerrarefExtractor):
 	def __init__(self):
 		super(NetCDFMetadataConversion, self).__init__()
 
+		add_local_arguments(self.parser)
+
 		# parse command line and load default logging configuration
 		self.setup(sensor='netcdf_metadata')
 
+		# assign local arguments
+		self.use_ncks = self.args.ncks or not nc_header.available()
+		self.pipeline_threads = max(1, int(self.args.pipeline_threads))
+		self.json_budget = json_budget.Budget(int(self.args.json_max_fields), int(self.args.json_max_string))
+		if self.args.metrics_port and not self.args.batch_dir and not self.args.prefork_socket:
+			metrics.start_exporter(self.args.metrics_port, self.extractor_info['name'])
+
 	# Check whether dataset already has output files
 	def check_message(self, connector, host, secret_key, resource, parameters):
-		# TODO: can we check local path before processing .nc file?
+		# Look at the mounted copy of the .nc file so unchanged files are skipped before download
+		try:
+			info = download_info(connector, host, secret_key, resource['id'])
+			nc_path = self.remapMountPath(connector, info.get('filepath', ''))
+			if nc_path and os.path.isfile(nc_path):
+				out_dir = os.path.dirname(nc_path)
+				out_fname_root = resource['name'].replace('.nc', '')
+				cache = OutputCache.for_outputs(out_dir, out_fname_root)
+				if cache.is_current(nc_path, self.output_paths(out_dir, out_fname_root), self.output_version()):
+					logging.info('...metadata outputs are current for %s; skipping' % nc_path)
+					return CheckMessage.ignore
+		except Exception as e:
+			logging.warning('...could not check output cache before download: %s' % str(e))
 		return CheckMessage.download
 
 	# Process the file and upload the results
 	def process_message(self, connector, host, secret_key, resource, parameters):
 		self.start_message()
+		message = metrics.start_message()
 
 		# Put files alongside .nc file
-		out_dir = os.path.dirname(resource['local_paths'][0])
+		nc_path = resource['local_paths'][0]
+		out_dir = os.path.dirname(nc_path)
 		out_fname_root = resource['name'].replace('.nc', '')
 
-		metaFilePath = os.path.join(out_dir, out_fname_root+'_metadata.cdl')
-		if not os.path.isfile(metaFilePath) or self.overwrite:
-			logging.info('...extracting metadata in cdl format: %s' % metaFilePath)
-			with open(metaFilePath, 'w') as fmeta:
-				subprocess.call(['ncks', '--cdl', '-m', '-M', resource['local_paths'][0]], stdout=fmeta)
-			self.created += 1
-			self.bytes += os.path.getsize(metaFilePath)
-			upload_to_dataset(connector, host, secret_key, resource['parent']['id'], metaFilePath)
-
-		metaFilePath = os.path.join(out_dir, out_fname_root+'._metadataxml')
-		if not os.path.isfile(metaFilePath) or self.overwrite:
-			logging.info('...extracting metadata in xml format: %s' % metaFilePath)
-			with open(metaFilePath, 'w') as fmeta:
-				subprocess.call(['ncks', '--xml', '-m', '-M', resource['local_paths'][0]], stdout=fmeta)
-			self.created += 1
-			self.bytes += os.path.getsize(metaFilePath)
-			upload_to_dataset(connector, host, secret_key, resource['parent']['id'], metaFilePath)
-
-		metaFilePath = os.path.join(out_dir, out_fname_root+'._metadata.json')
-		if not os.path.isfile(metaFilePath) or self.overwrite:
-			logging.info('...extracting metadata in json format: %s' % metaFilePath)
-			with open(metaFilePath, 'w') as fmeta:
-				subprocess.call(['ncks', '--jsn', '-m', '-M', resource['local_paths'][0]], stdout=fmeta)
-			self.created += 1
-			self.bytes += os.path.getsize(metaFilePath)
-			upload_to_dataset(connector, host, secret_key, resource['parent']['id'], metaFilePath)
-
-			# Add json metadata to original netCDF file
-			with open(metaFilePath, 'r') as metajson:
-				metadata = build_metadata(host, self.extractor_info, resource['id'],
-																json.load(metajson), 'dataset')
-				upload_metadata(connector, host, secret_key, resource['parent']['id'], metadata)
+		# Unchanged sources are skipped even when overwriting; changed ones are always redone
+		cache = OutputCache.for_outputs(out_dir, out_fname_root)
+		outputs = self.output_paths(out_dir, out_fname_root)
+		if cache.is_current(nc_path, outputs, self.output_version()):
+			logging.info('...metadata outputs are current for %s; skipping' % nc_path)
+			metrics.count("outputs_current")
+			logging.info(metrics.message_summary())
+			self.end_message()
+			return
+		source_fp = fingerprint(nc_path)
+		stale = cache.exists()
+
+		todo = []
+		for fmt, suffix, flag in METADATA_OUTPUTS:
+			metaFilePath = os.path.join(out_dir, out_fname_root+suffix)
+			if not os.path.isfile(metaFilePath) or self.overwrite or stale:
+				todo.append((fmt, metaFilePath))
+
+		if todo:
+			start = time.time()
+			header = None if self.use_ncks else self.read_header(nc_path)
 
+			# Each format is rendered and uploaded on its own thread as soon as it is ready,
+			# through the thread-safe client with its retries rather than the connector
+			client = get_client(host, secret_key, verify=getattr(connector, 'ssl_verify', True))
+			pool = ThreadPool(min(self.pipeline_threads, len(todo)))
+			try:
+				results = [pool.apply_async(self.produce_output,
+											(client, connector, host, resource, nc_path, fmt, metaFilePath, header,
+											 message))
+						   for fmt, metaFilePath in todo]
+				# counted here, on the message's own thread, for end_message
+				for r in results:
+					self.created += 1
+					self.bytes += r.get()
+			finally:
+				pool.close()
+				pool.join()
+			logging.info('...%s metadata outputs finished in %.2fs' % (len(todo), time.time() - start))
 
+		cache.record(source_fp, outputs, self.output_version())
+		logging.info(metrics.message_summary())
 		self.end_message()
 
+	def preload(self):
+		"""Import what the first message would, so pre-forked workers start warm."""
+		if not self.use_ncks:
+			nc_header.load()
+
+	def post_fork(self, slot):
+		"""Serve a pre-forked worker's own metrics on the metrics port plus its slot."""
+		if self.args.metrics_port:
+			metrics.start_exporter(self.args.metrics_port + slot, self.extractor_info['name'])
+
+	def output_paths(self, out_dir, out_fname_root):
+		return [os.path.join(out_dir, out_fname_root+suffix) for fmt, suffix, flag in METADATA_OUTPUTS]
+
+	def output_version(self):
+		"""Identify what generated the outputs, so a new extractor version or mode regenerates them."""
+		return "%s/%s" % (self.extractor_info['version'], "ncks" if self.use_ncks else "native")
+
+	def remapMountPath(self, connector, path):
+		return remap_mount_path(connector, path)
+
+	def read_header(self, nc_path):
+		"""Return the parsed header of nc_path, or None if ncks has to be used instead."""
+		start = time.time()
+		try:
+			with metrics.timer("read_header"):
+				header = nc_header.read_header(nc_path)
+		except Exception as e:
+			logging.warning('...reading header in-process failed, using ncks: %s' % str(e))
+			return None
+		logging.info('...read header in %.2fs' % (time.time() - start))
+		return header
+
+	def produce_output(self, client, connector, host, resource, nc_path, fmt, metaFilePath, header, message=None):
+		"""Render one metadata format and upload it, logging the time spent in each stage. Returns its size."""
+		metrics.attach(message)
+		start = time.time()
+		logging.info('...extracting metadata in %s format: %s' % (fmt, metaFilePath))
+		doc = self.extract_metadata(nc_path, fmt, metaFilePath, header)
+		rendered = time.time()
+
+		metadata_upload = None
+		if fmt == 'json':
+			# Add json metadata to original netCDF file while the file itself uploads
+			metadata_upload = BackgroundCall(self.upload_json_metadata, client, host, resource, doc)
+
+		client.upload_to_dataset(resource['parent']['id'], metaFilePath, getattr(connector, 'mounted_paths', None))
+		logging.info('...%s: rendered in %.2fs, uploaded in %.2fs' % (fmt, rendered - start, time.time() - rendered))
+
+		if metadata_upload:
+			metadata_upload.wait()
+		return os.path.getsize(metaFilePath)
+
+	def upload_json_metadata(self, client, host, resource, doc):
+		start = time.time()
+		metadata = build_metadata(host, self.extractor_info, resource['id'], doc, 'dataset')
+		client.upload_metadata(resource['parent']['id'], metadata)
+		logging.info('...json: metadata uploaded in %.2fs' % (time.time() - start))
+
+	def extract_metadata(self, nc_path, fmt, out_path, header=None):
+		"""Write the header of nc_path in fmt to out_path, rendering the parsed header if given.
+
+		For json, returns the part of the document that fits the metadata budget.
+		"""
+		if header is not None:
+			with metrics.timer("render_" + fmt):
+				nc_header.write(nc_header.render(header, fmt, nc_path), out_path)
+			if fmt == 'json':
+				return json_budget.prune(nc_header.to_json(header), self.json_budget)
+			return None
+
+		flag = [f for (name, suffix, f) in METADATA_OUTPUTS if name == fmt][0]
+		if fmt == 'json':
+			# Parse the ncks output as it is written instead of loading the whole file back
+			with metrics.timer("ncks_json"):
+				proc = subprocess.Popen(['ncks', flag, '-m', '-M', nc_path], stdout=subprocess.PIPE)
+				try:
+					doc = json_budget.stream_to_file(proc.stdout, out_path, self.json_budget)
+				finally:
+					proc.stdout.close()
+					proc.wait()
+			return doc
+
+		with open(out_path, 'w') as fmeta, metrics.timer("ncks_" + fmt):
+			subprocess.call(['ncks', flag, '-m', '-M', nc_path], stdout=fmeta)
+		return None
+
+	def extract_local(self, nc_path):
+		"""Write the metadata outputs next to nc_path without uploading them.
+
+		Returns (nc_path, output paths, whether anything was regenerated).
+		"""
+		out_dir = os.path.dirname(nc_path)
+		out_fname_root = os.path.basename(nc_path).replace('.nc', '')
+		cache = OutputCache.for_outputs(out_dir, out_fname_root)
+		outputs = self.output_paths(out_dir, out_fname_root)
+		if cache.is_current(nc_path, outputs, self.output_version()):
+			return (nc_path, outputs, False)
+
+		source_fp = fingerprint(nc_path)
+		header = None if self.use_ncks else self.read_header(nc_path)
+		for (fmt, suffix, flag), out_path in zip(METADATA_OUTPUTS, outputs):
+			self.extract_metadata(nc_path, fmt, out_path, header)
+		cache.record(source_fp, outputs, self.output_version())
+		return (nc_path, outputs, True)
+
+	def run_batch(self):
+		"""Extract every .nc file under --batch_dir in a process pool, then optionally register with Clowder."""
+		args = self.args
+		checkpoint = Checkpoint(args.batch_checkpoint or os.path.join(args.batch_dir, '.terra_netcdf_checkpoint'))
+		files = [f for f in find_nc_files(args.batch_dir, args.batch_start or None, args.batch_end or None)]
+		todo = [f for f in files if not checkpoint.is_done('extracted', f)]
+		logging.info('batch: %s .nc files found, %s already extracted' % (len(files), len(files) - len(todo)))
+
+		global _batch_extractor
+		_batch_extractor = self
+		start = time.time()
+		extracted = regenerated = failed = 0
+		pool = multiprocessing.Pool(max(1, args.batch_processes))
+		try:
+			for nc_path, outputs, changed in pool.imap_unordered(_batch_extract, todo, chunksize=4):
+				if outputs is None:
+					failed += 1
+					continue
+				checkpoint.mark('extracted', nc_path)
+				extracted += 1
+				regenerated += 1 if changed else 0
+				if extracted % 1000 == 0:
+					logging.info('batch: %s files extracted (%.1f files/sec)' % (extracted, extracted / (time.time() - start)))
+		finally:
+			pool.close()
+			pool.join()
+		elapsed = time.time() - start
+		logging.info('batch: extracted %s files (%s regenerated, %s failed) in %.1fs, %.1f files/sec' %
+					 (extracted, regenerated, failed, elapsed, extracted / elapsed if elapsed else 0))
+
+		if args.register:
+			client = ClowderClient(args.clowder_host, args.clowder_key, max(1, args.register_threads))
+			registrar = ClowderRegistrar(client, args.dataset_prefix, self.extractor_info, self.json_budget)
+			pending = [f for f in files if checkpoint.is_done('extracted', f) and not checkpoint.is_done('registered', f)]
+
+			def register(nc_path):
+				try:
+					out_dir = os.path.dirname(nc_path)
+					if registrar.register(nc_path, self.output_paths(out_dir, os.path.basename(nc_path).replace('.nc', ''))):
+						checkpoint.mark('registered', nc_path)
+						return True
+				except Exception as e:
+					logging.error('batch: registering %s failed: %s' % (nc_path, str(e)))
+				return False
+
+			start = time.time()
+			threads = ThreadPool(max(1, args.register_threads))
+			try:
+				registered = sum(1 for ok in threads.imap_unordered(register, pending) if ok)
+			finally:
+				threads.close()
+				threads.join()
+			elapsed = time.time() - start
+			logging.info('batch: registered %s of %s files in %.1fs, %.1f files/sec' %
+						 (registered, len(pending), elapsed, registered / elapsed if elapsed else 0))
+			logging.info(client.summary())
+			client.close()
+
+		checkpoint.close()
+
+
+# set before the batch pool forks so workers can reach the configured extractor
+_batch_extractor = None
+
+def _batch_extract(nc_path):
+	try:
+		return _batch_extractor.extract_local(nc_path)
+	except Exception as e:
+		logging.error('batch: extracting %s failed: %s' % (nc_path, str(e)))
+		return (nc_path, None, False)
+
+class BackgroundCall(threading.Thread):
+	"""Run func(*args) on its own thread; wait() re-raises anything it raised."""
+	def __init__(self, func, *args):
+		super(BackgroundCall, self).__init__()
+		self.daemon = True
+		self.func = func
+		self.args = args
+		self.error = None
+		self.message = metrics.current()
+		self.start()
+
+	def run(self):
+		metrics.attach(self.message)
+		try:
+			self.func(*self.args)
+		except Exception as e:
+			self.error = e
+
+	def wait(self):
+		self.join()
+		if self.error is not None:
+			raise self.error
+
 if __name__ == "__main__":
 	extractor = NetCDFMetadataConversion()
-	extractor.start()
+	if extractor.args.batch_dir:
+		extractor.run_batch()
+	elif extractor.args.prefork_socket:
+		serve_prefork(extractor, extractor.args.prefork_socket, extractor.args.prefork_workers)
+	elif extractor.args.workers > 1:
+		run_workers(extractor, extractor.args.workers, extractor.args.prefetch)
+	else:
+		extractor.start()
@@ -1,21 +1,50 @@
 #!/usr/bin/env python
 
 import os
+import sys
+import json
 import requests
 import logging
 
 from pyclowder.utils import CheckMessage
-from pyclowder.datasets import upload_metadata, download_metadata, submit_extraction
-from pyclowder.files import download_info
-from terrautils.extractors import TerrarefExtractor, delete_dataset_metadata, load_json_file, upload_to_dataset
+from pyclowder.datasets import upload_metadata, download_metadata
+from terrautils.extractors import TerrarefExtractor, delete_dataset_metadata, load_json_file
+
+# modules shared between extractors live in ../common in a repository checkout
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+from dirindex import DirectoryIndex
+from clowder_client import get_client
+from pathremap import remap_mount_path, remap_mount_paths
+from verify import verify_files_created
+from worker_pool import run_workers, PerThreadStats
+from upload import DatasetUploader
+import metrics
+
+download_metadata = metrics.timed(download_metadata)
 
 
 def add_local_arguments(parser):
 	# add any additional arguments to parser
 	parser.add_argument('--callback', default=os.getenv('CALLBACK_EXTRACTOR', ""),
 						help="user ID to use as creator of metadata")
-
-class RepairLemnatecDatasets(TerrarefExtractor):
+	parser.add_argument('--dirindex', default=os.getenv('DIRECTORY_INDEX', ""),
+						help="SQLite directory index used to find target files without listing directories")
+	parser.add_argument('--metrics_port', type=int, default=os.getenv('METRICS_PORT', 0),
+						help="port serving Prometheus metrics on /metrics (0 = off)")
+	parser.add_argument('--workers', type=int, default=os.getenv('EXTRACTOR_WORKERS', 1),
+						help="number of messages processed at the same time (1 = pyclowder's one at a time)")
+	parser.add_argument('--prefetch', type=int, default=os.getenv('EXTRACTOR_PREFETCH', 0),
+						help="number of messages fetched ahead when workers > 1 (default: 2 x workers)")
+	parser.add_argument('--http_threads', type=int, default=os.getenv('CLOWDER_HTTP_THREADS', 8),
+						help="number of Clowder requests in flight at once")
+	parser.add_argument('--stat_threads', type=int, default=os.getenv('VERIFY_STAT_THREADS', 16),
+						help="number of created files checked on disk at the same time")
+	parser.add_argument('--upload_chunk_mb', type=int, default=os.getenv('UPLOAD_CHUNK_MB', 8),
+						help="size of the chunks raw files are uploaded in, where Clowder supports chunked uploads")
+	parser.add_argument('--upload_retries', type=int, default=os.getenv('UPLOAD_RETRIES', 5),
+						help="number of times a failed upload chunk or file is retried")
+
+class RepairLemnatecDatasets(PerThreadStats, TerrarefExtractor):
 	def __init__(self):
 		super(RepairLemnatecDatasets, self).__init__()
 
@@ -26,6 +55,13 @@ class RepairLemnatecDatasets(TerrarefExtractor):
 
 		# assign local arguments
 		self.callback = self.args.callback
+		self.dirindex = DirectoryIndex(self.args.dirindex) if self.args.dirindex else None
+		self.http_threads = int(self.args.http_threads)
+		self.stat_threads = int(self.args.stat_threads)
+		self.upload_chunk_size = int(self.args.upload_chunk_mb) * 1024 * 1024
+		self.upload_retries = int(self.args.upload_retries)
+		if self.args.metrics_port:
+			metrics.start_exporter(self.args.metrics_port, self.extractor_info['name'])
 
 	# Check whether dataset has geospatial metadata
 	def check_message(self, connector, host, secret_key, resource, parameters):
@@ -34,8 +70,10 @@ class RepairLemnatecDatasets(TerrarefExtractor):
 	# Process the file and upload the results
 	def process_message(self, connector, host, secret_key, resource, parameters):
 		self.start_message()
+		metrics.start_message()
 
 		sensor_type, timestamp = resource['name'].split(" - ")
+		client = get_client(host, secret_key, self.http_threads, getattr(connector, 'ssl_verify', True))
 		targets = self.get_targets_by_sensor(sensor_type)
 		source = self.get_source_by_sensor(sensor_type)
 		existing_files = {}
@@ -55,30 +93,25 @@ class RepairLemnatecDatasets(TerrarefExtractor):
 				if 'extractor_id' in md['agent'] and md['agent']['extractor_id'].endswith(source):
 					# Found bin2tif metadata - are previously created files valid?
 					logging.getLogger(__name__).info("Found metadata from %s" % source)
-					for url in md['content']['files_created']:
-						fid = url.split("/")[-1]
-						i = download_info(connector, host, secret_key, fid)
-						i = self.remapMountPath(connector, i['filepath'])
-						logging.getLogger(__name__).info("Checking validity of %s" % i)
-						if not os.path.isfile(i):
-							# Found invalid file - nuke the entire site from orbit
-							logging.getLogger(__name__).info("Invalid; deleting metadata")
-							self.delete_dataset_metadata(host, self.clowder_user, self.clowder_pass, resource['id'], source)
-
-							# Now trigger a callback extraction if given
-							if len(self.callback) > 0:
-								logging.getLogger(__name__).info("Submitting callback extraction to %s" % self.callback)
-								submit_extraction(connector, host, secret_key, resource['id'], self.callback)
-							else:
-								callbacks = self.get_callbacks_by_sensor(sensor_type)
-								if callbacks:
-									for c in callbacks:
-										logging.getLogger(__name__).info("Submitting callback extraction to %s" % c)
-										submit_extraction(connector, host, secret_key, resource['id'], c)
-								else:
-									logging.getLogger(__name__).info("No default callback found for %s" % sensor_type)
-
-							break
+					with metrics.timer("verify_files_created"):
+						report = verify_files_created(client, resource['id'], md['content']['files_created'],
+													  lambda paths: remap_mount_paths(connector, paths), self.stat_threads)
+					logging.getLogger(__name__).info("Checked validity of created files: %s" % report.summary())
+					for fid, path in report.missing:
+						logging.getLogger(__name__).info("Missing %s" % path)
+					for fid in report.deleted:
+						logging.getLogger(__name__).info("File %s not found in Clowder" % fid)
+					for fid in report.unresolved:
+						logging.getLogger(__name__).info("No file path found for %s; not checked" % fid)
+
+					if not report.is_valid():
+						# Found invalid file - nuke the entire site from orbit
+						logging.getLogger(__name__).info("Invalid; deleting metadata")
+						self.delete_dataset_metadata(host, self.clowder_user, self.clowder_pass, resource['id'], source)
+
+						# Now trigger a callback extraction if given
+						self.submit_callbacks(client, resource['id'], sensor_type)
+						break
 
 		else:
 			# Search for target source files
@@ -90,46 +123,53 @@ class RepairLemnatecDatasets(TerrarefExtractor):
 			logging.getLogger(__name__).info("Searching for target files in %s" % source_dir)
 
 			if os.path.isdir(source_dir):
-				targ_files = {}
-				for f in os.listdir(source_dir):
-					for t in targets:
-						if f.endswith(t):
-							targ_files[t] = os.path.join(source_dir, f)
-							break
+				with metrics.timer("find_targets"):
+					if self.dirindex:
+						targ_files = self.dirindex.find_targets(source_dir, targets)
+					else:
+						targ_files = {}
+						for f in os.listdir(source_dir):
+							for t in targets:
+								if f.endswith(t):
+									targ_files[t] = os.path.join(source_dir, f)
+									break
 
 				if targ_files != {}:
-					for t in targ_files:
-						logging.getLogger(__name__).info("Uploading %s" % (targ_files[t]))
-						upload_to_dataset(connector, host, self.clowder_user, self.clowder_pass, resource['id'], targ_files[t])
+					uploader = DatasetUploader(client, self.upload_chunk_size, self.upload_retries)
+					# files left by an earlier, interrupted run are not uploaded again
+					dataset_files = client.get_file_list(resource['id'])
+
+					def upload(path):
+						logging.getLogger(__name__).info("Uploading %s" % path)
+						uploader.upload(resource['id'], path, dataset_files)
+					client.map(upload, targ_files.values())
+					logging.getLogger(__name__).info(uploader.summary())
 
 					# Now trigger a callback extraction if given
-					if len(self.callback) > 0:
-						logging.getLogger(__name__).info("Submitting callback extraction to %s" % self.callback)
-						submit_extraction(connector, host, secret_key, resource['id'], self.callback)
-					else:
-						callbacks = self.get_callbacks_by_sensor(sensor_type)
-						if callbacks:
-							for c in callbacks:
-								logging.getLogger(__name__).info("Submitting callback extraction to %s" % c)
-								submit_extraction(connector, host, secret_key, resource['id'], c)
-						else:
-							logging.getLogger(__name__).info("No default callback found for %s" % sensor_type)
+					self.submit_callbacks(client, resource['id'], sensor_type)
 				else:
 					logging.getLogger(__name__).error("targets not found in %s" % source_dir)
 
 			else:
 				logging.getLogger(__name__).info("%s could not be found" % source_dir)
 
+		logging.getLogger(__name__).info(metrics.message_summary())
 		#self.end_message()
 
 	def remapMountPath(self, connector, path):
-		if len(connector.mounted_paths) > 0:
-			for source_path in connector.mounted_paths:
-				if path.startswith(source_path):
-					return path.replace(source_path, connector.mounted_paths[source_path])
-			return path
+		return remap_mount_path(connector, path)
+
+	def submit_callbacks(self, client, dataset_id, sensor_type):
+		"""Submit the dataset to --callback if given, otherwise to the standard extractors for the sensor."""
+		if len(self.callback) > 0:
+			callbacks = [self.callback]
 		else:
-			return path
+			callbacks = self.get_callbacks_by_sensor(sensor_type)
+		if callbacks:
+			logging.getLogger(__name__).info("Submitting callback extractions to %s" % ", ".join(callbacks))
+			client.submit_extractions(dataset_id, callbacks)
+		else:
+			logging.getLogger(__name__).info("No default callback found for %s" % sensor_type)
 
 	def get_callbacks_by_sensor(self, sensor_type):
 		"""Return list of standard extractors to trigger based on input sensor."""
@@ -181,6 +221,10 @@ class RepairLemnatecDatasets(TerrarefExtractor):
 			return None
 
 	def delete_dataset_metadata(self, host, clowder_user, clowder_pass, datasetid, ext):
+		with metrics.timer("delete_dataset_metadata"):
+			return self._delete_dataset_metadata(host, clowder_user, clowder_pass, datasetid, ext)
+
+	def _delete_dataset_metadata(self, host, clowder_user, clowder_pass, datasetid, ext):
 		url = "%sapi/datasets/%s/metadata.jsonld?extractor=%s" % (host, datasetid, ext)
 
 		result = requests.delete(url, stream=True, auth=(clowder_user, clowder_pass))
@@ -190,4 +234,7 @@ class RepairLemnatecDatasets(TerrarefExtractor):
 
 if __name__ == "__main__":
 	extractor = RepairLemnatecDatasets()
-	extractor.start()
+	if extractor.args.workers > 1:
+		run_workers(extractor, extractor.args.workers, extractor.args.prefetch)
+	else:
+		extractor.start()
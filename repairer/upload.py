@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+"""Streaming, resumable uploads of raw files to a Clowder dataset.
+
+Files are sent straight from the mount in blocks instead of being read into
+memory. Where the server offers chunked uploads (POST api/uploads, PUT
+api/uploads/<id> with a Content-Range, GET api/uploads/<id> for the
+acknowledged offset, POST api/uploads/<id>/complete), a failed chunk is
+resumed from the last acknowledged offset instead of resending the file.
+Elsewhere the file is streamed as one multipart upload to
+api/uploadToDataset, retried from the start unless the failed attempt left the
+file in the dataset. Files whose name, size and checksum match a file already
+in the dataset are not uploaded again.
+"""
+
+import hashlib
+import io
+import logging
+import os
+import threading
+import time
+import uuid
+
+import requests
+
+import metrics
+from clowder_client import not_sent
+
+
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# checksum fields Clowder may report for a file, strongest first
+CHECKSUM_FIELDS = ("sha512", "md5")
+
+# host -> whether it offers chunked uploads, learned from the first attempt
+_chunked_support = {}
+
+
+def file_checksum(path, algorithm="sha512", block_size=1024 * 1024):
+	"""Hex digest of a file, read in blocks."""
+	digest = hashlib.new(algorithm)
+	with open(path, 'rb') as f:
+		block = f.read(block_size)
+		while block:
+			digest.update(block)
+			block = f.read(block_size)
+	return digest.hexdigest()
+
+
+class FileSlice(object):
+	"""Read-only view of length bytes of a file from offset, with a length requests can send as Content-Length."""
+
+	def __init__(self, path, offset, length):
+		self.f = open(path, 'rb')
+		self.f.seek(offset)
+		self.remaining = length
+
+	def __len__(self):
+		return self.remaining
+
+	def read(self, size=-1):
+		if size is None or size < 0 or size > self.remaining:
+			size = self.remaining
+		data = self.f.read(size)
+		self.remaining -= len(data)
+		return data
+
+	def close(self):
+		self.f.close()
+
+
+class MultipartFile(object):
+	"""multipart/form-data body holding one file, streamed from disk with a known length."""
+
+	def __init__(self, path, field="File"):
+		self.boundary = uuid.uuid4().hex
+		head = ('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n'
+				'Content-Type: application/octet-stream\r\n\r\n' % (
+					self.boundary, field, os.path.basename(path))).encode('utf-8')
+		tail = ('\r\n--%s--\r\n' % self.boundary).encode('utf-8')
+		self.length = len(head) + os.path.getsize(path) + len(tail)
+		self.parts = [io.BytesIO(head), open(path, 'rb'), io.BytesIO(tail)]
+
+	@property
+	def content_type(self):
+		return "multipart/form-data; boundary=%s" % self.boundary
+
+	def __len__(self):
+		return self.length
+
+	def read(self, size=-1):
+		chunks = []
+		while self.parts and (size is None or size < 0 or size > 0):
+			data = self.parts[0].read(size if size is not None and size > 0 else -1)
+			if not data:
+				self.parts.pop(0).close()
+				continue
+			chunks.append(data)
+			if size is not None and size > 0:
+				size -= len(data)
+		data = b"".join(chunks)
+		self.length -= len(data)
+		return data
+
+	def close(self):
+		for part in self.parts:
+			part.close()
+		self.parts = []
+
+
+class DatasetUploader(object):
+	"""Upload files to Clowder datasets through a ClowderClient, skipping files already there."""
+
+	def __init__(self, client, chunk_size=CHUNK_SIZE, retries=5, backoff=1.0):
+		self.client = client
+		self.chunk_size = max(1, chunk_size)
+		self.retries = retries
+		self.backoff = backoff
+		self.lock = threading.Lock()
+		self.counts = {"skipped": 0, "chunked": 0, "multipart": 0, "resumed": 0, "bytes": 0}
+
+	def count(self, key, n=1):
+		with self.lock:
+			self.counts[key] += n
+
+	def upload(self, dataset_id, path, existing=()):
+		"""Upload path to the dataset unless an entry of existing (its file list) matches; returns the file id."""
+		name = os.path.basename(path)
+		size = os.path.getsize(path)
+		match = self.find_existing(path, name, size, existing)
+		if match:
+			logging.getLogger(__name__).info("%s already in dataset as %s; skipping" % (name, match))
+			self.count("skipped")
+			metrics.count("uploads_skipped")
+			return match
+
+		if _chunked_support.get(self.client.host) is not False:
+			file_id = self.upload_chunked(dataset_id, path, name, size)
+			if file_id is not None:
+				_chunked_support[self.client.host] = True
+				self.count("chunked")
+				return file_id
+			_chunked_support[self.client.host] = False
+		file_id = self.upload_multipart(dataset_id, path, name, size)
+		self.count("multipart")
+		return file_id
+
+	def find_existing(self, path, name, size, existing):
+		"""Return the id of a dataset file with the same name, size and checksum as path, or None."""
+		checksums = {}
+		for f in existing:
+			if f.get('filename') != name or int(f.get('size', -1)) != size:
+				continue
+			info = f
+			if not any(info.get(field) for field in CHECKSUM_FIELDS):
+				info = self.client.download_info(f['id'])
+			for field in CHECKSUM_FIELDS:
+				if info.get(field):
+					if field not in checksums:
+						with metrics.timer("upload_checksum"):
+							checksums[field] = file_checksum(path, field)
+					if checksums[field] == info[field].lower():
+						return f['id']
+					break
+		return None
+
+	def _failed(self, error, failures, what):
+		"""Raise error if it is not worth retrying, else wait before the next attempt."""
+		status = getattr(getattr(error, 'response', None), 'status_code', None)
+		if status is not None and status < 500:
+			raise error
+		if failures > self.retries:
+			raise error
+		delay = self.backoff * (2 ** (failures - 1))
+		metrics.count("upload_retries")
+		logging.getLogger(__name__).warning("%s failed (%s); retry %s in %.1fs" % (what, error, failures, delay))
+		time.sleep(delay)
+
+	def upload_chunked(self, dataset_id, path, name, size):
+		"""Upload path in chunks, resuming from the acknowledged offset after a failure. None if unsupported."""
+		try:
+			# starting again resumes the same upload, so this POST is safe to retry
+			start = self.client.request('POST', 'uploads', "upload_start", retries=self.retries, json={
+				"dataset_id": dataset_id, "filename": name, "size": size,
+				"modified": int(os.path.getmtime(path))}).json()
+		except requests.HTTPError as e:
+			if e.response is not None and e.response.status_code in (404, 405, 501):
+				return None
+			raise
+		upload_id = start['id']
+		offset = int(start.get('offset', 0))
+		if offset:
+			logging.getLogger(__name__).info("resuming %s at byte %s of %s" % (name, offset, size))
+			self.count("resumed")
+
+		failures = 0
+		while offset < size:
+			length = min(self.chunk_size, size - offset)
+			body = FileSlice(path, offset, length)
+			try:
+				result = self.client.request('PUT', 'uploads/%s' % upload_id, "upload_chunk", retries=0, data=body,
+											 headers={'Content-Type': 'application/octet-stream',
+													  'Content-Range': 'bytes %d-%d/%d' % (offset, offset + length - 1, size)})
+				self.count("bytes", length)
+				offset = int(result.json()['offset'])
+				failures = 0
+			except (requests.ConnectionError, requests.HTTPError) as e:
+				if getattr(e, 'response', None) is not None and e.response.status_code == 409:
+					# the server holds a different offset than we sent from
+					offset = int(e.response.json()['offset'])
+					continue
+				failures += 1
+				self._failed(e, failures, "chunk %s-%s of %s" % (offset, offset + length, name))
+				offset = int(self.client.request('GET', 'uploads/%s' % upload_id, "upload_status").json()['offset'])
+				self.count("resumed")
+				metrics.count("upload_resumes")
+			finally:
+				body.close()
+
+		result = self.client.request('POST', 'uploads/%s/complete' % upload_id, "upload_complete",
+									 params={'extract': 'true'})
+		return result.json()['id']
+
+	def upload_multipart(self, dataset_id, path, name, size):
+		"""Stream path to api/uploadToDataset, retrying the whole file on failure.
+
+		A failed POST may still have stored the file, so before each retry the
+		dataset is checked for it unless the request never reached Clowder.
+		"""
+		failures = 0
+		while True:
+			body = MultipartFile(path)
+			try:
+				result = self.client.request('POST', 'uploadToDataset/%s' % dataset_id, "upload_to_dataset",
+											 retries=0, params={'extract': 'true'}, data=body,
+											 headers={'Content-Type': body.content_type})
+				self.count("bytes", size)
+				return result.json()['id']
+			except (requests.ConnectionError, requests.HTTPError) as e:
+				failures += 1
+				status = getattr(getattr(e, 'response', None), 'status_code', None)
+				if (status is None or status >= 500) and not not_sent(e):
+					match = self.find_existing(path, name, size, self.client.get_file_list(dataset_id))
+					if match:
+						logging.getLogger(__name__).info("%s was stored by the failed upload as %s" % (name, match))
+						return match
+				self._failed(e, failures, "upload of %s" % name)
+			finally:
+				body.close()
+
+	def summary(self):
+		with self.lock:
+			c = dict(self.counts)
+		return "uploads: %s chunked, %s multipart, %s skipped, %s resumed, %.1f MB sent" % (
+			c["chunked"], c["multipart"], c["skipped"], c["resumed"], c["bytes"] / 1048576.0)
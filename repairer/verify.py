@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+"""Check that the files an extractor reported creating still exist on disk."""
+
+import os
+from multiprocessing.pool import ThreadPool
+
+
+class VerificationReport(object):
+	"""Outcome of a files_created check.
+
+	valid and missing hold (file id, local path) pairs; deleted holds the ids
+	Clowder answers 404 for; unresolved holds the ids Clowder has no path for,
+	which can't be checked and don't make the files invalid.
+	"""
+
+	def __init__(self):
+		self.valid = []
+		self.missing = []
+		self.deleted = []
+		self.unresolved = []
+
+	def is_valid(self):
+		return not self.missing and not self.deleted
+
+	def summary(self):
+		return "%s valid, %s missing, %s deleted, %s unresolved" % (
+			len(self.valid), len(self.missing), len(self.deleted), len(self.unresolved))
+
+
+def verify_files_created(client, dataset_id, urls, remap_many, threads=16):
+	"""Resolve the files_created URLs of a dataset to local paths and stat them all concurrently.
+
+	File paths come from a single dataset file listing; every other id, such as
+	outputs in a separate Level_1 dataset, is looked up individually,
+	concurrently. remap_many(paths) converts a list of Clowder paths to the
+	local mount.
+	"""
+	file_ids = [url.rstrip("/").split("/")[-1] for url in urls]
+	report = VerificationReport()
+	if not file_ids:
+		return report
+
+	paths = {}
+	for f in client.get_file_list(dataset_id):
+		if f.get('filepath'):
+			paths[f['id']] = f['filepath']
+
+	deleted = set()
+	lookup = [fid for fid in file_ids if fid not in paths]
+	for fid, info in zip(lookup, client.download_info_many(lookup, missing_ok=True)):
+		if info is None:
+			deleted.add(fid)
+		elif info.get('filepath'):
+			paths[fid] = info['filepath']
+
+	found = [fid for fid in file_ids if fid in paths]
+	report.deleted = [fid for fid in file_ids if fid in deleted]
+	report.unresolved = [fid for fid in file_ids if fid not in paths and fid not in deleted]
+	resolved = list(zip(found, remap_many([paths[fid] for fid in found])))
+
+	pool = ThreadPool(max(1, min(threads, len(resolved) or 1)))
+	try:
+		exists = pool.map(os.path.isfile, [p for fid, p in resolved])
+	finally:
+		pool.close()
+		pool.join()
+	for entry, ok in zip(resolved, exists):
+		(report.valid if ok else report.missing).append(entry)
+	return report
@@ -0,0 +1,59 @@
+# bench_plotquery.py: compare plotQuery() in a loop against plotQueryBatch()
+# Usage: python bench_plotquery.py shpfile [num_points] [num_distinct]
+# Points are drawn at random around the plots of the shapefile; num_distinct
+# limits how many different positions are used, like repeated gantry captures.
+# When the shapefile has a compiled plot cache (plotcache.py), its load time and
+# batch lookups are compared with the OGR index too.
+import sys, time
+import numpy
+from plotid_by_latlon import getPlotIndex, plotQuery, plotQueryBatch
+from plotcache import PlotCache
+
+
+def randomPoints(shpFile, n, distinct):
+    # sample within the lon/lat span of the plot centroids
+    plots = getPlotIndex(shpFile, useCache=False).state[0]
+    lats = [p["point"][0] for p in plots]
+    lons = [p["point"][1] for p in plots]
+    rng = numpy.random.RandomState(42)
+    base_lons = rng.uniform(min(lons), max(lons), distinct)
+    base_lats = rng.uniform(min(lats), max(lats), distinct)
+    pick = rng.randint(0, distinct, n)
+    return base_lons[pick], base_lats[pick]
+
+
+if __name__ == '__main__':
+    shpFile = sys.argv[1]
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    distinct = int(sys.argv[3]) if len(sys.argv) > 3 else n
+
+    start = time.time()
+    getPlotIndex(shpFile, useCache=False)
+    print "index load:  %.3fs" % (time.time() - start)
+
+    lons, lats = randomPoints(shpFile, n, distinct)
+
+    start = time.time()
+    loop = [plotQuery(shpFile, lon, lat) for lon, lat in zip(lons, lats)]
+    loop_t = time.time() - start
+    print "plotQuery loop:  %d points in %.3fs (%.0f points/s)" % (n, loop_t, n / loop_t)
+
+    start = time.time()
+    plotids, c_lats, c_lons, contained = plotQueryBatch(shpFile, lons, lats)
+    batch_t = time.time() - start
+    print "plotQueryBatch:  %d points in %.3fs (%.0f points/s)" % (n, batch_t, n / batch_t)
+    print "speedup: %.1fx" % (loop_t / batch_t)
+
+    mismatches = sum(1 for r, p in zip(loop, plotids) if (r["plot"] if r else None) != p)
+    print "mismatched plot ids: %d" % mismatches
+
+    start = time.time()
+    cache = PlotCache(shpFile)
+    if cache.state is not None:
+        print "plot cache load:  %.4fs" % (time.time() - start)
+        start = time.time()
+        cache_ids, cache_lats, cache_lons, cache_contained = cache.lookupMany(lons, lats)
+        cache_t = time.time() - start
+        print "plot cache batch:  %d points in %.3fs (%.0f points/s)" % (n, cache_t, n / cache_t)
+        print "plot cache mismatches: %d ids, %d contained" % (
+            numpy.count_nonzero(cache_ids != plotids), numpy.count_nonzero(cache_contained != contained))
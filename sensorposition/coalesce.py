@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class MessageCoalescer(object):
+	"""Drop repeated messages for the same key that arrive within a time window.
+
+	The first message for a key is admitted and starts the window; later ones
+	are counted as duplicates until the window has passed. forget() reopens a
+	key, e.g. when processing the admitted message failed. A window of 0
+	admits every message.
+	"""
+
+	def __init__(self, window=0, max_entries=100000):
+		self.window = window
+		self.max_entries = max_entries
+		self.seen = OrderedDict()
+		self.lock = threading.Lock()
+		self.admitted = 0
+		self.dropped = 0
+
+	def _expire(self, now):
+		while self.seen:
+			key, first = next(iter(self.seen.items()))
+			if now - first < self.window and len(self.seen) <= self.max_entries:
+				break
+			self.seen.popitem(last=False)
+
+	def admit(self, key):
+		"""Return True if key should be processed, False if it is a duplicate within the window."""
+		if self.window <= 0:
+			return True
+		now = time.time()
+		with self.lock:
+			self._expire(now)
+			if key in self.seen:
+				self.dropped += 1
+				return False
+			self.seen[key] = now
+			self.admitted += 1
+			return True
+
+	def forget(self, key):
+		with self.lock:
+			self.seen.pop(key, None)
+
+	def summary(self):
+		total = self.admitted + self.dropped
+		return "message coalescing: %s admitted, %s dropped as duplicates (%.0f%%), %s datasets in window" % (
+			self.admitted, self.dropped, 100.0 * self.dropped / total if total else 0, len(self.seen))
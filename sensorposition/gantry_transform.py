@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+"""Vectorized conversion between gantry coordinates and WGS84 / UTM.
+
+A transform is fitted once from the surveyed field corners (see
+error_estimation.py) and then applied to whole NumPy arrays of gantry
+positions, instead of calling utm.from_latlon/to_latlon for every point.
+
+Gantry x runs north along the field and gantry y runs west, in meters.
+Fitting happens in a local metric frame (meters east/north of the mean
+corner position), in which WGS84 is linear to well below a millimeter over
+the size of the field, so residuals are reported in meters.
+
+Print the residuals of both models with:
+    python gantry_transform.py
+"""
+
+import math
+
+import numpy
+
+try:
+	import utm
+except ImportError:
+	utm = None
+
+
+# surveyed field corners: name, gantry (x, y) and WGS84 (lat, lon)
+CONTROL_POINTS = [
+	("SE", (3.8, 0.0), (33.0745, -111.97475)),
+	("SW", (3.8, 22.135), (33.0745666667, -111.9750833333)),
+	("NW", (207.3, 22.135), (33.0765333333, -111.9750833333)),
+	("NE", (207.3, 0.0), (33.0765166667, -111.9747833333)),
+]
+
+# WGS84 ellipsoid
+_A = 6378137.0
+_E2 = 0.00669437999014
+
+
+def _design(x, y, model):
+	x = numpy.asarray(x, dtype=numpy.float64)
+	y = numpy.asarray(y, dtype=numpy.float64)
+	if model == "affine":
+		return numpy.stack([numpy.ones_like(x), x, y], axis=-1)
+	return numpy.stack([numpy.ones_like(x), x, y, x * y], axis=-1)
+
+
+class GantryTransform(object):
+	"""Affine or bilinear gantry (x, y) -> WGS84 transform fitted from control points.
+
+	affine fits 6 parameters by least squares, so the corner residuals show how
+	far the surveyed corners are from a rigid, square gantry frame. bilinear fits
+	8 parameters and passes through all four corners exactly.
+	"""
+
+	def __init__(self, control_points=CONTROL_POINTS, model="affine"):
+		if model not in ("affine", "bilinear"):
+			raise ValueError("model must be 'affine' or 'bilinear', not %r" % model)
+		self.model = model
+		self.names = [c[0] for c in control_points]
+		self.gantry = numpy.array([c[1] for c in control_points], dtype=numpy.float64)
+		self.latlon = numpy.array([c[2] for c in control_points], dtype=numpy.float64)
+
+		# local metric frame around the mean corner
+		self.lat0, self.lon0 = self.latlon.mean(axis=0)
+		s = math.sin(math.radians(self.lat0))
+		w = 1.0 - _E2 * s * s
+		self.m_per_deg_lat = math.radians(1) * _A * (1.0 - _E2) / (w ** 1.5)
+		self.m_per_deg_lon = math.radians(1) * _A / math.sqrt(w) * math.cos(math.radians(self.lat0))
+
+		local = self._to_local(self.latlon[:, 0], self.latlon[:, 1])
+		design = _design(self.gantry[:, 0], self.gantry[:, 1], model)
+		self.coef = numpy.linalg.lstsq(design, local, rcond=-1)[0]
+
+		self.utm_zone = None
+		self.utm_coef = None
+		if utm is not None:
+			easting, northing, number, letter = [], [], None, None
+			for lat, lon in self.latlon:
+				e, n, number, letter = utm.from_latlon(lat, lon)
+				easting.append(e)
+				northing.append(n)
+			self.utm_zone = (number, letter)
+			self.utm_coef = numpy.linalg.lstsq(design, numpy.column_stack((easting, northing)), rcond=-1)[0]
+
+	def _to_local(self, lat, lon):
+		lat = numpy.asarray(lat, dtype=numpy.float64)
+		lon = numpy.asarray(lon, dtype=numpy.float64)
+		return numpy.stack([(lon - self.lon0) * self.m_per_deg_lon, (lat - self.lat0) * self.m_per_deg_lat], axis=-1)
+
+	def _from_local(self, local):
+		return (self.lat0 + local[..., 1] / self.m_per_deg_lat, self.lon0 + local[..., 0] / self.m_per_deg_lon)
+
+	def to_local(self, x, y):
+		"""Meters (east, north) of the mean corner for gantry positions, shape (..., 2)."""
+		return _design(x, y, self.model).dot(self.coef)
+
+	def to_latlon(self, x, y):
+		"""Return (lat, lon) arrays for arrays of gantry positions."""
+		return self._from_local(self.to_local(x, y))
+
+	def to_utm(self, x, y):
+		"""Return (easting, northing) arrays for gantry positions, in self.utm_zone. Needs the utm package."""
+		if self.utm_coef is None:
+			raise RuntimeError("the utm package is required for UTM output")
+		out = _design(x, y, self.model).dot(self.utm_coef)
+		return (out[..., 0], out[..., 1])
+
+	def from_latlon(self, lat, lon, iterations=5):
+		"""Return gantry (x, y) arrays for arrays of WGS84 points."""
+		local = self._to_local(lat, lon)
+		c = self.coef
+		# affine part; exact for the affine model and the starting point for bilinear
+		m = numpy.array([[c[1, 0], c[2, 0]], [c[1, 1], c[2, 1]]])
+		xy = (local - c[0]).dot(numpy.linalg.inv(m).T)
+		if self.model == "bilinear":
+			for i in range(iterations):
+				x, y = xy[..., 0], xy[..., 1]
+				r = self.to_local(x, y) - local
+				j00 = c[1, 0] + c[3, 0] * y
+				j01 = c[2, 0] + c[3, 0] * x
+				j10 = c[1, 1] + c[3, 1] * y
+				j11 = c[2, 1] + c[3, 1] * x
+				det = j00 * j11 - j01 * j10
+				xy = xy - numpy.stack([(j11 * r[..., 0] - j01 * r[..., 1]) / det,
+									   (j00 * r[..., 1] - j10 * r[..., 0]) / det], axis=-1)
+		return (xy[..., 0], xy[..., 1])
+
+	def footprints(self, x, y, fov_x, fov_y):
+		"""Return (n, 5, 2) closed [lon, lat] rings of the areas fov_x by fov_y meters centred on each position."""
+		x = numpy.asarray(x, dtype=numpy.float64).ravel()
+		y = numpy.asarray(y, dtype=numpy.float64).ravel()
+		hx = numpy.broadcast_to(numpy.asarray(fov_x, dtype=numpy.float64) / 2.0, x.shape)
+		hy = numpy.broadcast_to(numpy.asarray(fov_y, dtype=numpy.float64) / 2.0, y.shape)
+		cx = numpy.stack([x - hx, x + hx, x + hx, x - hx, x - hx], axis=1)
+		cy = numpy.stack([y - hy, y - hy, y + hy, y + hy, y - hy], axis=1)
+		lat, lon = self.to_latlon(cx, cy)
+		return numpy.stack([lon, lat], axis=-1)
+
+	def bounding_boxes(self, x, y, fov_x, fov_y):
+		"""Return (n, 4) arrays of [min lon, min lat, max lon, max lat] for each capture footprint."""
+		rings = self.footprints(x, y, fov_x, fov_y)
+		return numpy.concatenate([rings.min(axis=1), rings.max(axis=1)], axis=1)
+
+	def residuals(self):
+		"""Fit error at the control points in meters: per point (east, north) and summary statistics."""
+		fitted = self.to_local(self.gantry[:, 0], self.gantry[:, 1])
+		err = fitted - self._to_local(self.latlon[:, 0], self.latlon[:, 1])
+		dist = numpy.hypot(err[:, 0], err[:, 1])
+		gx, gy = self.from_latlon(*self.to_latlon(self.gantry[:, 0], self.gantry[:, 1]))
+		roundtrip = numpy.hypot(gx - self.gantry[:, 0], gy - self.gantry[:, 1])
+		return {
+			"model": self.model,
+			"points": dict((name, (float(e[0]), float(e[1]))) for name, e in zip(self.names, err)),
+			"mean": float(dist.mean()),
+			"rms": float(numpy.sqrt((dist ** 2).mean())),
+			"max": float(dist.max()),
+			"roundtrip_max": float(roundtrip.max())
+		}
+
+
+if __name__ == "__main__":
+	for model in ("affine", "bilinear"):
+		r = GantryTransform(model=model).residuals()
+		print("%s: mean %.3fm, rms %.3fm, max %.3fm, round trip %.2gm" % (
+			model, r["mean"], r["rms"], r["max"], r["roundtrip_max"]))
+		for name in sorted(r["points"]):
+			print("  %s: east %+.3fm, north %+.3fm" % ((name,) + r["points"][name]))
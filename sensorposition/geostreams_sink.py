@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+import atexit
+import json
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class DatapointSink(object):
+	"""Buffer geostreams datapoints and write them per stream through the bulk endpoint.
+
+	Datapoints are grouped by stream and flushed when batch_size datapoints are
+	pending or the oldest one has waited flush_interval seconds. Batches that fail
+	to post stay buffered and are retried on the next flush, up to max_attempts
+	times. Buffered datapoints are flushed on close(), which is also registered to
+	run at interpreter exit.
+
+	Each datapoint can carry a callback, called with True once its batch is
+	written or with False when it is given up, so that whatever records the
+	datapoint as done happens only after geostreams has it.
+	"""
+
+	def __init__(self, host, secret_key, batch_size=100, flush_interval=30, pool_size=4, verify=True,
+				 max_attempts=5):
+		self.host = host + ("" if host.endswith("/") else "/")
+		self.secret_key = secret_key
+		self.batch_size = max(1, int(batch_size))
+		self.flush_interval = float(flush_interval)
+		self.verify = verify
+		self.max_attempts = max(1, int(max_attempts))
+
+		self.session = requests.Session()
+		adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+		self.session.mount("http://", adapter)
+		self.session.mount("https://", adapter)
+
+		self.buffers = {}
+		self.pending = 0
+		self.oldest = None
+		self.lock = threading.Lock()
+		self.flush_lock = threading.Lock()
+
+		self.started = time.time()
+		self.written = 0
+		self.requests = 0
+		self.failures = 0
+		self.dropped = 0
+		self.flush_seconds = 0.0
+
+		self.closed = threading.Event()
+		if self.flush_interval > 0:
+			timer = threading.Thread(target=self._flush_timer, name="DatapointSink")
+			timer.daemon = True
+			timer.start()
+		atexit.register(self.close)
+
+	def add(self, stream_id, geometry, start_time, end_time, properties, on_written=None):
+		"""Queue one datapoint for stream_id, flushing if the batch is full.
+
+		on_written(ok) is called after the datapoint is written (True) or dropped (False).
+		"""
+		datapoint = {
+			"start_time": start_time,
+			"end_time": end_time,
+			"type": "Point",
+			"geometry": geometry,
+			"properties": properties,
+			"stream_id": str(stream_id)
+		}
+		with self.lock:
+			# [datapoint, callback, failed attempts]
+			self.buffers.setdefault(str(stream_id), []).append([datapoint, on_written, 0])
+			self.pending += 1
+			if self.oldest is None:
+				self.oldest = time.time()
+			full = self.pending >= self.batch_size
+		if full:
+			self.flush()
+
+	def flush(self):
+		"""Post everything buffered, one bulk request per stream and batch."""
+		with self.flush_lock:
+			with self.lock:
+				buffers, self.buffers = self.buffers, {}
+				self.pending = 0
+				self.oldest = None
+			if not buffers:
+				return
+
+			start = time.time()
+			failed = {}
+			done = []
+			for stream_id, entries in buffers.items():
+				for i in range(0, len(entries), self.batch_size):
+					batch = entries[i:i + self.batch_size]
+					if self._post(stream_id, [e[0] for e in batch]):
+						self.written += len(batch)
+						done.extend((e[1], True) for e in batch)
+						continue
+					for e in batch:
+						e[2] += 1
+						if e[2] >= self.max_attempts:
+							self.dropped += 1
+							done.append((e[1], False))
+						else:
+							failed.setdefault(stream_id, []).append(e)
+			self.flush_seconds += time.time() - start
+
+			if failed:
+				with self.lock:
+					for stream_id, entries in failed.items():
+						self.buffers[stream_id] = entries + self.buffers.get(stream_id, [])
+						self.pending += len(entries)
+					if self.oldest is None:
+						self.oldest = time.time()
+
+		for callback, ok in done:
+			if callback is None:
+				continue
+			try:
+				callback(ok)
+			except Exception:
+				logging.getLogger(__name__).exception("datapoint callback failed")
+
+	def _post(self, stream_id, datapoints):
+		url = "%sapi/geostreams/datapoints/bulk?key=%s" % (self.host, self.secret_key)
+		self.requests += 1
+		try:
+			result = self.session.post(url, headers={'Content-type': 'application/json'},
+									   data=json.dumps({"stream_id": stream_id, "datapoints": datapoints}),
+									   verify=self.verify)
+			result.raise_for_status()
+			return True
+		except requests.RequestException as e:
+			self.failures += 1
+			logging.getLogger(__name__).error("Failed to write %s datapoints to stream %s: %s" %
+											  (len(datapoints), stream_id, e))
+			return False
+
+	def _flush_timer(self):
+		while not self.closed.wait(min(self.flush_interval, 1.0)):
+			with self.lock:
+				due = self.oldest is not None and time.time() - self.oldest >= self.flush_interval
+			if due:
+				self.flush()
+
+	def close(self):
+		"""Stop the flush timer and write out anything still buffered."""
+		if self.closed.is_set():
+			return
+		self.closed.set()
+		self.flush()
+		if self.pending:
+			logging.getLogger(__name__).error("%s datapoints could not be written to geostreams" % self.pending)
+		self.session.close()
+
+	def throughput(self):
+		"""Return (datapoints/sec while posting, datapoints/sec since the sink was created)."""
+		posting = self.written / self.flush_seconds if self.flush_seconds else 0.0
+		overall = self.written / (time.time() - self.started)
+		return (posting, overall)
+
+	def summary(self):
+		posting, overall = self.throughput()
+		return "datapoints written: %s in %s requests (%s failed), %s pending, %s dropped; %.1f/s posting, %.1f/s overall" % (
+			self.written, self.requests, self.failures, self.pending, self.dropped, posting, overall)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+
+class ProcessedLedger(object):
+	"""SQLite record of datasets that already carry metadata from a given extractor version.
+
+	The ledger only short-circuits the "already processed" check; a dataset that is
+	not in it is still checked against Clowder.
+	"""
+
+	def __init__(self, path, timeout=30):
+		self.path = path
+		self.timeout = timeout
+		self.lock = threading.Lock()
+		self.conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+		with self.lock:
+			self.conn.execute("CREATE TABLE IF NOT EXISTS processed ("
+							  "dataset_id TEXT NOT NULL, version TEXT NOT NULL, recorded REAL NOT NULL, "
+							  "PRIMARY KEY (dataset_id, version))")
+			self.conn.commit()
+
+	def contains(self, dataset_id, version):
+		with self.lock:
+			row = self.conn.execute("SELECT 1 FROM processed WHERE dataset_id=? AND version=?",
+									(dataset_id, version)).fetchone()
+		return row is not None
+
+	def add(self, dataset_id, version):
+		self.add_many([dataset_id], version)
+
+	def add_many(self, dataset_ids, version):
+		now = time.time()
+		with self.lock:
+			self.conn.executemany("INSERT OR REPLACE INTO processed (dataset_id, version, recorded) VALUES (?, ?, ?)",
+								  [(ds, version, now) for ds in dataset_ids])
+			self.conn.commit()
+
+	def remove(self, dataset_id):
+		with self.lock:
+			self.conn.execute("DELETE FROM processed WHERE dataset_id=?", (dataset_id,))
+			self.conn.commit()
+
+	def count(self, version=None):
+		with self.lock:
+			if version is None:
+				return self.conn.execute("SELECT COUNT(*) FROM processed").fetchone()[0]
+			return self.conn.execute("SELECT COUNT(*) FROM processed WHERE version=?", (version,)).fetchone()[0]
+
+	def rebuild(self, host, secret_key, collection_id, extractor_name, version, threads=8):
+		"""Record every dataset in a Clowder collection that has metadata from extractor_name.
+
+		Returns the number of datasets recorded.
+		"""
+		host = host + ("" if host.endswith("/") else "/")
+		session = requests.Session()
+		url = "%sapi/collections/%s/datasets?key=%s" % (host, collection_id, secret_key)
+		result = session.get(url)
+		result.raise_for_status()
+		dataset_ids = [ds['id'] for ds in result.json()]
+		logging.getLogger(__name__).info("Checking %s datasets in collection %s" % (len(dataset_ids), collection_id))
+
+		def has_metadata(dataset_id):
+			md_url = "%sapi/datasets/%s/metadata.jsonld?key=%s&extractor=%s" % (host, dataset_id, secret_key, extractor_name)
+			md = session.get(md_url)
+			md.raise_for_status()
+			for entry in md.json():
+				agent = entry.get('agent', {})
+				if agent.get('name', '').endswith(extractor_name) or agent.get('extractor_id', '').endswith(extractor_name):
+					return dataset_id
+			return None
+
+		pool = ThreadPool(threads)
+		try:
+			found = [ds for ds in pool.map(has_metadata, dataset_ids) if ds]
+		finally:
+			pool.close()
+			pool.join()
+		self.add_many(found, version)
+		return len(found)
+
+	def reopen(self):
+		"""Replace the connection, e.g. in a forked worker: SQLite connections can't be shared between processes."""
+		with self.lock:
+			self.conn.close()
+			self.conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+
+	def close(self):
+		with self.lock:
+			self.conn.close()
+
+
+if __name__ == "__main__":
+	# Rebuild the ledger from a Clowder collection:
+	#   python ledger.py ledger.db https://terraref.ncsa.illinois.edu/clowder/ SECRET_KEY COLLECTION_ID
+	if len(sys.argv) != 5:
+		print("usage: ledger.py LEDGER_FILE CLOWDER_HOST SECRET_KEY COLLECTION_ID")
+		sys.exit(1)
+	logging.basicConfig(level=logging.INFO)
+	with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "extractor_info.json")) as info_file:
+		info = json.load(info_file)
+	ledger = ProcessedLedger(sys.argv[1])
+	added = ledger.rebuild(sys.argv[2], sys.argv[3], sys.argv[4], info['name'], info['version'])
+	print("recorded %s datasets; %s in ledger for version %s" % (added, ledger.count(info['version']), info['version']))
+	ledger.close()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+import json
+import os
+import threading
+from collections import OrderedDict
+
+
+def centroid_lonlat(centroid):
+	"""Return (lon, lat) of a centroid given as GeoJSON (dict or string) or as [lat, lon]."""
+	if isinstance(centroid, (str, type(u""))):
+		centroid = json.loads(centroid)
+	if isinstance(centroid, dict):
+		return (float(centroid['coordinates'][0]), float(centroid['coordinates'][1]))
+	return (float(centroid[1]), float(centroid[0]))
+
+
+class PlotResolver(object):
+	"""Resolve dataset centroids to plot sitenames with the season plot shapefile.
+
+	Uses the compiled plot cache of the shapefile (plotcache.py) when it is up
+	to date, mapped once per process and shared between processes, else the
+	shared PlotIndex from plotid_by_latlon, which reads the shapefile with GDAL
+	once per process. Results are memoized by centroid rounded to `digits`
+	decimal degrees, since consecutive gantry captures land in the same plot.
+	Centroids outside every plot resolve to None. The plots are loaded on the
+	first lookup or by load().
+
+	sitename_format names the season of the shapefile, so it has no default:
+	a sitename built for the wrong season would not match any sensor.
+	"""
+
+	def __init__(self, shp_file, sitename_format, digits=6, max_entries=10000, cache_file=None):
+		if not os.path.exists(shp_file):
+			raise IOError("plot shapefile %s does not exist" % shp_file)
+		if not sitename_format:
+			raise ValueError("a sitename format is needed to name the plots of %s" % shp_file)
+		self.shp_file = shp_file
+		self.cache_file = cache_file
+		self.index = None
+		self.sitename_format = sitename_format
+		self.digits = digits
+		self.max_entries = max_entries
+		self.entries = OrderedDict()
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+	def load(self):
+		"""Return the plot index, mapping the plot cache or reading the shapefile on first use."""
+		if self.index is None:
+			from plotcache import getPlotCache
+
+			index = getPlotCache(self.shp_file, self.cache_file)
+			if index is None:
+				# GDAL is only needed without an up to date plot cache
+				from plotid_by_latlon import getPlotIndex
+
+				index = getPlotIndex(self.shp_file, useCache=False)
+			if index is None:
+				raise IOError("plot shapefile %s could not be loaded" % self.shp_file)
+			self.index = index
+		return self.index
+
+	def sitename(self, centroid):
+		"""Return the sitename of the plot containing centroid, or None."""
+		lon, lat = centroid_lonlat(centroid)
+		key = (round(lon, self.digits), round(lat, self.digits))
+		with self.lock:
+			if key in self.entries:
+				sitename = self.entries.pop(key)
+				self.entries[key] = sitename
+				self.hits += 1
+				return sitename
+			self.misses += 1
+
+		plot = self.load().lookup(lon, lat)
+		sitename = None
+		if plot and plot['contained']:
+			sitename = self.sitename_format.format(**plot)
+
+		with self.lock:
+			self.entries[key] = sitename
+			while len(self.entries) > self.max_entries:
+				self.entries.popitem(last=False)
+		return sitename
+
+	def summary(self):
+		return "plot resolver: %s hits, %s lookups" % (self.hits, self.misses)
@@ -0,0 +1,366 @@
+# plotcache.py: compiled, memory-mapped copy of the plots of a shapefile
+# Usage: python plotcache.py shpfile [cachefile]
+# Output: cachefile, by default next to the shapefile as <name>.plotcache
+#
+# Every process using plotid_by_latlon reads the shapefile through OGR into
+# per-plot geometry objects. The cache file instead holds NumPy arrays: lon/lat
+# vertices, ring and plot offsets, bounding boxes, the Range/Pass/MAC_ENTRY
+# fields, centroids and a plot id string table. Processes memory-map it
+# read-only, so nothing is parsed at startup and the workers of a node share the
+# same pages, and lookups run point-in-polygon tests on the arrays without GDAL.
+# The cache records the mtime and size of the shapefile and its sidecar files
+# and is not used once they change.
+import sys, os, json, math, struct, threading, time
+import numpy
+
+MAGIC = b"PLOTCACHE"
+VERSION = 1
+ALIGN = 64
+# points closer than this to a plot edge, in degrees (about 0.1 mm), touch the plot
+EPSILON = 1e-9
+SIDECARS = ('.shp', '.shx', '.dbf', '.prj')
+
+
+def defaultCacheFile(shpFile):
+    return os.path.splitext(shpFile)[0] + ".plotcache"
+
+
+def sourceStamp(shpFile):
+    """[extension, mtime, size] of the shapefile and each of its sidecar files that exist."""
+    base = os.path.splitext(shpFile)[0]
+    stamp = []
+    for ext in SIDECARS:
+        if os.path.exists(base + ext):
+            st = os.stat(base + ext)
+            stamp.append([ext, st.st_mtime, st.st_size])
+    return stamp
+
+
+def _align(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def writePlotCache(cacheFile, plots, stamp):
+    """Write plots to cacheFile, replacing it atomically.
+
+    Each plot is a dict with "plot", "range", "pass", "mac_entry", "point"
+    ([lat, lon, 0]) and "rings", a list of rings of (lon, lat) vertices. A point
+    is inside a plot when it is inside an odd number of its rings, which covers
+    holes and multipolygons alike.
+    """
+    vertices, ringOffsets, plotRings, boxes = [], [0], [0], []
+    kept = []
+    for p in plots:
+        first = len(vertices)
+        for ring in p["rings"]:
+            ring = [(float(v[0]), float(v[1])) for v in ring]
+            if len(ring) < 3:
+                continue
+            if ring[0] != ring[-1]:
+                ring.append(ring[0])
+            vertices.extend(ring)
+            ringOffsets.append(len(vertices))
+        if len(vertices) == first:
+            continue
+        xs = [v[0] for v in vertices[first:]]
+        ys = [v[1] for v in vertices[first:]]
+        boxes.append((min(xs), max(xs), min(ys), max(ys)))
+        plotRings.append(len(ringOffsets) - 1)
+        kept.append(p)
+
+    ids = [p["plot"].encode('utf-8') if not isinstance(p["plot"], bytes) else p["plot"] for p in kept]
+    idOffsets = numpy.cumsum([0] + [len(i) for i in ids])
+    arrays = [
+        ("vertices", numpy.array(vertices, dtype=numpy.float64).reshape(-1, 2)),
+        ("ringOffsets", numpy.array(ringOffsets, dtype=numpy.int64)),
+        ("plotRings", numpy.array(plotRings, dtype=numpy.int64)),
+        ("boxes", numpy.array(boxes, dtype=numpy.float64).reshape(-1, 4)),
+        ("ranges", numpy.array([p["range"] for p in kept], dtype=numpy.int32)),
+        ("passes", numpy.array([p["pass"] for p in kept], dtype=numpy.int32)),
+        ("macEntries", numpy.array([p["mac_entry"] for p in kept], dtype=numpy.int32)),
+        ("centroids", numpy.array([p["point"][:2] for p in kept], dtype=numpy.float64).reshape(-1, 2)),
+        ("idOffsets", numpy.asarray(idOffsets, dtype=numpy.int64)),
+        ("idBytes", numpy.frombuffer(b"".join(ids), dtype=numpy.uint8))
+    ]
+
+    # offsets are relative to the start of the data, which follows the header
+    layout = []
+    offset = 0
+    for name, a in arrays:
+        layout.append([name, a.dtype.str, list(a.shape), offset])
+        offset = _align(offset + a.nbytes)
+    header = json.dumps({"version": VERSION, "source": stamp, "plots": len(kept),
+                         "arrays": layout}).encode('utf-8')
+    dataStart = _align(len(MAGIC) + 4 + len(header))
+
+    tmpFile = "%s.tmp.%d" % (cacheFile, os.getpid())
+    with open(tmpFile, 'wb') as f:
+        f.write(MAGIC + struct.pack("<I", len(header)) + header)
+        for (name, a), entry in zip(arrays, layout):
+            f.seek(dataStart + entry[3])
+            f.write(numpy.ascontiguousarray(a).tobytes())
+        f.truncate(dataStart + offset)
+    # workers that mapped the old file keep reading it until they reopen
+    os.rename(tmpFile, cacheFile)
+    return len(kept)
+
+
+def readHeader(cacheFile):
+    """Return the header of a cache file, with "dataStart" added. Raises ValueError if it isn't one."""
+    with open(cacheFile, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("not a plot cache: " + str(cacheFile))
+        n, = struct.unpack("<I", f.read(4))
+        header = json.loads(f.read(n).decode('utf-8'))
+    if header.get("version") != VERSION:
+        raise ValueError("unsupported plot cache version " + str(header.get("version")))
+    header["dataStart"] = _align(len(MAGIC) + 4 + n)
+    return header
+
+
+def geometryRings(geom):
+    """Rings of an OGR geometry as lists of (x, y), descending into polygons and multipolygons."""
+    if geom.GetGeometryCount() == 0:
+        points = geom.GetPoints() or []
+        return [[p[:2] for p in points]] if points else []
+    rings = []
+    for i in range(geom.GetGeometryCount()):
+        rings.extend(geometryRings(geom.GetGeometryRef(i)))
+    return rings
+
+
+def compilePlotCache(shpFile, cacheFile=None):
+    """Read shpFile with OGR and write its plots to cacheFile. Returns the number of plots, None on failure."""
+    from plotid_by_latlon import PlotIndex
+
+    # stamp first, so a shapefile replaced while it is read leaves the cache stale
+    stamp = sourceStamp(shpFile)
+    index = PlotIndex(shpFile)
+    if index.state is None:
+        return None
+    plots = [dict(p, rings=geometryRings(p["geom_ll"])) for p in index.state[0]]
+    return writePlotCache(cacheFile or defaultCacheFile(shpFile), plots, stamp)
+
+
+def segmentDistances(ax, ay, bx, by, x, y):
+    """Distances from (x, y) to each segment (ax, ay)-(bx, by)."""
+    dx = bx - ax
+    dy = by - ay
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        t = ((x - ax) * dx + (y - ay) * dy) / (dx * dx + dy * dy)
+    # zero-length segments give NaN; their distance is to the start point
+    t = numpy.clip(numpy.nan_to_num(t), 0.0, 1.0)
+    return numpy.hypot(ax + t * dx - x, ay + t * dy - y)
+
+
+class PlotCache(object):
+    """Plots of a compiled cache file, memory-mapped read-only.
+
+    Answers lookup() and lookupMany() like plotid_by_latlon.PlotIndex, except
+    that "geom" is a GeoJSON polygon rather than an OGR geometry and distances
+    to plots outside the point are measured in lon/lat scaled by the cosine of
+    the field latitude. The shapefile and cache are checked at most every
+    check_interval seconds: a recompiled cache is reopened, and while the cache
+    is out of date lookups go to an OGR PlotIndex.
+    """
+    def __init__(self, shpFile, cacheFile=None, check_interval=5.0):
+        self.shpFile = shpFile
+        self.cacheFile = cacheFile or defaultCacheFile(shpFile)
+        self.check_interval = check_interval
+        # dict of arrays swapped as one reference so lookups never mix two files
+        self.state = None
+        self.fallback = None
+        self.checked = None
+        self.last_check = 0
+        self.lock = threading.Lock()
+        self.load()
+
+    def stamps(self):
+        try:
+            cacheTime = os.path.getmtime(self.cacheFile)
+        except OSError:
+            cacheTime = None
+        return (sourceStamp(self.shpFile), cacheTime)
+
+    def load(self):
+        """Map the cache file if it matches the shapefile. Returns False if it is missing, stale or unreadable."""
+        stamps = self.stamps()
+        self.checked = stamps
+        self.last_check = time.time()
+        if stamps[1] is None:
+            return False
+        try:
+            header = readHeader(self.cacheFile)
+        except (IOError, OSError, ValueError) as e:
+            print("PlotCache: ERROR reading " + str(self.cacheFile) + ": " + str(e))
+            return False
+        if header["source"] != stamps[0]:
+            print("PlotCache: " + str(self.cacheFile) + " is out of date for " + str(self.shpFile))
+            return False
+
+        raw = numpy.memmap(self.cacheFile, dtype=numpy.uint8, mode='r')
+        arrays = {}
+        for name, dtype, shape, offset in header["arrays"]:
+            if numpy.prod(shape) == 0:
+                arrays[name] = numpy.zeros(shape, dtype=numpy.dtype(dtype))
+            else:
+                arrays[name] = numpy.ndarray(tuple(shape), dtype=numpy.dtype(dtype), buffer=raw,
+                                             offset=header["dataStart"] + offset)
+        # small derived arrays: first vertex of each plot, and the edges joining one ring to the next
+        arrays["plotVertices"] = arrays["ringOffsets"][arrays["plotRings"]]
+        arrays["ringJoins"] = arrays["ringOffsets"][1:-1] - 1
+        lats = arrays["centroids"][:, 0]
+        arrays["scale"] = math.cos(math.radians(float(lats.mean()))) if len(lats) else 1.0
+        self.state = arrays
+        return True
+
+    def refresh(self):
+        """Reopen the cache, or fall back to OGR, if the shapefile or cache changed."""
+        now = time.time()
+        if now - self.last_check < self.check_interval:
+            return
+        with self.lock:
+            if now - self.last_check < self.check_interval:
+                return
+            self.last_check = now
+            if self.stamps() == self.checked:
+                return
+            if self.load():
+                self.fallback = None
+                return
+            if self.fallback is None:
+                print("PlotCache: reading " + str(self.shpFile) + " with OGR until the cache is recompiled")
+                from plotid_by_latlon import PlotIndex
+                index = PlotIndex(self.shpFile, check_interval=self.check_interval)
+                if index.state is not None:
+                    self.fallback = index
+
+    def covers(self, arrays, i, x, y):
+        """True if plot i contains or touches the lon/lat point."""
+        vertices = arrays["vertices"]
+        ringOffsets = arrays["ringOffsets"]
+        inside = False
+        for r in range(arrays["plotRings"][i], arrays["plotRings"][i + 1]):
+            ring = vertices[ringOffsets[r]:ringOffsets[r + 1]]
+            ax, ay = ring[:-1, 0], ring[:-1, 1]
+            bx, by = ring[1:, 0], ring[1:, 1]
+            if (segmentDistances(ax, ay, bx, by, x, y) <= EPSILON).any():
+                return True
+            crosses = (ay > y) != (by > y)
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                xcross = ax + (y - ay) * (bx - ax) / (by - ay)
+            if numpy.count_nonzero(crosses & (x < xcross)) % 2:
+                inside = not inside
+        return inside
+
+    def nearest(self, arrays, x, y):
+        """Position of the plot closest to the lon/lat point."""
+        v = arrays["vertices"]
+        s = arrays["scale"]
+        d = segmentDistances(v[:-1, 0] * s, v[:-1, 1], v[1:, 0] * s, v[1:, 1], x * s, y)
+        d[arrays["ringJoins"]] = numpy.inf
+        return int(numpy.argmin(numpy.minimum.reduceat(d, arrays["plotVertices"][:-1])))
+
+    def findLonLat(self, arrays, x, y):
+        """Return (plot position, contained) for a lon/lat point."""
+        boxes = arrays["boxes"]
+        for i in numpy.nonzero((boxes[:, 0] <= x) & (x <= boxes[:, 1]) &
+                               (boxes[:, 2] <= y) & (y <= boxes[:, 3]))[0]:
+            if self.covers(arrays, i, x, y):
+                return (int(i), True)
+        return (self.nearest(arrays, x, y), False)
+
+    def plotId(self, arrays, i):
+        o = arrays["idOffsets"]
+        return arrays["idBytes"][o[i]:o[i + 1]].tobytes().decode('utf-8')
+
+    def geometry(self, arrays, i):
+        vertices = arrays["vertices"]
+        ringOffsets = arrays["ringOffsets"]
+        rings = [vertices[ringOffsets[r]:ringOffsets[r + 1]].tolist()
+                 for r in range(arrays["plotRings"][i], arrays["plotRings"][i + 1])]
+        return {"type": "Polygon", "coordinates": rings}
+
+    def result(self, arrays, i, contained):
+        lat, lon = arrays["centroids"][i]
+        return {"plot": self.plotId(arrays, i), "range": int(arrays["ranges"][i]),
+                "pass": int(arrays["passes"][i]), "mac_entry": int(arrays["macEntries"][i]),
+                "geom": self.geometry(arrays, i), "point": [float(lat), float(lon), 0],
+                "contained": contained}
+
+    def lookup(self, lon, lat):
+        """Return the plot containing, touching, or closest to <lon, lat>. None if no plots."""
+        self.refresh()
+        if self.fallback is not None:
+            return self.fallback.lookup(lon, lat)
+        arrays = self.state
+        if arrays is None or len(arrays["boxes"]) == 0:
+            return None
+        i, contained = self.findLonLat(arrays, float(lon), float(lat))
+        return self.result(arrays, i, contained)
+
+    def lookupMany(self, lons, lats):
+        """Batch version of lookup(), returning the same arrays as PlotIndex.lookupMany()."""
+        self.refresh()
+        if self.fallback is not None:
+            return self.fallback.lookupMany(lons, lats)
+        lons = numpy.asarray(lons, dtype=numpy.float64).ravel()
+        lats = numpy.asarray(lats, dtype=numpy.float64).ravel()
+        n = len(lons)
+        plotids = numpy.empty(n, dtype=object)
+        c_lats = numpy.full(n, numpy.nan)
+        c_lons = numpy.full(n, numpy.nan)
+        contained = numpy.zeros(n, dtype=bool)
+        arrays = self.state
+        if arrays is None or len(arrays["boxes"]) == 0 or n == 0:
+            return (plotids, c_lats, c_lons, contained)
+
+        coords, inverse = numpy.unique(numpy.column_stack((lons, lats)), axis=0, return_inverse=True)
+        found = numpy.empty(len(coords), dtype=numpy.int64)
+        inside = numpy.zeros(len(coords), dtype=bool)
+        for k in range(len(coords)):
+            found[k], inside[k] = self.findLonLat(arrays, coords[k, 0], coords[k, 1])
+
+        inverse = inverse.ravel()
+        idx = found[inverse]
+        used = numpy.unique(found)
+        ids = numpy.empty(len(arrays["boxes"]), dtype=object)
+        ids[used] = [self.plotId(arrays, i) for i in used]
+        plotids[:] = ids[idx]
+        c_lats[:] = arrays["centroids"][idx, 0]
+        c_lons[:] = arrays["centroids"][idx, 1]
+        contained[:] = inside[inverse]
+        return (plotids, c_lats, c_lons, contained)
+
+
+_plotCaches = {}
+_plotCachesLock = threading.Lock()
+
+def getPlotCache(shpFile, cacheFile=None):
+    """Return the shared PlotCache for shpFile, or None if its cache file is missing or out of date.
+
+    The cache file is only looked for once per process; use plotid_by_latlon
+    with OGR when this returns None.
+    """
+    shpFile = os.path.abspath(shpFile)
+    cacheFile = os.path.abspath(cacheFile or defaultCacheFile(shpFile))
+    with _plotCachesLock:
+        if (shpFile, cacheFile) not in _plotCaches:
+            cache = PlotCache(shpFile, cacheFile)
+            _plotCaches[(shpFile, cacheFile)] = cache if cache.state is not None else None
+        return _plotCaches[(shpFile, cacheFile)]
+
+# Example run:
+# python plotcache.py data/sorghumexpfall2016v5_lblentry_1to7.shp
+# 1728 plots written to data/sorghumexpfall2016v5_lblentry_1to7.plotcache in 0.842s
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("usage: python plotcache.py shpfile [cachefile]")
+        sys.exit(2)
+    shpFile = sys.argv[1]
+    cacheFile = sys.argv[2] if len(sys.argv) > 2 else defaultCacheFile(shpFile)
+    start = time.time()
+    count = compilePlotCache(shpFile, cacheFile)
+    if count is None:
+        sys.exit(1)
+    print("%d plots written to %s in %.3fs" % (count, cacheFile, time.time() - start))
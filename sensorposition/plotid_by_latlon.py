@@ -4,77 +4,300 @@
 # Usage: python plotid_by_latlon.py shpfile lon lat
 # Output: id of the plot which contains, touches, or is closest to the point. None if something wrong
 # Dependency: GDAL 2.0+ with GEOS, PROJ4, and python library support
-import sys, os, string, copy
+import sys, os, string, copy, heapq, math, threading, time
+import numpy
 from osgeo import gdal
 from osgeo import ogr
 from osgeo import osr
+from plotcache import getPlotCache
 
-def plotQuery(shpFile = None, lon = 0, lat = 0):
+
+class STRtree(object):
+    """Sort-Tile-Recursive packed R-tree over (minx, maxx, miny, maxy) boxes.
+
+    Payloads are the positions of the boxes in the list given to the constructor.
+    """
+    def __init__(self, boxes, capacity=16):
+        self.capacity = max(2, capacity)
+        nodes = [(box, i, True) for i, box in enumerate(boxes)]
+        while len(nodes) > 1:
+            nodes = self._pack(nodes)
+        self.root = nodes[0] if nodes else None
+
+    def _pack(self, nodes):
+        # one STR pass: slice by x center, tile each slice by y center
+        cap = self.capacity
+        num_parents = int(math.ceil(len(nodes) / float(cap)))
+        num_slices = int(math.ceil(math.sqrt(num_parents)))
+        slice_size = num_slices * cap
+        nodes = sorted(nodes, key=lambda n: n[0][0] + n[0][1])
+        parents = []
+        for s in range(0, len(nodes), slice_size):
+            vslice = sorted(nodes[s:s + slice_size], key=lambda n: n[0][2] + n[0][3])
+            for g in range(0, len(vslice), cap):
+                group = vslice[g:g + cap]
+                box = (min(n[0][0] for n in group), max(n[0][1] for n in group),
+                       min(n[0][2] for n in group), max(n[0][3] for n in group))
+                parents.append((box, group, False))
+        return parents
+
+    def query(self, x, y):
+        """Return payloads of all boxes containing (x, y)."""
+        found = []
+        if self.root is None:
+            return found
+        stack = [self.root]
+        while stack:
+            box, children, leaf = stack.pop()
+            if x < box[0] or x > box[1] or y < box[2] or y > box[3]:
+                continue
+            if leaf:
+                found.append(children)
+            else:
+                stack.extend(children)
+        return sorted(found)
+
+    def nearest(self, x, y, distance):
+        """Return (payload, distance) closest to (x, y), using distance(payload) for exact distances."""
+        if self.root is None:
+            return (None, None)
+        best, best_d = None, float('inf')
+        counter = 0
+        heap = [(_boxDistance(self.root[0], x, y), counter, self.root)]
+        while heap:
+            d, _, node = heapq.heappop(heap)
+            if d >= best_d:
+                break
+            box, children, leaf = node
+            if leaf:
+                d = distance(children)
+                if d < best_d or (d == best_d and children < best):
+                    best, best_d = children, d
+                continue
+            for child in children:
+                counter += 1
+                heapq.heappush(heap, (_boxDistance(child[0], x, y), counter, child))
+        return (best, best_d)
+
+
+def _boxDistance(box, x, y):
+    dx = max(box[0] - x, 0.0, x - box[1])
+    dy = max(box[2] - y, 0.0, y - box[3])
+    return math.sqrt(dx * dx + dy * dy)
+
+
+class PlotIndex(object):
+    """Plots of a shapefile held in memory behind an STRtree.
+
+    The shapefile is read once; lookups only project the query point and test
+    the few plots whose bounding box covers it. The index is rebuilt when the
+    shapefile mtime changes, checked at most every check_interval seconds.
+    """
+    def __init__(self, shpFile, capacity=16, check_interval=5.0):
+        self.shpFile = shpFile
+        self.capacity = capacity
+        self.check_interval = check_interval
+        # (plots, tree, transform) swapped as one reference so lookups never mix two loads
+        self.state = None
+        self.mtime = None
+        self.last_check = 0
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """Read every plot from the shapefile and rebuild the tree. Returns False on failure."""
+        if not os.path.exists(self.shpFile):
+            print "PlotIndex: ERROR shp file does not exist: " + str(self.shpFile)
+            return False
+        mtime = os.path.getmtime(self.shpFile)
+
+        ds = gdal.OpenEx( self.shpFile, gdal.OF_VECTOR | gdal.OF_READONLY)
+        if ds is None :
+            print "PlotIndex: ERROR Open failed: " + str(self.shpFile) + "\n"
+            return False
+        layerName = os.path.basename(self.shpFile).split('.shp')[0]
+        lyr = ds.GetLayerByName( layerName )
+        if lyr is None :
+            print "PlotIndex: ERROR fetch layer: " + str(layerName) + "\n"
+            return False
+
+        lyr.ResetReading()
+        lyr_defn = lyr.GetLayerDefn()
+        t_srs = lyr.GetSpatialRef()
+        s_srs = osr.SpatialReference()
+        s_srs.ImportFromEPSG(4326)
+
+        fi_rangepass = lyr_defn.GetFieldIndex('RangePass')
+        fi_range = lyr_defn.GetFieldIndex('Range')
+        fi_pass = lyr_defn.GetFieldIndex('Pass')
+        fi_macentry = lyr_defn.GetFieldIndex('MAC_ENTRY')
+
+        transform_back = osr.CoordinateTransformation(t_srs, s_srs)
+        plots = []
+        boxes = []
+        for f in lyr: # for each plot
+            geom = f.GetGeometryRef()
+            if geom is None:
+                continue
+            geom = geom.Clone()
+            geom_ll = geom.Clone()
+            geom_ll.Transform(transform_back)
+            centroid = geom_ll.Centroid()
+            plots.append({
+                "plot": f.GetFieldAsString(fi_rangepass),
+                "range": f.GetFieldAsInteger(fi_range),
+                "pass": f.GetFieldAsInteger(fi_pass),
+                "mac_entry": f.GetFieldAsInteger(fi_macentry),
+                "geom": geom,
+                "geom_ll": geom_ll,
+                "point": [centroid.GetY(), centroid.GetX(), 0]
+            })
+            boxes.append(geom.GetEnvelope())
+        ds = None
+
+        self.state = (plots, STRtree(boxes, self.capacity), osr.CoordinateTransformation(s_srs, t_srs))
+        self.mtime = mtime
+        self.last_check = time.time()
+        return True
+
+    def refresh(self):
+        """Reload the index if the shapefile changed since it was read."""
+        now = time.time()
+        if now - self.last_check < self.check_interval:
+            return
+        with self.lock:
+            if now - self.last_check < self.check_interval:
+                return
+            self.last_check = now
+            try:
+                mtime = os.path.getmtime(self.shpFile)
+            except OSError:
+                return
+            if mtime != self.mtime:
+                self.load()
+
+    def findProjected(self, plots, tree, x, y):
+        """Return (plot position, contained) for a point in the layer SRS, or (None, False)."""
+        point = ogr.Geometry(ogr.wkbPoint)
+        point.SetPoint_2D(0, x, y)
+        for i in tree.query(x, y):
+            geom = plots[i]["geom"]
+            if (geom.Contains(point) or geom.Touches(point)): # GDAL needs to support Covers() for better efficiency
+                return (i, True)
+        i, d = tree.nearest(x, y, lambda j: plots[j]["geom"].Distance(point))
+        return (i, False)
+
+    def result(self, plots, i, contained):
+        plot = plots[i]
+        return {"plot": plot["plot"], "range": plot["range"], "pass": plot["pass"],
+                "mac_entry": plot["mac_entry"], "geom": plot["geom_ll"].Clone(),
+                "point": list(plot["point"]), "contained": contained}
+
+    def lookup(self, lon, lat):
+        """Return the plot containing, touching, or closest to <lon, lat>. None if no plots."""
+        self.refresh()
+        if self.state is None:
+            return None
+        plots, tree, transform = self.state
+        point = ogr.Geometry(ogr.wkbPoint)
+        point.SetPoint_2D(0, lon, lat)
+        point.Transform(transform)
+        i, contained = self.findProjected(plots, tree, point.GetX(), point.GetY())
+        if i is None:
+            print "PlotIndex: ERROR searched but couldn't find nearest plot. Check data file or the point. "
+            return None
+        return self.result(plots, i, contained)
+
+    def lookupMany(self, lons, lats):
+        """Batch version of lookup() over arrays of points.
+
+        Returns parallel arrays (plot ids, centroid lats, centroid lons, contained).
+        Points that can't be resolved get a None plot id and NaN centroid.
+        """
+        self.refresh()
+        lons = numpy.asarray(lons, dtype=numpy.float64).ravel()
+        lats = numpy.asarray(lats, dtype=numpy.float64).ravel()
+        n = len(lons)
+        plotids = numpy.empty(n, dtype=object)
+        c_lats = numpy.full(n, numpy.nan)
+        c_lons = numpy.full(n, numpy.nan)
+        contained = numpy.zeros(n, dtype=bool)
+        if self.state is None or n == 0:
+            return (plotids, c_lats, c_lons, contained)
+        plots, tree, transform = self.state
+
+        # consecutive captures repeat positions, so only resolve each distinct point once
+        coords, inverse = numpy.unique(numpy.column_stack((lons, lats)), axis=0, return_inverse=True)
+        projected = transform.TransformPoints(coords.tolist())
+        found = numpy.full(len(coords), -1, dtype=numpy.int64)
+        inside = numpy.zeros(len(coords), dtype=bool)
+        for k, p in enumerate(projected):
+            i, c = self.findProjected(plots, tree, p[0], p[1])
+            if i is not None:
+                found[k] = i
+                inside[k] = c
+
+        inverse = inverse.ravel()
+        idx = found[inverse]
+        ids = numpy.array([p["plot"] for p in plots] + [None], dtype=object)
+        centroids = numpy.array([p["point"][:2] for p in plots] + [[numpy.nan, numpy.nan]])
+        plotids[:] = ids[idx]
+        c_lats[:] = centroids[idx, 0]
+        c_lons[:] = centroids[idx, 1]
+        contained[:] = inside[inverse]
+        return (plotids, c_lats, c_lons, contained)
+
+
+_plotIndexes = {}
+_plotIndexesLock = threading.Lock()
+
+def getPlotIndex(shpFile, useCache=False):
+    """Return the shared plot index for shpFile, loading it on first use. None if it can't be loaded.
+
+    This is a PlotIndex read with OGR, or with useCache the compiled PlotCache
+    from plotcache.py when one is up to date with the shapefile. The cache
+    returns "geom" as a GeoJSON dict, one Polygon per plot, and tests plot
+    boundaries with a tolerance, so it is only used when asked for.
+    """
+    shpFile = os.path.abspath(shpFile)
+    if useCache:
+        cache = getPlotCache(shpFile)
+        if cache is not None:
+            return cache
+    with _plotIndexesLock:
+        index = _plotIndexes.get(shpFile)
+        if index is None:
+            index = PlotIndex(shpFile)
+            if index.state is None:
+                return None
+            _plotIndexes[shpFile] = index
+    return index
+
+def plotQuery(shpFile = None, lon = 0, lat = 0, useCache = False):
     if not os.path.exists(shpFile):
         print "plotQuery(): ERROR shp file does not exist: " + str(shpFile)
         return None
 
-    # open plot shp file
-    ds = gdal.OpenEx( shpFile, gdal.OF_VECTOR | gdal.OF_READONLY)
-    if ds is None :
-        print "plotQuery(): ERROR Open failed: " + str(shpFile) + "\n"
+    index = getPlotIndex(shpFile, useCache)
+    if index is None:
         return None
-    layerName = os.path.basename(shpFile).split('.shp')[0]
-    lyr = ds.GetLayerByName( layerName )
-    if lyr is None :
-        print "plotQuery(): ERROR fetch layer: " + str(layerName) + "\n"
+    return index.lookup(lon, lat)
+
+def plotQueryBatch(shpFile = None, lons = (), lats = (), useCache = False):
+    """Look up arrays of <lon, lat> points with the same semantics as plotQuery().
+
+    Returns parallel NumPy arrays (plot ids, centroid lats, centroid lons, contained)
+    where contained is False for points matched to their nearest plot. None if
+    the shapefile can't be read. useCache is as for getPlotIndex().
+    """
+    if not os.path.exists(shpFile):
+        print "plotQueryBatch(): ERROR shp file does not exist: " + str(shpFile)
         return None
 
-    # load shp file
-    lyr.ResetReading()
-    num_records = lyr.GetFeatureCount()
-    lyr_defn = lyr.GetLayerDefn()
-    t_srs = lyr.GetSpatialRef()
-
-    # create point
-    point = ogr.Geometry(ogr.wkbPoint)
-    point.SetPoint_2D(0, lon, lat)
-    s_srs = osr.SpatialReference()
-    s_srs.ImportFromEPSG(4326)
-    transform = osr.CoordinateTransformation(s_srs, t_srs)
-    transform_back = osr.CoordinateTransformation(t_srs, s_srs)
-    point.Transform(transform)
-
-    fi_rangepass = lyr_defn.GetFieldIndex('RangePass')
-    fi_range = lyr_defn.GetFieldIndex('Range')
-    fi_pass = lyr_defn.GetFieldIndex('Pass')
-    fi_macentry = lyr_defn.GetFieldIndex('MAC_ENTRY')
-
-    min = 1000000000.0
-    minid = None
-    mingeom = None
-    for f in lyr: # for each plot
-        plotid = f.GetFieldAsString(fi_rangepass)
-        rangeid = f.GetFieldAsInteger(fi_range)
-        passid = f.GetFieldAsInteger(fi_pass)
-        macentryid = f.GetFieldAsInteger(fi_macentry)
-        geom = f.GetGeometryRef()
-        if (geom.Contains(point) or geom.Touches(point)): # GDAL needs to support Covers() for better efficiency
-            #print "plotQuery(): INFO point in plot"
-            ds = None
-            geom.Transform(transform_back)
-            centroid = geom.Centroid()
-            return {"plot":plotid, "geom":geom, "point": [centroid.GetY(), centroid.GetX(), 0]}
-        # calc distance and update nearest
-        d = geom.Distance(point)
-        if (d < min):
-            min = d
-            minid = plotid
-            mingeom = copy.copy(geom)
-
-    ds = None
-    if minid is None:
-        print "plotQuery(): ERROR searched but couldn't find nearest plot. Check data file or the point. "
+    index = getPlotIndex(shpFile, useCache)
+    if index is None:
         return None
-    #print "plotQuery(): INFO point not in plot"
-    geom.Transform(transform_back)
-    centroid = geom.Centroid()
-    return {"plot":minid, "geom":mingeom, "point": [centroid.GetY(), centroid.GetX(), 0]}
+    return index.lookupMany(lons, lats)
 
 # Example run:
 # python plotid_by_latlon.py data/sorghumexpfall2016v5_lblentry_1to7.shp -111.97495668222 33.0760167027358
@@ -84,4 +307,4 @@ if __name__ == '__main__':
     shpFile = sys.argv[1] # shp file path
     lon = float(sys.argv[2]) # point lon
     lat = float(sys.argv[3]) # point lat
-    print plotQuery(shpFile, lon, lat)
\ No newline at end of file
+    print plotQuery(shpFile, lon, lat)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class StreamCache(object):
+	"""Process-local cache of resolved geostreams ids with TTL and LRU eviction.
+
+	get_or_resolve() holds a lock per key while resolving, so concurrent workers
+	asking for the same (sensor, stream) wait for the first one instead of
+	creating duplicates. None results are not cached.
+	"""
+
+	def __init__(self, max_entries=256, ttl=3600):
+		self.max_entries = max_entries
+		self.ttl = ttl
+		self.entries = OrderedDict()
+		self.lock = threading.Lock()
+		self.key_locks = {}
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def get(self, key):
+		"""Return the cached value for key, or None if absent or expired."""
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is None:
+				return None
+			value, expires = entry
+			if expires < time.time():
+				del self.entries[key]
+				return None
+			# move to most recently used
+			del self.entries[key]
+			self.entries[key] = entry
+			return value
+
+	def put(self, key, value):
+		with self.lock:
+			if key in self.entries:
+				del self.entries[key]
+			self.entries[key] = (value, time.time() + self.ttl)
+			while len(self.entries) > self.max_entries:
+				self.entries.popitem(last=False)
+				self.evictions += 1
+
+	def invalidate(self, key):
+		with self.lock:
+			self.entries.pop(key, None)
+
+	def get_or_resolve(self, key, resolve):
+		"""Return the cached value for key, calling resolve() under the key lock on a miss."""
+		value = self.get(key)
+		if value is not None:
+			self.hits += 1
+			return value
+
+		with self.lock:
+			key_lock = self.key_locks.setdefault(key, threading.Lock())
+		with key_lock:
+			# another worker may have resolved it while we waited
+			value = self.get(key)
+			if value is not None:
+				self.hits += 1
+				return value
+			self.misses += 1
+			value = resolve()
+			if value is not None:
+				self.put(key, value)
+			return value
+
+	def summary(self):
+		return "stream cache: %s hits, %s misses, %s evictions, %s entries" % (
+			self.hits, self.misses, self.evictions, len(self.entries))
@@ -1,23 +1,99 @@
 #!/usr/bin/env python
 
+import os
+import signal
+import sys
+import threading
+
 from pyclowder.utils import CheckMessage
-from pyclowder.datasets import get_info, get_file_list, upload_metadata, download_metadata
+from pyclowder.datasets import get_info, get_file_list, download_metadata
 from terrautils.extractors import TerrarefExtractor, build_metadata
-from terrautils.geostreams import create_datapoint_with_dependencies, get_sensor_by_name, create_sensor, \
-	get_stream_by_name, create_stream, create_datapoint
 from terrautils.metadata import get_terraref_metadata, get_extractor_metadata, calculate_scan_time
 
+from coalesce import MessageCoalescer
+from geostreams_sink import DatapointSink
+from ledger import ProcessedLedger
+from plot_resolver import PlotResolver
+from stream_cache import StreamCache
+
+# modules shared between extractors live in ../common in a repository checkout
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+from clowder_client import get_client
+from lazy_import import lazy_function, preload
+from prefork import serve_prefork
+from worker_pool import run_workers, PerThreadStats
+import metrics
+
+# terrautils.geostreams (and GDAL through it) is imported when the first datapoint is written
+GEOSTREAMS = "terrautils.geostreams"
+
+get_info = metrics.timed(get_info)
+download_metadata = metrics.timed(download_metadata)
+create_datapoint_with_dependencies = metrics.timed(lazy_function(GEOSTREAMS, "create_datapoint_with_dependencies"))
+get_sensor_by_name = metrics.timed(lazy_function(GEOSTREAMS, "get_sensor_by_name"))
+get_stream_by_name = metrics.timed(lazy_function(GEOSTREAMS, "get_stream_by_name"))
+create_stream = metrics.timed(lazy_function(GEOSTREAMS, "create_stream"))
+
+
+def add_local_arguments(parser):
+	# add any additional arguments to parser
+	parser.add_argument('--batch_size', type=int, default=os.getenv('GEOSTREAMS_BATCH_SIZE', 100),
+						help="number of pending datapoints that triggers a bulk write to geostreams")
+	parser.add_argument('--batch_interval', type=float, default=os.getenv('GEOSTREAMS_BATCH_INTERVAL', 30),
+						help="maximum seconds a datapoint is buffered before it is written")
+	parser.add_argument('--stream_cache_ttl', type=float, default=os.getenv('STREAM_CACHE_TTL', 3600),
+						help="seconds a resolved geostreams sensor/stream id is reused")
+	parser.add_argument('--stream_cache_size', type=int, default=os.getenv('STREAM_CACHE_SIZE', 256),
+						help="maximum number of cached geostreams stream ids")
+	parser.add_argument('--ledger', default=os.getenv('PROCESSED_LEDGER', ""),
+						help="SQLite file recording datasets that already have sensorposition metadata")
+	parser.add_argument('--coalesce_window', type=float, default=os.getenv('COALESCE_WINDOW', 0),
+						help="seconds during which repeated metadata messages for a dataset are dropped (default 0 = off)")
+	parser.add_argument('--metrics_port', type=int, default=os.getenv('METRICS_PORT', 0),
+						help="port serving Prometheus metrics on /metrics (0 = off)")
+	parser.add_argument('--workers', type=int, default=os.getenv('EXTRACTOR_WORKERS', 1),
+						help="number of messages processed at the same time (1 = pyclowder's one at a time)")
+	parser.add_argument('--prefetch', type=int, default=os.getenv('EXTRACTOR_PREFETCH', 0),
+						help="number of messages fetched ahead when workers > 1 (default: 2 x workers)")
+	parser.add_argument('--prefork_socket', default=os.getenv('PREFORK_SOCKET', ""),
+						help="serve jobs from batch_launcher.sh on this unix socket with pre-forked warm workers")
+	parser.add_argument('--prefork_workers', type=int, default=os.getenv('PREFORK_WORKERS', 4),
+						help="number of pre-forked workers serving --prefork_socket")
+	parser.add_argument('--plot_shapefile', default=os.getenv('PLOT_SHAPEFILE', ""),
+						help="season plot boundary shapefile used to find the plot of datasets without site_metadata")
+	parser.add_argument('--plot_cache', default=os.getenv('PLOT_CACHE', ""),
+						help="plot cache compiled from the shapefile by plotcache.py (default: <shapefile>.plotcache)")
+	parser.add_argument('--plot_sitename', default=os.getenv('PLOT_SITENAME_FORMAT', ""),
+						help="sitename of a plot from its shapefile fields {range}, {pass} and {plot}, "
+							 "e.g. \"MAC Field Scanner Season 4 Range {range} Pass {pass}\" (required with --plot_shapefile)")
 
 # @begin extractor_sensor_position
 # @in new_dataset_added
 
-class Sensorposition2Geostreams(TerrarefExtractor):
+class Sensorposition2Geostreams(PerThreadStats, TerrarefExtractor):
 	def __init__(self):
 		super(Sensorposition2Geostreams, self).__init__()
 
+		add_local_arguments(self.parser)
+
 		# parse command line and load default logging configuration
 		self.setup(sensor='sensorposition')
 
+		# assign local arguments
+		self.batch_size = int(self.args.batch_size)
+		self.batch_interval = float(self.args.batch_interval)
+		self.sinks = {}
+		self.sinks_lock = threading.Lock()
+		self.streams = StreamCache(int(self.args.stream_cache_size), float(self.args.stream_cache_ttl))
+		self.ledger = ProcessedLedger(self.args.ledger) if self.args.ledger else None
+		self.coalescer = MessageCoalescer(float(self.args.coalesce_window))
+		if self.args.plot_shapefile and not self.args.plot_sitename:
+			self.parser.error("--plot_shapefile needs --plot_sitename (PLOT_SITENAME_FORMAT) for the season of the shapefile")
+		self.plots = PlotResolver(self.args.plot_shapefile, self.args.plot_sitename,
+								  cache_file=self.args.plot_cache or None) if self.args.plot_shapefile else None
+		if self.args.metrics_port and not self.args.prefork_socket:
+			metrics.start_exporter(self.args.metrics_port, self.extractor_info['name'])
+
 	# Check whether dataset has geospatial metadata
 	def check_message(self, connector, host, secret_key, resource, parameters):
 		if resource['type'] != "dataset":
@@ -28,11 +104,26 @@ class Sensorposition2Geostreams(TerrarefExtractor):
 		self.start_check(resource)
 
 		if 'spatial_metadata' in resource['metadata']:
-			ds_md = download_metadata(connector, host, secret_key, resource['id'])
+			if not self.coalescer.admit(resource['id']):
+				self.log_skip(resource, "dataset already handled within the last %ss" % self.coalescer.window)
+				metrics.count("coalesced_messages")
+				return CheckMessage.ignore
+
+			if self.ledger and self.ledger.contains(resource['id'], self.extractor_info['version']):
+				self.log_skip(resource, "sensorposition metadata already exists (ledger)")
+				return CheckMessage.ignore
+
+			try:
+				ds_md = download_metadata(connector, host, secret_key, resource['id'])
+			except Exception:
+				self.coalescer.forget(resource['id'])
+				raise
 			ext_md = get_extractor_metadata(ds_md, self.extractor_info['name'])
 			if not ext_md:
 				return CheckMessage.bypass
 			else:
+				if self.ledger:
+					self.ledger.add(resource['id'], self.extractor_info['version'])
 				self.log_skip(resource, "sensorposition metadata already exists")
 				return CheckMessage.ignore
 		else:
@@ -41,10 +132,22 @@ class Sensorposition2Geostreams(TerrarefExtractor):
 
 	# Process the file and upload the results
 	def process_message(self, connector, host, secret_key, resource, parameters):
+		metrics.start_message()
+		try:
+			self.create_datapoint(connector, host, secret_key, resource)
+		except Exception:
+			# let a redelivered or repeated message for this dataset through
+			self.coalescer.forget(resource['id'])
+			raise
+
+	def create_datapoint(self, connector, host, secret_key, resource):
 		self.start_message(resource)
 
 		terra_md = resource['metadata']
-		ds_info = get_info(connector, host, secret_key, resource['id'])
+		if 'name' in resource:
+			ds_name = resource['name']
+		else:
+			ds_name = get_info(connector, host, secret_key, resource['id'])['name']
 
 		# @begin extract_positional_info_from_metadata
 		# @in new_dataset_added
@@ -53,14 +156,14 @@ class Sensorposition2Geostreams(TerrarefExtractor):
 
 		# Get sensor from datasetname
 		self.log_info(resource, "Getting position information from metadata")
-		(streamprefix, timestamp) = ds_info['name'].split(' - ')
+		(streamprefix, timestamp) = ds_name.split(' - ')
 		date = timestamp.split("__")[0]
 		scan_time = calculate_scan_time(terra_md)
 		streamprefix += " Datasets"
 		dpmetadata = {
 			"source_dataset": host + ("" if host.endswith("/") else "/") + \
 							  "datasets/" + resource['id'],
-			"dataset_name": ds_info['name']
+			"dataset_name": ds_name
 		}
 
 		centroid = None
@@ -77,13 +180,51 @@ class Sensorposition2Geostreams(TerrarefExtractor):
 					]
 				}
 
+		sitename = None
+		local_plot = False
 		if 'site_metadata' in terra_md:
 			# We've already determined the plot associated with this dataset so we can skip some work
-			self.log_info(resource, "Creating datapoint without lookup in %s" % streamprefix)
-			create_datapoint_with_dependencies(connector, host, secret_key,
-											   streamprefix, centroid,
-											   scan_time, scan_time, dpmetadata, date, bbox,
-											   terra_md['site_metadata']['sitename'])
+			sitename = terra_md['site_metadata']['sitename']
+		elif self.plots and centroid:
+			# Find the plot in the local shapefile rather than with a remote lookup
+			with metrics.timer("plot_lookup"):
+				sitename = self.plots.sitename(centroid)
+			if sitename:
+				self.log_info(resource, "Found plot %s from centroid" % sitename)
+				local_plot = True
+
+		# thread-safe, unlike the connector, for recording the dataset from the sink's thread
+		client = get_client(host, secret_key, verify=getattr(connector, 'ssl_verify', True))
+		queued = False
+		if sitename:
+			stream_id = self.get_stream_id(connector, host, secret_key, sitename, streamprefix)
+			if stream_id:
+				self.log_info(resource, "Queueing datapoint for stream %s" % stream_id)
+				metrics.count("datapoints_queued")
+
+				def written(ok):
+					if ok:
+						self.record_datapoint(client, host, resource)
+					else:
+						self.log_error(resource, "Datapoint could not be written to stream %s" % stream_id)
+						self.coalescer.forget(resource['id'])
+
+				# the dataset metadata and ledger entry are written once the batch holding the datapoint is
+				self.get_sink(host, secret_key).add(stream_id, bbox if bbox else point_geometry(centroid),
+													scan_time, scan_time, dpmetadata, on_written=written)
+				queued = True
+			elif local_plot:
+				# never create a plot sensor from a name built here; leave it to the remote lookup
+				self.log_info(resource, "No sensor named %s; creating datapoint with lookup in %s" % (sitename, streamprefix))
+				create_datapoint_with_dependencies(connector, host, secret_key,
+												   streamprefix, centroid,
+												   scan_time, scan_time, dpmetadata, date, bbox)
+			else:
+				self.log_info(resource, "Creating datapoint without lookup in %s" % streamprefix)
+				create_datapoint_with_dependencies(connector, host, secret_key,
+												   streamprefix, centroid,
+												   scan_time, scan_time, dpmetadata, date, bbox,
+												   sitename)
 
 		else:
 			# We need to do the traditional querying for plot
@@ -92,17 +233,102 @@ class Sensorposition2Geostreams(TerrarefExtractor):
 											   streamprefix, centroid,
 											   scan_time, scan_time, dpmetadata, date, bbox)
 
+		if not queued:
+			self.record_datapoint(client, host, resource)
+
+		for sink in self.sinks.values():
+			self.log_info(resource, sink.summary())
+		self.log_info(resource, self.streams.summary())
+		self.log_info(resource, self.coalescer.summary())
+		if self.plots:
+			self.log_info(resource, self.plots.summary())
+		self.log_info(resource, metrics.message_summary())
+		self.end_message(resource)
+
+	def record_datapoint(self, client, host, resource):
+		"""Mark the dataset as done once its datapoint is in geostreams: Clowder metadata, then the ledger.
+
+		Queued datapoints are recorded from the sink's flush thread after their
+		message has returned, so the metadata goes through a ClowderClient rather
+		than the message's connector.
+		"""
 		# Attach geometry to Clowder metadata as well
 		self.log_info(resource, "Uploading dataset metadata")
 		ext_meta = build_metadata(host, self.extractor_info, resource['id'], {
 			"datapoints_added": 1
 		}, 'dataset')
-		upload_metadata(connector, host, secret_key, resource['id'], ext_meta)
+		client.upload_metadata(resource['id'], ext_meta)
+		if self.ledger:
+			self.ledger.add(resource['id'], self.extractor_info['version'])
 
-		self.end_message(resource)
+	def get_sink(self, host, secret_key):
+		"""Return the buffered datapoint writer for a Clowder host, creating it on first use."""
+		with self.sinks_lock:
+			if host not in self.sinks:
+				self.sinks[host] = DatapointSink(host, secret_key, self.batch_size, self.batch_interval)
+			return self.sinks[host]
+
+	def get_stream_id(self, connector, host, secret_key, sitename, streamprefix):
+		"""Return the id of the stream for this plot and instrument, creating the stream if needed.
+
+		None means the plot sensor does not exist yet, which is left to
+		create_datapoint_with_dependencies. Only found streams are cached, so a
+		sensor created later is picked up.
+		"""
+		def resolve():
+			sensor = get_sensor_by_name(connector, host, secret_key, sitename)
+			if not sensor:
+				return None
+			stream_name = "%s (%s)" % (streamprefix, sensor['id'])
+			stream = get_stream_by_name(connector, host, secret_key, stream_name)
+			if stream:
+				return stream['id']
+			return create_stream(connector, host, secret_key, stream_name, sensor['id'], sensor['geometry'])
+
+		return self.streams.get_or_resolve((sitename, streamprefix), resolve)
+
+	def preload(self):
+		"""Import what the first message would, so pre-forked workers start warm."""
+		preload(GEOSTREAMS)
+		if self.plots:
+			self.plots.load()
+
+	def post_fork(self, slot):
+		"""Give a pre-forked worker its own ledger connection, caches and sinks, and its own metrics port."""
+		if self.ledger:
+			self.ledger.reopen()
+		self.streams = StreamCache(int(self.args.stream_cache_size), float(self.args.stream_cache_ttl))
+		self.sinks = {}
+		self.sinks_lock = threading.Lock()
+		if self.args.metrics_port:
+			metrics.start_exporter(self.args.metrics_port + slot, self.extractor_info['name'])
+
+	def close_sinks(self):
+		"""Write out any datapoints still buffered."""
+		for sink in self.sinks.values():
+			sink.close()
+
+
+def point_geometry(centroid):
+	"""Return a GeoJSON point for a centroid given either as GeoJSON or as [lat, lon]."""
+	if isinstance(centroid, dict):
+		return centroid
+	return {"type": "Point", "coordinates": [centroid[1], centroid[0], 0]}
 
 # @end extractor_sensor_position
 
 if __name__ == "__main__":
 	extractor = Sensorposition2Geostreams()
-	extractor.start()
+	# exit normally on SIGTERM, so buffered datapoints are written and recorded in the finally below;
+	# worker and prefork modes install their own handlers
+	signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+	try:
+		if extractor.args.prefork_socket:
+			serve_prefork(extractor, extractor.args.prefork_socket, extractor.args.prefork_workers,
+						  on_exit=extractor.close_sinks)
+		elif extractor.args.workers > 1:
+			run_workers(extractor, extractor.args.workers, extractor.args.prefetch)
+		else:
+			extractor.start()
+	finally:
+		extractor.close_sinks()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+"""Jobs submitted to a pre-forked pool go through pyclowder's own message handling.
+
+Runs against the fake Clowder server from benchmarks/; skipped when pyclowder
+isn't installed.
+"""
+
+import json
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+import unittest
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+sys.path.append(os.path.join(REPO, "common"))
+sys.path.append(os.path.join(REPO, "benchmarks"))
+
+import fake_clowder
+import prefork
+
+try:
+	import pyclowder.connectors
+except ImportError:
+	pyclowder = None
+
+
+class Args(object):
+	mounted_paths = {}
+	sslverify = True
+
+
+class Extractor(object):
+	"""Appends the resources pyclowder hands to process_message to a file, one JSON line each."""
+
+	extractor_info = {"name": "test.prefork", "process": {"dataset": ["file.added"]}}
+	args = Args()
+
+	def __init__(self, out_path):
+		self.out_path = out_path
+		self.slot = None
+
+	def post_fork(self, slot):
+		self.slot = slot
+
+	def check_message(self, connector, host, secret_key, resource, parameters):
+		from pyclowder.utils import CheckMessage
+		return CheckMessage.bypass
+
+	def process_message(self, connector, host, secret_key, resource, parameters):
+		with open(self.out_path, 'a') as f:
+			f.write(json.dumps({"type": resource["type"], "id": resource["id"], "slot": self.slot}) + "\n")
+
+
+class JobsTest(unittest.TestCase):
+	def test_extractor_arguments(self):
+		jobs = prefork._jobs(["--connector", "HPC", "--pickle", "a.pickle", "b.pickle", "--sslignore", "--ping"])
+		self.assertEqual(jobs, [{"picklefile": os.path.abspath("a.pickle")},
+								{"picklefile": os.path.abspath("b.pickle")}, {"ping": True}])
+
+	def test_routing_key_needs_a_message(self):
+		self.assertRaises(ValueError, prefork._jobs, ["--routing_key", "clowder.dataset.file.added"])
+
+
+@unittest.skipIf(pyclowder is None, "pyclowder is required")
+class SubmitTest(unittest.TestCase):
+	def setUp(self):
+		self.server, self.state, self.host = fake_clowder.start()
+		self.state.seed({"datasets": {"ds1": {"name": "stereoTop - 1"}}})
+		self.tmp = tempfile.mkdtemp()
+		self.socket_path = os.path.join(self.tmp, "prefork.sock")
+		self.out_path = os.path.join(self.tmp, "processed")
+		self.pid = os.fork()
+		if self.pid == 0:
+			try:
+				prefork.serve_prefork(Extractor(self.out_path), self.socket_path, workers=1)
+			finally:
+				os._exit(0)
+		for i in range(100):
+			if os.path.exists(self.socket_path):
+				break
+			time.sleep(0.05)
+
+	def tearDown(self):
+		os.kill(self.pid, signal.SIGTERM)
+		os.waitpid(self.pid, 0)
+		self.server.shutdown()
+		shutil.rmtree(self.tmp)
+
+	def test_message_with_routing_key(self):
+		message = os.path.join(self.tmp, "message.json")
+		with open(message, 'w') as f:
+			json.dump({"id": "ds1", "datasetId": "ds1", "host": self.host, "secretKey": "key"}, f)
+
+		jobs = prefork._jobs(["--message", message, "--routing_key", "clowder.dataset.file.added"])
+		reply = prefork.submit(self.socket_path, jobs[0], timeout=30)
+
+		self.assertEqual(reply["status"], "ok", reply.get("error"))
+		with open(self.out_path) as f:
+			self.assertEqual([json.loads(line) for line in f], [{"type": "dataset", "id": "ds1", "slot": 0}])
+
+
+if __name__ == "__main__":
+	unittest.main()
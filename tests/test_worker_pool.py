@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+"""Messages handled by the worker pool go through pyclowder's own message handling.
+
+Runs against the fake Clowder server from benchmarks/; skipped when pyclowder
+or pika aren't installed.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+import unittest
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+sys.path.append(os.path.join(REPO, "common"))
+sys.path.append(os.path.join(REPO, "benchmarks"))
+
+import fake_clowder
+import worker_pool
+
+
+class Method(object):
+	def __init__(self, delivery_tag, routing_key, redelivered=False):
+		self.delivery_tag = delivery_tag
+		self.routing_key = routing_key
+		self.redelivered = redelivered
+
+
+class Properties(object):
+	reply_to = None
+	correlation_id = None
+
+
+class Channel(object):
+	def __init__(self):
+		self.acked = []
+		self.nacked = []
+
+	def basic_ack(self, delivery_tag):
+		self.acked.append(delivery_tag)
+
+	def basic_nack(self, delivery_tag, requeue=True):
+		self.nacked.append((delivery_tag, requeue))
+
+
+class Extractor(object):
+	"""Records the resources pyclowder hands to process_message."""
+
+	extractor_info = {"name": "test.worker_pool", "process": {"dataset": ["file.added"]}}
+
+	def __init__(self):
+		self.resources = []
+		self.lock = threading.Lock()
+
+	def check_message(self, connector, host, secret_key, resource, parameters):
+		from pyclowder.utils import CheckMessage
+		return CheckMessage.bypass
+
+	def process_message(self, connector, host, secret_key, resource, parameters):
+		with self.lock:
+			self.resources.append(resource)
+
+
+def consumer(extractor, workers=2):
+	"""A MessageConsumer without a RabbitMQ connection; channel calls run at once."""
+	c = worker_pool.MessageConsumer.__new__(worker_pool.MessageConsumer)
+	c.extractor = extractor
+	c.workers = workers
+	c.pool = worker_pool.OrderedPool(workers)
+	c.processed = 0
+	c.failed = 0
+	c.count_lock = threading.Lock()
+	c.mounted_paths = {}
+	c.ssl_verify = True
+	c.channel = Channel()
+	c.threadsafe = lambda func, *args, **kwargs: func(*args, **kwargs)
+	return c
+
+
+@unittest.skipIf(worker_pool.pika is None, "pyclowder and pika are required")
+class ProcessMessageTest(unittest.TestCase):
+	def setUp(self):
+		self.server, self.state, self.host = fake_clowder.start()
+		self.state.seed({"datasets": {"ds%d" % i: {"name": "stereoTop - %d" % i} for i in range(4)}})
+
+	def tearDown(self):
+		self.server.shutdown()
+
+	def test_dataset_messages(self):
+		extractor = Extractor()
+		c = consumer(extractor)
+		for i in range(4):
+			body = json.dumps({"id": "ds%d" % i, "datasetId": "ds%d" % i, "host": self.host, "secretKey": "key"})
+			c.on_message(c.channel, Method(i, "clowder.dataset.file.added"), Properties(), body)
+		c.pool.wait()
+
+		self.assertEqual(sorted(c.channel.acked), [0, 1, 2, 3])
+		self.assertEqual(c.channel.nacked, [])
+		self.assertEqual(sorted(r["name"] for r in extractor.resources), ["stereoTop - %d" % i for i in range(4)])
+		self.assertTrue(all(r["type"] == "dataset" for r in extractor.resources))
+
+	def test_routing_key_in_body_is_kept(self):
+		body = worker_pool.message_body(json.dumps({"routing_key": "clowder.file.added"}), "clowder.dataset.file.added")
+		self.assertEqual(body["routing_key"], "clowder.file.added")
+
+
+class Stats(worker_pool.PerThreadStats):
+	"""Resets and counts its stats like TerrarefExtractor's start_message/end_message."""
+
+	def message(self, n, results):
+		self.created = 0
+		self.bytes = 0
+		for i in range(n):
+			self.created += 1
+			self.bytes += 10
+			time.sleep(0.001)
+		results[n] = (self.created, self.bytes)
+
+
+class PerThreadStatsTest(unittest.TestCase):
+	def test_concurrent_messages_keep_their_own_stats(self):
+		stats = Stats()
+		results = {}
+		threads = [threading.Thread(target=stats.message, args=(n, results)) for n in range(1, 9)]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		self.assertEqual(results, dict((n, (n, n * 10)) for n in range(1, 9)))
+		self.assertEqual(stats.created, 0)
+
+
+if __name__ == "__main__":
+	unittest.main()